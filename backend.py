@@ -0,0 +1,663 @@
+import os
+import stat
+import time
+import errno
+import fcntl
+import struct
+import sqlite3
+import asyncio
+import logging
+import threading
+import pylut
+import metrics
+import mountinfo
+from runcmd import Run_Cmd_Error
+
+log = logging.getLogger( __name__ )
+
+
+class Backend( object ):
+    """
+    Filesystem specific operations used by FSItem and pylut.syncfile
+    Identifiers (FIDs) are strings, layouts are pylut.LustreStripeInfo.
+    Errors are raised as runcmd.Run_Cmd_Error (or BackendError, a subclass
+    carrying the errno as code), so callers handle every backend the same.
+    The *_async versions run the blocking call in the loop's default
+    executor unless a backend has something better.
+    """
+    name = None
+
+    def path2fid( self, path ):
+        raise NotImplementedError
+
+
+    def fid2path( self, mountpoint, fid ):
+        """ Return list of all paths (hardlinks) of fid
+        """
+        raise NotImplementedError
+
+
+    def fidpath( self, mountpoint, fid ):
+        """
+        Return a path that opens fid without a lookup of every path
+        component, or None if this backend has none (use the normal path)
+        """
+        return None
+
+
+    def getstripeinfo( self, path ):
+        raise NotImplementedError
+
+
+    def setstripeinfo( self, path, count=None, size=None, offset=None ):
+        """ Create file path with the given layout, or set the default
+            layout of existing directory path (same as "lfs setstripe")
+        """
+        raise NotImplementedError
+
+
+    def getsom( self, path ):
+        """ Return (possibly stale) size without asking the OSTs
+        """
+        raise NotImplementedError
+
+
+    async def path2fid_async( self, path, limit=None ):
+        return await _in_executor( self.path2fid, path )
+
+
+    async def getstripeinfo_async( self, path, limit=None ):
+        return await _in_executor( self.getstripeinfo, path )
+
+
+    async def setstripeinfo_async( self, path, count=None, size=None, offset=None,
+                                   limit=None ):
+        return await _in_executor( self.setstripeinfo, path, count, size, offset )
+
+
+    def __repr__( self ):
+        return '<{0}>'.format( self.__class__.__name__ )
+
+
+async def _in_executor( fn, *args ):
+    return await asyncio.get_running_loop().run_in_executor( None, fn, *args )
+
+
+class LfsBackend( Backend ):
+    """
+    Lustre, through the lfs command line tool (the pylut functions)
+    """
+    name = 'lfs'
+
+    def path2fid( self, path ):
+        return pylut.path2fid( path )
+
+
+    def fid2path( self, mountpoint, fid ):
+        return pylut.fid2path( mountpoint, fid )
+
+
+    def fidpath( self, mountpoint, fid ):
+        return pylut.fidpath( mountpoint, fid )
+
+
+    def getstripeinfo( self, path ):
+        return pylut.getstripeinfo( path )
+
+
+    def setstripeinfo( self, path, count=None, size=None, offset=None ):
+        return pylut.setstripeinfo( path, count=count, size=size, offset=offset )
+
+
+    def getsom( self, path ):
+        return pylut.getsom( path )
+
+
+    async def path2fid_async( self, path, limit=None ):
+        return await pylut.path2fid_async( path, limit=limit )
+
+
+    async def getstripeinfo_async( self, path, limit=None ):
+        return await pylut.getstripeinfo_async( path, limit=limit )
+
+
+    async def setstripeinfo_async( self, path, count=None, size=None, offset=None,
+                                   limit=None ):
+        return await pylut.setstripeinfo_async( path, count=count, size=size,
+                                                offset=offset, limit=limit )
+
+
+# Lustre client interface, see lustre_user.h
+LL_IOC_PATH2FID = 0x800866ad     # _IOR( 'f', 173, long )
+LOV_USER_MAGIC_V1 = 0x0bd10bd0
+LOV_USER_MAGIC_V3 = 0x0bd30bd0
+LOV_PATTERN_RAID0 = 0x001
+LOV_XATTR = 'lustre.lov'
+# create a file without allocating OST objects, so the layout can be set
+O_LOV_DELAY_CREATE = os.O_NOCTTY | getattr( os, 'O_ASYNC', 0o20000 )
+
+_lum_header = struct.Struct( '<IIQQIHH' )  # lov_user_md_v1, without objects
+_lum_v3_pool = 16                         # lov_user_md_v3 adds lmm_pool_name
+_lum_object = struct.Struct( '<QQII' )     # lov_user_ost_data_v1
+
+class XattrBackend( LfsBackend ):
+    """
+    Lustre, through the client's ioctl and xattr interface (no subprocess)
+    FIDs come from the LL_IOC_PATH2FID ioctl, layouts from the lustre.lov
+    xattr, new files are created with O_LOV_DELAY_CREATE and get their layout
+    from setxattr.  Anything this doesn't handle (symlinks and sockets, which
+    can't be opened; composite (PFL) layouts; setting the layout of an
+    existing directory) falls back to lfs.
+    """
+    name = 'xattr'
+
+    def path2fid( self, path ):
+        try:
+            fd = os.open( path, os.O_RDONLY | os.O_NONBLOCK | os.O_NOFOLLOW )
+        except ( OSError ) as e:
+            log.debug( 'path2fid {0}: {1}, using lfs'.format( path, e ) )
+            return super( XattrBackend, self ).path2fid( path )
+        try:
+            buf = bytearray( 16 )
+            fcntl.ioctl( fd, LL_IOC_PATH2FID, buf, True )
+        except ( OSError ) as e:
+            log.debug( 'path2fid {0}: {1}, using lfs'.format( path, e ) )
+            return super( XattrBackend, self ).path2fid( path )
+        finally:
+            os.close( fd )
+        return '[0x{0:x}:0x{1:x}:0x{2:x}]'.format( *struct.unpack( '<QII', buf ) )
+
+
+    def getstripeinfo( self, path ):
+        try:
+            lov = os.getxattr( path, LOV_XATTR, follow_symlinks=False )
+            return parse_lov( lov )
+        except ( OSError, LayoutError ) as e:
+            log.debug( 'getstripeinfo {0}: {1!r}, using lfs'.format( path, e ) )
+            return super( XattrBackend, self ).getstripeinfo( path )
+
+
+    def setstripeinfo( self, path, count=None, size=None, offset=None ):
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | O_LOV_DELAY_CREATE
+        try:
+            fd = os.open( path, flags, 0o666 )
+        except ( OSError ):
+            # existing dir (default layout) or error, lfs handles and reports
+            return super( XattrBackend, self ).setstripeinfo( path, count, size, offset )
+        try:
+            os.setxattr( fd, LOV_XATTR, pack_lov( count, size, offset ) )
+        except ( OSError ) as e:
+            log.debug( 'setstripeinfo {0}: {1}, using lfs'.format( path, e ) )
+            os.close( fd )
+            fd = None
+            os.unlink( path )
+            return super( XattrBackend, self ).setstripeinfo( path, count, size, offset )
+        finally:
+            if fd is not None:
+                os.close( fd )
+
+
+def parse_lov( lov ):
+    """
+    Return pylut.LustreStripeInfo from the value of the lustre.lov xattr
+    (struct lov_user_md v1 or v3)
+    Without objects (a directory default layout), only count, size and
+    offset are set, same as for "lfs getstripe" on a directory.
+    """
+    if len( lov ) < _lum_header.size:
+        raise LayoutError( reason='short lov xattr', origin=lov )
+    ( magic, pattern, oi_id, oi_seq, size, count, gen_or_offset ) = \
+        _lum_header.unpack_from( lov, 0 )
+    if magic == LOV_USER_MAGIC_V1:
+        start = _lum_header.size
+    elif magic == LOV_USER_MAGIC_V3:
+        start = _lum_header.size + _lum_v3_pool
+    else:
+        raise LayoutError( reason='unsupported layout magic 0x{0:x}'.format( magic ),
+                           origin=lov )
+    if count == 0xffff:
+        count = -1
+    nobj = ( len( lov ) - start ) // _lum_object.size
+    if nobj < 1:
+        if gen_or_offset == 0xffff:
+            gen_or_offset = -1
+        return pylut.LustreStripeInfo( count=count, size=size, offset=gen_or_offset )
+    index_info = []
+    for i in range( nobj ):
+        ( objid, group, ost_gen, obdidx ) = _lum_object.unpack_from(
+            lov, start + i * _lum_object.size )
+        index_info.append( ( obdidx, objid, group ) )
+    return pylut.LustreStripeInfo( count=count, size=size, offset=index_info[0][0],
+        pattern=pattern, gen=gen_or_offset, index_info=index_info )
+
+
+def pack_lov( count=None, size=None, offset=None ):
+    """
+    Return lov_user_md v1 for setting a layout, None means filesystem default
+    """
+    if offset is None or int( offset ) < 0:
+        offset = 0xffff
+    if count is not None and int( count ) < 0:
+        count = 0xffff
+    return _lum_header.pack( LOV_USER_MAGIC_V1, LOV_PATTERN_RAID0, 0, 0,
+                             int( size or 0 ), int( count or 0 ), int( offset ) )
+
+
+class PosixBackend( Backend ):
+    """
+    Any non-Lustre filesystem (ext4, XFS, NFS, tmpfs, ...), no subprocess
+    The identifier is built from ( st_dev, st_ino ), layouts are empty
+    (same as "has no stripe info") and setstripeinfo just creates the file.
+    """
+    name = 'posix'
+
+    def _lstat( self, path, op ):
+        try:
+            return os.lstat( path )
+        except ( OSError ) as e:
+            raise BackendError( e.errno, '{0}: {1}'.format( path, e.strerror ),
+                                [ self.name, op, path ] )
+
+
+    def path2fid( self, path ):
+        st = self._lstat( path, 'path2fid' )
+        return '0x{0:x}:0x{1:x}'.format( st.st_dev, st.st_ino )
+
+
+    def fid2path( self, mountpoint, fid ):
+        raise BackendError( errno.EOPNOTSUPP,
+            'fid2path not supported on {0}'.format( mountpoint ),
+            [ self.name, 'fid2path', fid ] )
+
+
+    def getstripeinfo( self, path ):
+        self._lstat( path, 'getstripe' )
+        return pylut.LustreStripeInfo()
+
+
+    def setstripeinfo( self, path, count=None, size=None, offset=None ):
+        if os.path.isdir( path ):
+            return
+        try:
+            os.close( os.open( path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666 ) )
+        except ( OSError ) as e:
+            raise BackendError( e.errno,
+                'setstripe: cannot create {0}: {1}'.format( path, e.strerror ),
+                [ self.name, 'setstripe', path ] )
+
+
+    def getsom( self, path ):
+        return self._lstat( path, 'getsom' ).st_size
+
+
+    # plain system calls, not worth a trip through the executor
+    async def path2fid_async( self, path, limit=None ):
+        return self.path2fid( path )
+
+
+    async def getstripeinfo_async( self, path, limit=None ):
+        return self.getstripeinfo( path )
+
+
+    async def setstripeinfo_async( self, path, count=None, size=None, offset=None,
+                                   limit=None ):
+        return self.setstripeinfo( path, count, size, offset )
+
+
+_sim_schema = '''
+CREATE TABLE IF NOT EXISTS fids (
+    dev INTEGER, ino INTEGER, fid TEXT UNIQUE, PRIMARY KEY ( dev, ino ) );
+CREATE TABLE IF NOT EXISTS links (
+    fid TEXT, path TEXT, PRIMARY KEY ( fid, path ) );
+CREATE TABLE IF NOT EXISTS layouts (
+    fid TEXT PRIMARY KEY, count INTEGER, size INTEGER, offset INTEGER );
+CREATE TABLE IF NOT EXISTS objects (
+    fid TEXT, stripe INTEGER, obdidx INTEGER, objid INTEGER,
+    PRIMARY KEY ( fid, stripe ) );
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY, value INTEGER );
+'''
+
+class SimBackend( Backend ):
+    """
+    Simulated Lustre over a normal directory tree, no lfs needed
+    FIDs and layouts are kept in SQLite (in memory by default), keyed by
+    (st_dev, st_ino):
+    - FIDs are handed out in sequence on first lookup, the way the MDS
+      allocates them ([0x200000400:0x1:0x0], [0x200000400:0x2:0x0], ...)
+    - regular files get a layout on first use: the one from setstripeinfo,
+      else the default layout of the parent directory, else the default of
+      root, else count=1, size=1MiB; OST objects are allocated round-robin
+      over osts targets with per-OST object ids, so index_info looks real
+    - fid2path answers for every path the FID was seen under
+    latency (seconds) is slept in every call, to stand in for the MDS round
+    trip.  An inode number reused after a delete keeps the old FID, except
+    for files created by setstripeinfo.
+    :param root      str: top of the simulated filesystem
+    :param db        str: sqlite database (default: in memory), a file keeps
+                          FIDs and layouts between runs
+    :param osts      int: number of simulated OSTs (default=8)
+    :param count     int: filesystem default stripe count (default=1)
+    :param size      int: filesystem default stripe size (default=1MiB)
+    :param latency float: seconds added to every operation (default=0)
+    """
+    name = 'sim'
+    fid_seq = 0x200000400
+    fid_seq_width = 0x20000
+
+    def __init__( self, root, db=':memory:', osts=8, count=1, size=1048576,
+                  latency=0 ):
+        self.root = os.path.abspath( root )
+        self.osts = osts
+        self.default = ( count, size, -1 )
+        self.latency = latency
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect( db, check_same_thread=False, isolation_level=None )
+        self._db.executescript( _sim_schema )
+
+
+    def _op( self, name ):
+        if self.latency > 0:
+            time.sleep( self.latency )
+        return metrics.timer( 'backend.sim.{0}'.format( name ) )
+
+
+    def _lstat( self, path, op ):
+        try:
+            return os.lstat( path )
+        except ( OSError ) as e:
+            raise BackendError( e.errno, '{0}: {1}'.format( path, e.strerror ),
+                                [ self.name, op, path ] )
+
+
+    def _next( self, name, first=1 ):
+        """ Next value of counter name (call with the lock held)
+        """
+        row = self._db.execute( 'SELECT value FROM counters WHERE name=?',
+                                ( name, ) ).fetchone()
+        value = first if row is None else row[0] + 1
+        self._db.execute( 'INSERT OR REPLACE INTO counters VALUES (?, ?)', ( name, value ) )
+        return value
+
+
+    def _newfid( self, st ):
+        n = self._next( 'fid', first=0 )
+        fid = '[0x{0:x}:0x{1:x}:0x0]'.format( self.fid_seq + n // self.fid_seq_width,
+                                              n % self.fid_seq_width + 1 )
+        self._db.execute( 'INSERT OR REPLACE INTO fids VALUES (?, ?, ?)',
+                          ( st.st_dev, st.st_ino, fid ) )
+        return fid
+
+
+    def _fid( self, path, st, new=False ):
+        """ FID of path (call with the lock held), new=True for a new file
+        """
+        row = self._db.execute( 'SELECT fid FROM fids WHERE dev=? AND ino=?',
+                                ( st.st_dev, st.st_ino ) ).fetchone()
+        if row is not None and new:
+            # inode number reused, forget the deleted file
+            for table in ( 'links', 'layouts', 'objects' ):
+                self._db.execute( 'DELETE FROM {0} WHERE fid=?'.format( table ), row )
+            row = None
+        fid = self._newfid( st ) if row is None else row[0]
+        self._db.execute( 'INSERT OR IGNORE INTO links VALUES (?, ?)',
+                          ( fid, os.path.abspath( path ) ) )
+        return fid
+
+
+    def path2fid( self, path ):
+        with self._op( 'path2fid' ):
+            st = self._lstat( path, 'path2fid' )
+            with self._lock:
+                return self._fid( path, st )
+
+
+    def fid2path( self, mountpoint, fid ):
+        with self._op( 'fid2path' ):
+            with self._lock:
+                return self._fid2path( fid )
+
+
+    def _fid2path( self, fid ):
+        """ Paths of fid that still exist (call with the lock held)
+        """
+        key = self._db.execute( 'SELECT dev, ino FROM fids WHERE fid=?',
+                                ( fid, ) ).fetchone()
+        paths = []
+        if key is not None:
+            for ( path, ) in self._db.execute( 'SELECT path FROM links WHERE fid=?',
+                                               ( fid, ) ).fetchall():
+                try:
+                    st = os.lstat( path )
+                except ( OSError ):
+                    st = None
+                if st is not None and ( st.st_dev, st.st_ino ) == key:
+                    paths.append( path )
+                else:
+                    self._db.execute( 'DELETE FROM links WHERE fid=? AND path=?',
+                                      ( fid, path ) )
+        if len( paths ) < 1:
+            raise BackendError( errno.ENOENT,
+                '{0} cannot find {1}: No such file or directory'.format( self.root, fid ),
+                [ self.name, 'fid2path', fid ] )
+        return paths
+
+
+    def fidpath( self, mountpoint, fid ):
+        try:
+            return self.fid2path( mountpoint, fid )[0]
+        except ( BackendError ):
+            return None
+
+
+    def getsom( self, path ):
+        with self._op( 'getsom' ):
+            return self._lstat( path, 'getsom' ).st_size
+
+
+    def getstripeinfo( self, path ):
+        with self._op( 'getstripe' ):
+            st = self._lstat( path, 'getstripe' )
+            with self._lock:
+                if stat.S_ISDIR( st.st_mode ):
+                    ( count, size, offset ) = self._dirlayout( path, st )
+                    return pylut.LustreStripeInfo( count=count, size=size, offset=offset )
+                if not stat.S_ISREG( st.st_mode ):
+                    return pylut.LustreStripeInfo()
+                fid = self._fid( path, st )
+                objs = self._objects( fid )
+                if len( objs ) < 1:
+                    ( count, size, offset ) = self._dirlayout(
+                        os.path.dirname( os.path.abspath( path ) ) )
+                    objs = self._allocate( fid, count, size, offset )
+                ( size, ) = self._db.execute( 'SELECT size FROM layouts WHERE fid=?',
+                                              ( fid, ) ).fetchone()
+                index_info = [ ( obdidx, objid, 0 ) for ( obdidx, objid ) in objs ]
+                return pylut.LustreStripeInfo( count=len( objs ), size=size,
+                    offset=index_info[0][0], pattern=LOV_PATTERN_RAID0, gen=0,
+                    index_info=index_info )
+
+
+    def _objects( self, fid ):
+        return self._db.execute(
+            'SELECT obdidx, objid FROM objects WHERE fid=? ORDER BY stripe',
+            ( fid, ) ).fetchall()
+
+
+    def _dirlayout( self, path, st=None ):
+        """ Default layout of directory path, inherited from root or the
+            filesystem default (call with the lock held)
+        """
+        for d in ( path, self.root ):
+            if st is None:
+                try:
+                    st = os.lstat( d )
+                except ( OSError ):
+                    continue
+            row = self._db.execute(
+                'SELECT l.count, l.size, l.offset FROM fids f JOIN layouts l '
+                'ON f.fid=l.fid WHERE f.dev=? AND f.ino=?',
+                ( st.st_dev, st.st_ino ) ).fetchone()
+            if row is not None:
+                return row
+            st = None
+        return self.default
+
+
+    def _allocate( self, fid, count, size, offset ):
+        """ Allocate OST objects for fid (call with the lock held)
+        """
+        count = int( count or self.default[0] )
+        size = int( size or self.default[1] )
+        if count < 0 or count > self.osts:
+            count = self.osts
+        if offset is None or int( offset ) < 0:
+            first = self._next( 'roundrobin', first=0 ) % self.osts
+        else:
+            first = int( offset ) % self.osts
+        self._db.execute( 'INSERT OR REPLACE INTO layouts VALUES (?, ?, ?, ?)',
+                          ( fid, count, size, first ) )
+        objs = []
+        for i in range( count ):
+            obdidx = ( first + i ) % self.osts
+            objid = self._next( 'ost{0}'.format( obdidx ) )
+            self._db.execute( 'INSERT INTO objects VALUES (?, ?, ?, ?)',
+                              ( fid, i, obdidx, objid ) )
+            objs.append( ( obdidx, objid ) )
+        return objs
+
+
+    def setstripeinfo( self, path, count=None, size=None, offset=None ):
+        with self._op( 'setstripe' ):
+            if os.path.isdir( path ):
+                st = os.lstat( path )
+                with self._lock:
+                    fid = self._fid( path, st )
+                    ( dcount, dsize, doffset ) = self._dirlayout( path, st )
+                    self._db.execute( 'INSERT OR REPLACE INTO layouts VALUES (?, ?, ?, ?)',
+                        ( fid, int( count or dcount ), int( size or dsize ),
+                          doffset if offset is None else int( offset ) ) )
+                return
+            try:
+                fd = os.open( path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666 )
+            except ( OSError ) as e:
+                raise BackendError( e.errno,
+                    'setstripe: cannot create {0}: {1}'.format( path, e.strerror ),
+                    [ self.name, 'setstripe', path ] )
+            try:
+                st = os.fstat( fd )
+            finally:
+                os.close( fd )
+            with self._lock:
+                fid = self._fid( path, st, new=True )
+                ( dcount, dsize, doffset ) = self._dirlayout(
+                    os.path.dirname( os.path.abspath( path ) ) )
+                self._allocate( fid, count or dcount, size or dsize,
+                                doffset if offset is None else offset )
+
+
+    def __repr__( self ):
+        return '<{0} {1}>'.format( self.__class__.__name__, self.root )
+
+
+# root directory -> Backend, see register()
+_backends = {}
+_ordered = []
+# Lustre paths below no registered root, see set_default()
+_default = LfsBackend()
+# If True, paths below no registered root on a non-Lustre mount (fstype
+# from /proc/self/mountinfo) use the backend for their fstype, see
+# set_fstype(), and PosixBackend if there is none
+autodetect = True
+_posix = PosixBackend()
+_fstypes = {}
+
+def register( root, backend ):
+    """
+    Use backend for root and everything below it (root does not have to be
+    a mountpoint), ie:
+        backend.register( '/scratch/sim', backend.SimBackend( '/scratch/sim' ) )
+    """
+    global _ordered
+    root = os.path.abspath( root )
+    _backends[ root ] = backend
+    _ordered = sorted( _backends, key=len, reverse=True )
+
+
+def unregister( root ):
+    global _ordered
+    _backends.pop( os.path.abspath( root ), None )
+    _ordered = sorted( _backends, key=len, reverse=True )
+
+
+def set_default( backend ):
+    """ Backend for Lustre mounts below no registered root (default:
+        LfsBackend), also used for everything if autodetect is off or the
+        mount table is not available
+        :return: the previous default
+    """
+    global _default
+    old = _default
+    _default = backend
+    return old
+
+
+def set_fstype( fstype, backend ):
+    """ Backend for mounts of type fstype (ie: 'nfs4'), None to go back
+        to PosixBackend (or the default, for 'lustre')
+    """
+    if backend is None:
+        _fstypes.pop( fstype, None )
+    else:
+        _fstypes[ fstype ] = backend
+
+
+def for_path( path ):
+    """
+    Return the Backend for (absolute) path
+    A registered root wins; otherwise, with autodetect, the backend follows
+    the type of the mount holding path (the lookup is cached per directory
+    by mountinfo).
+    """
+    if _ordered:
+        for root in _ordered:
+            if path.startswith( root ) and \
+               ( len( path ) == len( root ) or path[ len( root ) ] == os.sep or root == os.sep ):
+                return _backends[ root ]
+    if autodetect:
+        table = mountinfo.mounttable()
+        if table is not None:
+            m = table.find( path )
+            if m is not None:
+                if m.fstype in _fstypes:
+                    return _fstypes[ m.fstype ]
+                if m.fstype != 'lustre':
+                    return _posix
+    return _default
+
+
+class BackendError( Run_Cmd_Error ):
+    """
+    Error from a backend that doesn't run commands; code is the errno, so
+    handlers written for lfs errors (ie: code 2, ENOENT) keep working
+    """
+    pass
+
+
+class LayoutError( Exception ):
+    """ Layout (lustre.lov xattr) this module can't parse
+    """
+    def __init__( self, reason, origin, *a, **k ):
+        super( LayoutError, self ).__init__( *a, **k )
+        self.reason = reason
+        self.origin = origin
+
+    def __repr__( self ):
+        return "<{0} (reason={1} origin={2})>".format(
+            self.__class__.__name__, self.reason, self.origin )
+
+    __str__ = __repr__
+
+
+if __name__ == '__main__':
+    raise UserWarning( 'Cmdline not supported' )
@@ -0,0 +1,12 @@
+"""
+pylut benchmark suite
+
+Scenarios run against the deterministic lfs stand-in (bench/fakelfs), and
+against bench/fakersync if rsync is not installed, so they work on any Linux
+box without Lustre.  Results are written as JSON and can be compared across
+commits:
+    python -m bench --out before.json
+    python -m bench --out after.json
+    python -m bench --compare before.json after.json
+See python -m bench --help
+"""
@@ -0,0 +1,180 @@
+"""
+Run the pylut benchmark scenarios, see bench/__init__.py
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+HERE = os.path.dirname( os.path.abspath( __file__ ) )
+TOP = os.path.dirname( HERE )
+
+# small enough that the syncfile_large scenario goes through dd
+RSYNCMAXSIZE = 16 * 1024 * 1024
+
+
+def setup_env():
+    """
+    Point pylut at the stand-in tools, unless the environment already names
+    real ones.  Must run before pylut is imported.
+    """
+    rsync = shutil.which( 'rsync' ) or os.path.join( HERE, 'fakersync' )
+    os.environ.setdefault( 'PYLUTLFSPATH', os.path.join( HERE, 'fakelfs' ) )
+    os.environ.setdefault( 'PYLUTRSYNCPATH', rsync )
+    os.environ.setdefault( 'PYLUTRSYNCMAXSIZE', str( RSYNCMAXSIZE ) )
+    if TOP not in sys.path:
+        sys.path.insert( 0, TOP )
+
+
+def _git_commit():
+    try:
+        out = subprocess.run( [ 'git', 'rev-parse', 'HEAD' ], cwd=TOP,
+                              capture_output=True, text=True, check=True )
+    except ( OSError, subprocess.CalledProcessError ):
+        return None
+    return out.stdout.strip()
+
+
+def _meta( args ):
+    return {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'host': socket.gethostname(),
+        'platform': platform.platform(),
+        'time': time.strftime( '%Y-%m-%dT%H:%M:%S%z' ),
+        'scale': args.scale,
+        'backend': args.backend,
+        'repeat': args.repeat,
+        'lfs': os.environ[ 'PYLUTLFSPATH' ],
+        'rsync': os.environ[ 'PYLUTRSYNCPATH' ],
+        'rsyncmaxsize': int( os.environ[ 'PYLUTRSYNCMAXSIZE' ] ),
+        'fakelfs_latency': float( os.environ.get( 'FAKELFS_LATENCY', 0 ) ),
+    }
+
+
+def _backend( name, workdir ):
+    import backend
+    if name == 'sim':
+        return backend.SimBackend( workdir,
+            latency=float( os.environ.get( 'FAKELFS_LATENCY', 0 ) ) )
+    if name == 'posix':
+        return backend.PosixBackend()
+    # workdir is not on Lustre, keep autodetection from skipping the fake lfs
+    return backend.LfsBackend()
+
+
+def run_scenario( name, fn, args ):
+    """
+    Run scenario fn args.repeat times, each time in a fresh work directory
+    :return dict: median seconds plus derived rates
+    """
+    import backend
+    times = []
+    res = None
+    for i in range( args.repeat ):
+        workdir = tempfile.mkdtemp( prefix='pylutbench.', dir=args.workdir )
+        backend.register( workdir, _backend( args.backend, workdir ) )
+        try:
+            run = fn( workdir, args.scale )
+            start = time.perf_counter()
+            res = run()
+            times.append( time.perf_counter() - start )
+        finally:
+            backend.unregister( workdir )
+            shutil.rmtree( workdir )
+    secs = statistics.median( times )
+    result = dict( res )
+    result.update( {
+        'seconds': secs,
+        'times': times,
+        'ops_per_sec': res[ 'ops' ] / secs if secs else None,
+    } )
+    if 'bytes' in res:
+        result[ 'bytes_per_sec' ] = res[ 'bytes' ] / secs if secs else None
+    return result
+
+
+def compare( old, new ):
+    """ Print per scenario change in median time between two result files
+    """
+    with open( old ) as f:
+        a = json.load( f )
+    with open( new ) as f:
+        b = json.load( f )
+    print( '{0:24s} {1:>12s} {2:>12s} {3:>8s}'.format(
+        'scenario', a[ 'meta' ][ 'commit' ][ :12 ] if a[ 'meta' ][ 'commit' ] else old,
+        b[ 'meta' ][ 'commit' ][ :12 ] if b[ 'meta' ][ 'commit' ] else new, 'change' ) )
+    for name, r in b[ 'results' ].items():
+        if name not in a[ 'results' ]:
+            print( '{0:24s} {1:>12s} {2:12.4f}'.format( name, '-', r[ 'seconds' ] ) )
+            continue
+        before = a[ 'results' ][ name ][ 'seconds' ]
+        change = ( r[ 'seconds' ] - before ) / before * 100 if before else 0.0
+        print( '{0:24s} {1:12.4f} {2:12.4f} {3:+7.1f}%'.format(
+            name, before, r[ 'seconds' ], change ) )
+    for key in ( 'scale', 'backend', 'lfs', 'rsync', 'fakelfs_latency' ):
+        if a[ 'meta' ].get( key ) != b[ 'meta' ].get( key ):
+            print( 'WARNING: {0} differs: {1!r} vs {2!r}'.format(
+                key, a[ 'meta' ].get( key ), b[ 'meta' ].get( key ) ) )
+
+
+def process_cmdline():
+    parser = argparse.ArgumentParser( prog='python -m bench',
+        description='Run pylut benchmark scenarios against a fake lfs' )
+    parser.add_argument( '--out', '-o', help='write JSON results to this file' )
+    parser.add_argument( '--scenario', '-s', action='append',
+        help='scenario to run, may be repeated (default: all)' )
+    parser.add_argument( '--repeat', '-r', type=int, default=3,
+        help='runs per scenario, the median is reported (default: %(default)s)' )
+    parser.add_argument( '--scale', type=int, default=1,
+        help='multiplies the input size of every scenario (default: %(default)s)' )
+    parser.add_argument( '--backend', choices=( 'lfs', 'sim', 'posix' ), default='lfs',
+        help='lfs: run the lfs tool (default: bench/fakelfs); sim: '
+             'backend.SimBackend, no subprocess for Lustre calls; posix: '
+             'backend.PosixBackend, no Lustre at all' )
+    parser.add_argument( '--workdir',
+        help='where scenario inputs are created (default: system tmp dir)' )
+    parser.add_argument( '--list', action='store_true', help='list scenarios' )
+    parser.add_argument( '--compare', nargs=2, metavar=( 'OLD', 'NEW' ),
+        help='compare two result files instead of running' )
+    return parser.parse_args()
+
+
+def main():
+    args = process_cmdline()
+    if args.compare:
+        compare( *args.compare )
+        return
+    setup_env()
+    from bench import scenarios
+    if args.list:
+        for name in scenarios.SCENARIOS:
+            print( name )
+        return
+    names = args.scenario or list( scenarios.SCENARIOS )
+    unknown = set( names ) - set( scenarios.SCENARIOS )
+    if unknown:
+        raise SystemExit( 'Unknown scenario(s): {0}'.format( ', '.join( sorted( unknown ) ) ) )
+    output = { 'meta': _meta( args ), 'results': {} }
+    for name in names:
+        r = run_scenario( name, scenarios.SCENARIOS[ name ], args )
+        output[ 'results' ][ name ] = r
+        sys.stderr.write( '{0:24s} {1:10.4f}s {2:12.1f} ops/s\n'.format(
+            name, r[ 'seconds' ], r[ 'ops_per_sec' ] or 0 ) )
+    text = json.dumps( output, indent=2, sort_keys=True )
+    if args.out:
+        with open( args.out, 'w' ) as f:
+            f.write( text + '\n' )
+    else:
+        print( text )
+
+
+if __name__ == '__main__':
+    main()
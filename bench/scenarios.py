@@ -0,0 +1,260 @@
+"""
+Benchmark scenarios
+Each scenario is a function( workdir, scale ) that prepares its input under
+workdir (not timed) and returns a callable that does the timed work and
+returns a dict with 'ops' (operations done) and optionally 'bytes'.
+pylut must only be imported after bench.setup_env(), it reads its settings
+from the environment at import time.  Lustre calls go through the backend
+registered for workdir (see python -m bench --backend).
+"""
+import os
+import time
+import random
+import collections
+
+# name -> scenario function, in definition order
+SCENARIOS = collections.OrderedDict()
+
+SEED = 1
+
+
+def scenario( fn ):
+    SCENARIOS[ fn.__name__ ] = fn
+    return fn
+
+
+def _mkfiles( top, count, size, seed=SEED ):
+    """ count files of size bytes (deterministic content) under top
+    """
+    rnd = random.Random( seed )
+    os.makedirs( top )
+    block = bytes( rnd.getrandbits( 8 ) for i in range( min( size, 65536 ) or 1 ) )
+    paths = []
+    for i in range( count ):
+        p = os.path.join( top, 'f{0:06d}'.format( i ) )
+        with open( p, 'wb' ) as f:
+            left = size
+            while left > 0:
+                f.write( block[ :left ] )
+                left -= len( block )
+        paths.append( p )
+    return paths
+
+
+def _items( paths ):
+    import fsitem
+    mnt = fsitem.getmountpoint( os.path.dirname( paths[0] ) )
+    return [ fsitem.FSItem( p, absname=p, mountpoint=mnt ) for p in paths ]
+
+
+def _syncopts( workdir, **kw ):
+    opts = dict( tmpbase=os.path.join( workdir, 'tmpbase' ), keeptmp=False,
+                 synctimes=True, syncperms=True, post_checksums=True )
+    opts.update( kw )
+    return opts
+
+
+@scenario
+def path2fid( workdir, scale ):
+    import backend
+    paths = _mkfiles( os.path.join( workdir, 'src' ), 50 * scale, 0 )
+    be = backend.for_path( paths[0] )
+    def run():
+        for p in paths:
+            be.path2fid( p )
+        return { 'ops': len( paths ) }
+    return run
+
+
+@scenario
+def getstripe_parse( workdir, scale ):
+    import pylut
+    lines = [ '/mnt/lustre/file',
+              'lmm_stripe_count:   4',
+              'lmm_stripe_size:    1048576',
+              'lmm_pattern:        1',
+              'lmm_layout_gen:     0',
+              'lmm_stripe_offset:  3',
+              '\tobdidx\t\t objid\t\t objid\t\t group' ] + \
+            [ '\t{0:6d}\t{1:14d}\t{2:>14}\t{3:14d}'.format( i, 1000 + i, hex( 1000 + i ), 0 )
+              for i in range( 3, 7 ) ] + [ '' ]
+    count = 20000 * scale
+    def run():
+        for i in range( count ):
+            pylut.LustreStripeInfo.from_lfs_getstripe( list( lines ) )
+        return { 'ops': count }
+    return run
+
+
+@scenario
+def getstripe( workdir, scale ):
+    import backend
+    paths = _mkfiles( os.path.join( workdir, 'src' ), 50 * scale, 0 )
+    be = backend.for_path( paths[0] )
+    def run():
+        for p in paths:
+            be.getstripeinfo( p )
+        return { 'ops': len( paths ) }
+    return run
+
+
+@scenario
+def setstripe( workdir, scale ):
+    import backend
+    top = os.path.join( workdir, 'tgt' )
+    os.makedirs( top )
+    count = 50 * scale
+    be = backend.for_path( top )
+    def run():
+        for i in range( count ):
+            be.setstripeinfo( os.path.join( top, 'f{0:06d}'.format( i ) ),
+                              count=4, size=1048576 )
+        return { 'ops': count }
+    return run
+
+
+def _sync_files( workdir, paths, **kw ):
+    import pylut
+    import fsitem
+    tgtdir = os.path.join( workdir, 'tgt' )
+    if not os.path.isdir( tgtdir ):
+        os.makedirs( tgtdir )
+    opts = _syncopts( workdir, **kw )
+    srcs = _items( paths )
+    tgts = [ fsitem.FSItem( os.path.join( tgtdir, os.path.basename( p ) ),
+                            mountpoint=srcs[0].mountpoint ) for p in paths ]
+    def run():
+        nbytes = 0
+        actions = collections.Counter()
+        for s, t in zip( srcs, tgts ):
+            ( tmp, action ) = pylut.syncfile( s, t, **opts )
+            actions.update( k for k, v in action.items() if v )
+            if action[ 'data_copy' ]:
+                nbytes += s.size
+        return { 'ops': len( srcs ), 'bytes': nbytes, 'actions': dict( actions ) }
+    return run
+
+
+@scenario
+def syncfile_small( workdir, scale ):
+    paths = _mkfiles( os.path.join( workdir, 'src' ), 20 * scale, 4096 )
+    return _sync_files( workdir, paths )
+
+
+@scenario
+def syncfile_large( workdir, scale ):
+    # larger than PYLUTRSYNCMAXSIZE (see bench.setup_env), copied with dd
+    paths = _mkfiles( os.path.join( workdir, 'src' ), 2 * scale, 24 * 1024 * 1024 )
+    return _sync_files( workdir, paths )
+
+
+@scenario
+def syncfile_hardlinked( workdir, scale ):
+    # 4 links per inode, keeptmp so links after the first are hardlinked
+    # from the tmp file instead of copied
+    src = os.path.join( workdir, 'src' )
+    paths = _mkfiles( src, 5 * scale, 65536 )
+    links = []
+    for p in paths:
+        links.append( p )
+        for k in range( 1, 4 ):
+            os.link( p, '{0}.link{1}'.format( p, k ) )
+            links.append( '{0}.link{1}'.format( p, k ) )
+    return _sync_files( workdir, links, keeptmp=True )
+
+
+@scenario
+def syncfile_metaonly( workdir, scale ):
+    # tgt data is current, only the atime differs (src changed last, so the
+    # ctime shortcut in _compare_files doesn't skip the check)
+    import shutil
+    paths = _mkfiles( os.path.join( workdir, 'src' ), 20 * scale, 4096 )
+    tgtdir = os.path.join( workdir, 'tgt' )
+    os.makedirs( tgtdir )
+    for p in paths:
+        t = os.path.join( tgtdir, os.path.basename( p ) )
+        shutil.copy2( p, t )
+        st = os.stat( p )
+        os.utime( t, ns=( st.st_atime_ns - 10**9, st.st_mtime_ns ) )
+    time.sleep( 0.01 )
+    for p in paths:
+        os.chmod( p, 0o644 )
+    return _sync_files( workdir, paths )
+
+
+@scenario
+def checksum( workdir, scale ):
+    paths = _mkfiles( os.path.join( workdir, 'src' ), 1, 64 * 1024 * 1024 * scale )
+    def run():
+        f = _items( paths )[0]
+        f.checksum()
+        return { 'ops': 1, 'bytes': f.size }
+    return run
+
+
+@scenario
+def tree_sync( workdir, scale ):
+    import pylut
+    import fsitem
+    import treewalk
+    src = os.path.join( workdir, 'src' )
+    tgt = os.path.join( workdir, 'tgt' )
+    rnd = random.Random( SEED )
+    for d in range( 4 * scale ):
+        for sd in range( 4 ):
+            _mkfiles( os.path.join( src, 'd{0}'.format( d ), 's{0}'.format( sd ) ),
+                      8, rnd.choice( ( 0, 512, 4096, 65536 ) ), seed=d * 4 + sd )
+    opts = _syncopts( workdir )
+    def run():
+        nbytes = 0
+        ops = 0
+        for item in treewalk.walk( src ):
+            tpath = tgt + item.absname[ len( src ): ]
+            if item.absname == src:
+                if not os.path.isdir( tgt ):
+                    os.mkdir( tgt )
+            elif item.is_dir():
+                if not os.path.isdir( tpath ):
+                    os.mkdir( tpath )
+                pylut.syncdir( item, fsitem.FSItem( tpath ), syncperms=True,
+                               synctimes=True )
+            else:
+                ( tmp, action ) = pylut.syncfile( item, fsitem.FSItem( tpath ), **opts )
+                if action[ 'data_copy' ]:
+                    nbytes += item.size
+            ops += 1
+        return { 'ops': ops, 'bytes': nbytes }
+    return run
+
+
+@scenario
+def sched_sync( workdir, scale ):
+    # most files share OST 0, see scheduler.OstScheduler
+    import backend
+    import fsitem
+    import scheduler
+    src = os.path.join( workdir, 'src' )
+    tgt = os.path.join( workdir, 'tgt' )
+    os.makedirs( src )
+    os.makedirs( tgt )
+    be = backend.for_path( workdir )
+    block = bytes( random.Random( SEED ).getrandbits( 8 ) for i in range( 65536 ) )
+    names = []
+    for i in range( 32 * scale ):
+        name = 'f{0:06d}'.format( i )
+        p = os.path.join( src, name )
+        be.setstripeinfo( p, count=1, size=1048576, offset=0 if i % 4 else i % 8 )
+        with open( p, 'r+b' ) as f:
+            for k in range( 32 ):
+                f.write( block )
+        names.append( name )
+    opts = _syncopts( workdir )
+    def run():
+        pairs = ( ( fsitem.FSItem( os.path.join( src, n ) ),
+                    fsitem.FSItem( os.path.join( tgt, n ) ) ) for n in names )
+        sched = scheduler.OstScheduler( workers=8, max_ost_bytes=4 * 1048576, tgt_osts=8 )
+        rv = sched.sync( pairs, **opts )
+        if rv[ 'errors' ]:
+            raise rv[ 'errors' ][0]
+        return { 'ops': rv[ 'synced' ], 'bytes': rv[ 'bytes' ] }
+    return run
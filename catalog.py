@@ -0,0 +1,368 @@
+import os
+import json
+import hashlib
+import logging
+import numpy
+import fsitem
+import pylut
+import treewalk
+
+log = logging.getLogger( __name__ )
+
+
+# One row per filesystem entry
+# path_id is the row number, parent_id is the path_id of the parent directory
+# (-1 for the root of the catalog), layout_id indexes the layout table (-1 if
+# unknown or not applicable) and fid_seq == 0 means the FID is not known.
+# phash is a 64-bit hash of the path relative to the catalog root, it is the
+# join key when comparing catalogs (see treediff)
+entry_dtype = numpy.dtype( [
+    ( 'path_id',   '<i8' ),
+    ( 'parent_id', '<i8' ),
+    ( 'phash',     '<u8' ),
+    ( 'ino',       '<u8' ),
+    ( 'fid_seq',   '<u8' ),
+    ( 'fid_oid',   '<u4' ),
+    ( 'fid_ver',   '<u4' ),
+    ( 'mode',      '<u4' ),
+    ( 'uid',       '<u4' ),
+    ( 'gid',       '<u4' ),
+    ( 'nlink',     '<u4' ),
+    ( 'size',      '<i8' ),
+    ( 'atime_ns',  '<i8' ),
+    ( 'mtime_ns',  '<i8' ),
+    ( 'ctime_ns',  '<i8' ),
+    ( 'layout_id', '<i4' ),
+] )
+
+# Interned stripe layouts, only the parts that are needed to recreate a layout
+# (offset and OST objects differ for every file, so they are not kept)
+layout_dtype = numpy.dtype( [
+    ( 'count',   '<i4' ),
+    ( 'size',    '<i8' ),
+    ( 'pattern', '<i8' ),
+] )
+
+CATALOG_VERSION = 1
+
+
+class Catalog( object ):
+    """
+    Column-wise store of tree scan results
+    Holds one row of numpy.ndarray (see entry_dtype) per filesystem entry
+    instead of one FSItem per entry; FSItems are materialized on demand with
+    item().  Names are stored as one byte blob plus offsets.
+    """
+
+    # initial number of rows, grows by doubling
+    initial_capacity = 1024
+
+    def __init__( self, root, mountpoint=None ):
+        """
+        :param root str: absolute path of the top of the scanned tree
+        :param mountpoint str: OPTIONAL mountpoint holding root
+        """
+        self.root = root
+        self.mountpoint = mountpoint
+        if self.mountpoint is None:
+            self.mountpoint = fsitem.getmountpoint( root )
+        self._entries = numpy.zeros( self.initial_capacity, dtype=entry_dtype )
+        self._len = 0
+        self._names = []            # while adding entries
+        self._nameblob = None       # after freeze() or load()
+        self._nameoffsets = None
+        self._layouts = []
+        self._layout_ids = {}
+        self._layout_array = None
+        self._relpaths = None
+
+
+    @classmethod
+    def from_walk( cls, top, with_fid=False, with_stripeinfo=False, **walkargs ):
+        """
+        Scan the tree at top (with treewalk.walk) into a new Catalog
+        :param top str: directory to scan
+        :param with_fid bool: also look up the FID of every entry (slow)
+        :param with_stripeinfo bool: also look up the layout of every regular
+                                     file and directory (slow)
+        :param walkargs: passed to treewalk.walk
+        """
+        self = None
+        dir_ids = {}
+        for item in treewalk.walk( top, **walkargs ):
+            if self is None:
+                self = cls( item.absname, mountpoint=item.mountpoint )
+                parent_id = -1
+            else:
+                parent_id = dir_ids[ item.parent ]
+            if with_fid:
+                item.inode()
+            if with_stripeinfo:
+                item.stripeinfo()
+            path_id = self.add_item( item, parent_id )
+            if item.is_dir():
+                dir_ids[ item.absname ] = path_id
+        self.freeze()
+        return self
+
+
+    def add( self, name, parent_id, st, fid=None, stripeinfo=None ):
+        """
+        Add one entry
+        :param name str: file name (basename), '' for the root
+        :param parent_id int: path_id of parent directory, -1 for the root
+        :param st os.stat_result: stat information
+        :param fid str: OPTIONAL Lustre FID
+        :param stripeinfo pylut.LustreStripeInfo: OPTIONAL stripe layout
+        :return int: path_id of the new entry
+        """
+        if self._nameblob is not None:
+            raise CatalogError( reason='catalog is read-only', origin=self.root )
+        path_id = self._len
+        if path_id >= len( self._entries ):
+            self._entries = numpy.resize( self._entries, 2 * len( self._entries ) )
+        seq, oid, ver = _fid_to_ints( fid )
+        bname = os.fsencode( name )
+        phash = 0
+        if parent_id >= 0:
+            phash = path_hash( int( self._entries[ parent_id ][ 'phash' ] ), bname )
+        self._entries[ path_id ] = (
+            path_id, parent_id, phash, st.st_ino, seq, oid, ver,
+            st.st_mode, st.st_uid, st.st_gid, st.st_nlink, st.st_size,
+            st.st_atime_ns, st.st_mtime_ns, st.st_ctime_ns,
+            self._intern_layout( stripeinfo ) )
+        self._names.append( bname )
+        self._len += 1
+        return path_id
+
+
+    def add_item( self, item, parent_id ):
+        """
+        Add an FSItem, using whatever information it already has cached
+        (FID and stripe info are not looked up)
+        :return int: path_id of the new entry
+        """
+        name = item.name if parent_id >= 0 else ''
+        return self.add( name, parent_id, item.fullstat(),
+                         fid=item._inode, stripeinfo=item._stripeinfo )
+
+
+    def freeze( self ):
+        """
+        Finish adding entries, converts all buffers to numpy arrays
+        """
+        if self._nameblob is not None:
+            return
+        self._entries = self._entries[ :self._len ].copy()
+        lengths = numpy.fromiter( ( len( n ) for n in self._names ),
+                                  dtype='<u8', count=len( self._names ) )
+        self._nameoffsets = numpy.zeros( len( lengths ) + 1, dtype='<u8' )
+        numpy.cumsum( lengths, out=self._nameoffsets[1:] )
+        self._nameblob = numpy.frombuffer( b''.join( self._names ), dtype=numpy.uint8 )
+        self._names = None
+        self._layout_array = numpy.array( self._layouts, dtype=layout_dtype )
+
+
+    def __len__( self ):
+        return self._len
+
+
+    @property
+    def entries( self ):
+        """ numpy structured array (entry_dtype) with one row per entry
+        """
+        self.freeze()
+        return self._entries
+
+
+    @property
+    def layouts( self ):
+        """ numpy structured array (layout_dtype) of interned layouts
+        """
+        self.freeze()
+        return self._layout_array
+
+
+    def name( self, path_id ):
+        self.freeze()
+        start, end = self._nameoffsets[ path_id ], self._nameoffsets[ path_id + 1 ]
+        return os.fsdecode( self._nameblob[ start:end ].tobytes() )
+
+
+    def relpath( self, path_id ):
+        """
+        Return path of entry path_id relative to the catalog root
+        """
+        parts = []
+        parent_ids = self.entries[ 'parent_id' ]
+        while path_id > 0:
+            parts.append( self.name( path_id ) )
+            path_id = parent_ids[ path_id ]
+        return os.path.join( *reversed( parts ) ) if parts else ''
+
+
+    def relpaths( self ):
+        """
+        Return list of relative paths for all entries (index is path_id)
+        Parents are always added before their children, so this is one pass.
+        """
+        if self._relpaths is None:
+            parent_ids = self.entries[ 'parent_id' ].tolist()
+            blob = self._nameblob.tobytes()
+            offsets = self._nameoffsets.tolist()
+            rv = [ '' ] * len( self )
+            for i in range( 1, len( self ) ):
+                name = os.fsdecode( blob[ offsets[i]:offsets[ i + 1 ] ] )
+                p = parent_ids[i]
+                rv[i] = name if p == 0 else rv[p] + os.sep + name
+            self._relpaths = rv
+        return self._relpaths
+
+
+    def layout( self, layout_id ):
+        """
+        Return pylut.LustreStripeInfo for layout_id, None if layout_id < 0
+        """
+        if layout_id < 0:
+            return None
+        row = self.layouts[ layout_id ]
+        sinfo = pylut.LustreStripeInfo()
+        for k in ( 'count', 'size', 'pattern' ):
+            v = int( row[ k ] )
+            if v >= 0:
+                setattr( sinfo, k, v )
+        return sinfo
+
+
+    def item( self, path_id, byfid=False ):
+        """
+        Materialize entry path_id as an FSItem (no system calls)
+        stat information, FID and stripe info come from the catalog
+        :param byfid bool: OPTIONAL see FSItem.datapath()
+        """
+        row = self.entries[ path_id ]
+        absname = os.path.join( self.root, self.relpath( path_id ) ).rstrip( os.sep ) \
+                  or os.sep
+        f = fsitem.FSItem( absname, absname=absname, mountpoint=self.mountpoint,
+                           byfid=byfid )
+        f.set_stat( _row_to_stat( row ) )
+        f.set_inode( _ints_to_fid( row[ 'fid_seq' ], row[ 'fid_oid' ], row[ 'fid_ver' ] ) )
+        f.set_stripeinfo( self.layout( int( row[ 'layout_id' ] ) ) )
+        return f
+
+
+    def items( self, byfid=False ):
+        """ Iterate over all entries as FSItems
+        """
+        for i in range( len( self ) ):
+            yield self.item( i, byfid=byfid )
+
+
+    def save( self, path ):
+        """
+        Save catalog to directory path (created if needed), as one .npy file
+        per array, so it can be loaded with load( path, mmap=True )
+        """
+        self.freeze()
+        if not os.path.isdir( path ):
+            os.makedirs( path )
+        numpy.save( os.path.join( path, 'entries.npy' ), self._entries )
+        numpy.save( os.path.join( path, 'names.npy' ), self._nameblob )
+        numpy.save( os.path.join( path, 'name_offsets.npy' ), self._nameoffsets )
+        numpy.save( os.path.join( path, 'layouts.npy' ), self._layout_array )
+        with open( os.path.join( path, 'catalog.json' ), 'w' ) as f:
+            json.dump( { 'version': CATALOG_VERSION,
+                         'root': self.root,
+                         'mountpoint': self.mountpoint,
+                         'count': len( self ) }, f )
+
+
+    @classmethod
+    def load( cls, path, mmap=True ):
+        """
+        Load a catalog written by save()
+        :param mmap bool: if True (default), arrays are memory-mapped read-only
+                          instead of read into memory
+        """
+        with open( os.path.join( path, 'catalog.json' ) ) as f:
+            meta = json.load( f )
+        if meta[ 'version' ] != CATALOG_VERSION:
+            raise CatalogError(
+                reason='unsupported catalog version {0}'.format( meta[ 'version' ] ),
+                origin=path )
+        mode = 'r' if mmap else None
+        self = cls( meta[ 'root' ], mountpoint=meta[ 'mountpoint' ] )
+        self._entries = numpy.load( os.path.join( path, 'entries.npy' ), mmap_mode=mode )
+        self._nameblob = numpy.load( os.path.join( path, 'names.npy' ), mmap_mode=mode )
+        self._nameoffsets = numpy.load( os.path.join( path, 'name_offsets.npy' ),
+                                        mmap_mode=mode )
+        self._layout_array = numpy.load( os.path.join( path, 'layouts.npy' ) )
+        self._len = len( self._entries )
+        self._names = None
+        return self
+
+
+    def _intern_layout( self, sinfo ):
+        if sinfo is None or sinfo.count is None:
+            return -1
+        key = tuple( -1 if v is None else v
+                     for v in ( sinfo.count, sinfo.size, sinfo.pattern ) )
+        try:
+            return self._layout_ids[ key ]
+        except ( KeyError ):
+            layout_id = len( self._layouts )
+            self._layouts.append( key )
+            self._layout_ids[ key ] = layout_id
+            return layout_id
+
+
+    def __repr__( self ):
+        return '<{0} {1} ({2} entries)>'.format( self.__class__.__name__,
+            self.root, len( self ) )
+
+
+def path_hash( parent_hash, name ):
+    """
+    Return 64-bit hash (int) of a relative path, given the hash of its parent
+    directory and its name (bytes); the catalog root has hash 0
+    """
+    h = hashlib.blake2b( parent_hash.to_bytes( 8, 'little' ), digest_size=8 )
+    h.update( name )
+    return int.from_bytes( h.digest(), 'little' )
+
+
+def _row_to_stat( row ):
+    ns = [ int( row[ k ] ) for k in ( 'atime_ns', 'mtime_ns', 'ctime_ns' ) ]
+    return os.stat_result(
+        ( int( row[ 'mode' ] ), int( row[ 'ino' ] ), 0, int( row[ 'nlink' ] ),
+          int( row[ 'uid' ] ), int( row[ 'gid' ] ), int( row[ 'size' ] ) )
+        + tuple( x // 1000000000 for x in ns ),
+        { 'st_atime': ns[0] / 1e9, 'st_mtime': ns[1] / 1e9, 'st_ctime': ns[2] / 1e9,
+          'st_atime_ns': ns[0], 'st_mtime_ns': ns[1], 'st_ctime_ns': ns[2] } )
+
+
+def _fid_to_ints( fid ):
+    """
+    Convert FID string '[0x200000400:0x1:0x0]' to ( seq, oid, ver )
+    """
+    if fid is None:
+        return ( 0, 0, 0 )
+    if isinstance( fid, bytes ):
+        fid = fid.decode()
+    parts = fid.strip().strip( '[]' ).split( ':' )
+    if len( parts ) != 3:
+        raise CatalogError( reason='invalid FID', origin=fid )
+    return tuple( int( x, 16 ) for x in parts )
+
+
+def _ints_to_fid( seq, oid, ver ):
+    if seq == 0:
+        return None
+    return '[{0:#x}:{1:#x}:{2:#x}]'.format( int( seq ), int( oid ), int( ver ) )
+
+
+class CatalogError( pylut.PylutError ): pass
+
+
+if __name__ == '__main__':
+    raise UserWarning( 'Cmdline not supported' )
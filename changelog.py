@@ -0,0 +1,394 @@
+import os
+import errno
+import logging
+import pylut
+import fsitem
+import treewalk
+from runcmd import runcmd, Run_Cmd_Error
+
+log = logging.getLogger( __name__ )
+
+
+# Changelog record types, see "lfs changelog" and lustre_user.h
+RECORD_TYPES = ( 'MARK', 'CREAT', 'MKDIR', 'HLINK', 'SLINK', 'MKNOD', 'UNLNK',
+                 'RMDIR', 'RENME', 'RNMTO', 'OPEN', 'CLOSE', 'LYOUT', 'TRUNC',
+                 'SATTR', 'XATTR', 'HSM', 'MTIME', 'CTIME', 'ATIME', 'MIGRT',
+                 'FLRW', 'RESYNC', 'GXATR', 'NOPEN', )
+
+# Record types that change the data or metadata of the target (t=) FID
+CHANGE_TYPES = frozenset( ( 'CREAT', 'MKDIR', 'HLINK', 'SLINK', 'MKNOD',
+                            'CLOSE', 'LYOUT', 'TRUNC', 'SATTR', 'XATTR',
+                            'HSM', 'MTIME', 'CTIME', 'MIGRT', 'FLRW',
+                            'RESYNC', ) )
+
+# Record types that remove a name (p= + name)
+REMOVE_TYPES = frozenset( ( 'UNLNK', 'RMDIR', ) )
+
+# flag set on UNLNK/RMDIR/RENME records when the last link of t= went away
+CLF_UNLINK_LAST = 0x0001
+
+NULL_FID = '[0x0:0x0:0x0]'
+
+
+class ChangelogRecord( object ):
+    """
+    class ChangelogRecord( object )
+    One record as printed by "lfs changelog"
+    """
+    attrnames = ( 'recno', 'type', 'time', 'date', 'flags', 'tfid', 'pfid',
+                  'name', 'sfid', 'spfid', 'sname', 'jobid', 'uidgid', )
+
+    def __init__( self, **kwargs ):
+        for k in self.attrnames:
+            setattr( self, k, kwargs.get( k ) )
+
+    @classmethod
+    def from_line( cls, line ):
+        """
+        Parse one line of "lfs changelog" output, ie:
+        3 06UNLNK 15:15:41.30 2018.01.09 0x1 t=[0x200000402:0x2:0x0] ef=0xf u=500:500 nid=1.2.3.4@tcp p=[0x200000402:0x1:0x0] chloe.jpg
+        For renames, the new name follows p= and the old name follows sp=
+        """
+        head = line.rstrip( '\n' ).split( None, 5 )
+        if len( head ) < 6:
+            raise ChangelogError( reason='too few fields', origin=line )
+        parts = head[:5] + head[5].split( ' ' )
+        info = { 'recno': int( parts[0] ),
+                 'type': parts[1][2:],
+                 'time': parts[2],
+                 'date': parts[3],
+                 'flags': int( parts[4], 16 ),
+               }
+        keys = { 't': 'tfid', 'p': 'pfid', 's': 'sfid', 'sp': 'spfid',
+                 'j': 'jobid', 'u': 'uidgid' }
+        # name is everything between p=[...] and the next field (or end of
+        # line), may contain spaces; same for old name after sp=[...]
+        # a name token looking like s=... or sp=... is only a field if its
+        # value is a FID
+        name_for = None
+        for part in parts[5:]:
+            k, sep, v = part.partition( '=' )
+            if sep and k in keys and ( name_for is None or
+                    ( k in ( 's', 'sp' ) and v.startswith( '[' ) and v.endswith( ']' ) ) ):
+                info[ keys[ k ] ] = v
+                name_for = { 'p': 'name', 'sp': 'sname' }.get( k )
+                if name_for:
+                    info[ name_for ] = None
+            elif name_for is not None:
+                if info[ name_for ] is None:
+                    info[ name_for ] = part
+                else:
+                    info[ name_for ] += ' ' + part
+        return cls( **info )
+
+    def __repr__( self ):
+        return '<{0} {1} {2} t={3} p={4} {5}>'.format( self.__class__.__name__,
+            self.recno, self.type, self.tfid, self.pfid, self.name )
+
+
+class ChangeSet( object ):
+    """
+    Deduplicated summary of a sequence of changelog records
+        changed: set of FIDs whose current paths need to be synced
+        removed: set of ( parent FID, name ) that no longer exist
+        renames: list of ( old parent FID, old name, new parent FID,
+                 new name, FID ), in record order
+        last_recno: highest record number seen (for changelog_clear)
+    """
+
+    def __init__( self ):
+        self.changed = set()
+        self.removed = set()
+        self.renames = []
+        self.last_recno = None
+        self.count = 0
+
+
+    @classmethod
+    def from_records( cls, records ):
+        self = cls()
+        for rec in records:
+            self.add( rec )
+        return self
+
+
+    def add( self, rec ):
+        self.count += 1
+        self.last_recno = rec.recno
+        if rec.type in CHANGE_TYPES:
+            self.changed.add( rec.tfid )
+            if rec.pfid and rec.name is not None:
+                self.removed.discard( ( rec.pfid, rec.name ) )
+        elif rec.type in REMOVE_TYPES:
+            self.removed.add( ( rec.pfid, rec.name ) )
+            if rec.flags & CLF_UNLINK_LAST:
+                self.changed.discard( rec.tfid )
+        elif rec.type == 'RENME':
+            # old name is gone, renamed file shows up under its new name
+            self.removed.add( ( rec.spfid, rec.sname ) )
+            self.removed.discard( ( rec.pfid, rec.name ) )
+            self.changed.add( rec.sfid )
+            self.renames.append( ( rec.spfid, rec.sname, rec.pfid, rec.name, rec.sfid ) )
+            if rec.tfid and rec.tfid != NULL_FID and rec.flags & CLF_UNLINK_LAST:
+                # existing target of the rename was overwritten
+                self.changed.discard( rec.tfid )
+        # other types (OPEN, ATIME, MARK, ...) don't need a sync
+
+
+    def __repr__( self ):
+        return '<{0} records={1} changed={2} removed={3} last={4}>'.format(
+            self.__class__.__name__, self.count, len( self.changed ),
+            len( self.removed ), self.last_recno )
+
+
+class ChangelogReader( object ):
+    """
+    Read and clear changelog records for one MDT and changelog user
+    If source is given, records are read from that file instead of from
+    "lfs changelog" (stand-in for testing) and clear() removes consumed
+    records from the file.
+    """
+
+    def __init__( self, mdtname, user, startrec=0, source=None ):
+        """
+        :param mdtname str: ie: 'lustre-MDT0000'
+        :param user str: changelog user id, ie: 'cl1'
+        :param startrec int: first record number to read
+        :param source str: OPTIONAL file with "lfs changelog" output
+        """
+        self.mdtname = mdtname
+        self.user = user
+        self.startrec = startrec
+        self.source = source
+
+
+    def read( self ):
+        """
+        Return list of ChangelogRecords currently available
+        """
+        if self.source is not None:
+            with open( self.source ) as f:
+                lines = f.read().splitlines()
+        else:
+            cmd = [ pylut.env[ 'PYLUTLFSPATH' ], 'changelog' ]
+            opts = None
+            args = [ self.mdtname, self.startrec ]
+            ( output, errput ) = runcmd( cmd, opts, args )
+            if isinstance( output, bytes ):
+                output = os.fsdecode( output )
+            lines = output.splitlines()
+        records = [ ChangelogRecord.from_line( l ) for l in lines if len( l ) > 0 ]
+        return [ r for r in records if r.recno >= self.startrec ]
+
+
+    def clear( self, endrec ):
+        """
+        Tell Lustre that records up to and including endrec are consumed
+        """
+        if self.source is not None:
+            with open( self.source ) as f:
+                lines = f.read().splitlines()
+            keep = [ l for l in lines
+                     if len( l ) > 0 and ChangelogRecord.from_line( l ).recno > endrec ]
+            with open( self.source, 'w' ) as f:
+                f.writelines( l + '\n' for l in keep )
+        else:
+            cmd = [ pylut.env[ 'PYLUTLFSPATH' ], 'changelog_clear' ]
+            opts = None
+            args = [ self.mdtname, self.user, endrec ]
+            runcmd( cmd, opts, args )
+        self.startrec = endrec + 1
+
+
+def incremental_sync( reader, src_root, tgt_root, tmpbase, fid2path=None,
+                      clear=True, **syncopts ):
+    """
+    Sync only what changed under src_root since the last run, as reported by
+    the Lustre changelog
+    Renames are first repeated on tgt_root, so a renamed directory keeps its
+    contents (its children have no changelog records of their own).  A
+    renamed directory whose old name can't be found under tgt_root is synced
+    recursively instead.  Then removed names are deleted from tgt_root, and
+    the current paths of all changed FIDs are synced (files with
+    pylut.syncfile, directories with pylut.syncdir).  FIDs from the changelog
+    are set on the source FSItems, so they are not looked up again.
+    Consumed records are cleared afterwards, unless there were errors or
+    clear=False.
+    :param reader ChangelogReader:
+    :param src_root str: top of the source tree (on Lustre)
+    :param tgt_root str: top of the target tree
+    :param tmpbase str: passed to pylut.syncfile
+    :param fid2path func: OPTIONAL callable( mountpoint, fids ) returning a
+                          dict of fid -> list of paths
+                          (default is pylut.fid2path_bulk)
+    :param syncopts: passed to pylut.syncfile and pylut.syncdir
+    :return dict: counts of 'records', 'renamed', 'synced', 'deleted',
+                  'skipped' and a list of 'errors'
+    """
+    if fid2path is None:
+        fid2path = pylut.fid2path_bulk
+    src_root = os.path.abspath( src_root )
+    tgt_root = os.path.abspath( tgt_root )
+    mountpoint = fsitem.getmountpoint( src_root )
+    records = reader.read()
+    changes = ChangeSet.from_records( records )
+    log.debug( 'changelog: {0}'.format( changes ) )
+    rv = { 'records': changes.count, 'renamed': 0, 'synced': 0, 'deleted': 0,
+           'skipped': 0, 'errors': [] }
+    if changes.count < 1:
+        return rv
+    # Resolve all FIDs in one batch
+    parent_fids = set( p for p, n in changes.removed )
+    for spfid, sname, pfid, name, fid in changes.renames:
+        parent_fids.update( ( spfid, pfid ) )
+    paths = fid2path( mountpoint, changes.changed | parent_fids )
+    # Renames
+    recursive = set( _rename_all( changes.renames, paths, src_root, tgt_root, rv ) )
+    # Deletions
+    for pfid, name in changes.removed:
+        for parent in paths.get( pfid, [] ):
+            src = os.path.join( parent, name )
+            tgt = _src2tgt( src, src_root, tgt_root )
+            if tgt is None or os.path.lexists( src ):
+                continue
+            try:
+                rv[ 'deleted' ] += _remove( tgt )
+            except ( OSError, pylut.PylutError ) as e:
+                rv[ 'errors' ].append( e )
+    # Syncs, parents before children
+    todo = []
+    for fid in changes.changed:
+        for src in paths.get( fid, [] ):
+            tgt = _src2tgt( src, src_root, tgt_root )
+            if tgt is None:
+                rv[ 'skipped' ] += 1
+                continue
+            todo.append( ( src, tgt, fid ) )
+    todo.sort( key=lambda x: ( x[0].count( os.sep ), x[0] ) )
+    for src, tgt, fid in todo:
+        try:
+            if fid in recursive:
+                rv[ 'synced' ] += _sync_tree( src, tgt, fid, tmpbase, syncopts )
+                continue
+            _sync_one( src, tgt, fid, tmpbase, syncopts )
+            rv[ 'synced' ] += 1
+        except ( OSError, pylut.PylutError, Run_Cmd_Error ) as e:
+            rv[ 'errors' ].append( e )
+    if clear and not rv[ 'errors' ]:
+        reader.clear( changes.last_recno )
+    return rv
+
+
+def _rename_all( renames, paths, src_root, tgt_root, rv ):
+    """ Repeat renames on the target, in record order
+    A rename whose old name doesn't exist on the target yet (ie: its parent
+    is renamed by a later record) is retried after the others.
+    :return list: FIDs of the renames that could not be done on the target
+    """
+    failed = []
+    todo = list( renames )
+    while todo:
+        again = []
+        for r in todo:
+            spfid, sname, pfid, name, fid = r
+            new_tgt = _parent2tgt( paths, pfid, name, src_root, tgt_root )
+            if new_tgt is None:
+                # moved out of src_root, handled by the removal
+                continue
+            old_tgt = _parent2tgt( paths, spfid, sname, src_root, tgt_root )
+            if old_tgt is None:
+                # moved in from outside of src_root
+                failed.append( fid )
+                continue
+            if not os.path.lexists( old_tgt ) or \
+               not os.path.isdir( os.path.dirname( new_tgt ) ):
+                again.append( r )
+                continue
+            log.debug( 'rename {0} -> {1}'.format( old_tgt, new_tgt ) )
+            try:
+                os.rename( old_tgt, new_tgt )
+            except ( OSError ) as e:
+                log.debug( 'rename failed, will sync instead: {0}'.format( e ) )
+                again.append( r )
+                continue
+            rv[ 'renamed' ] += 1
+        if len( again ) == len( todo ):
+            failed.extend( r[4] for r in again )
+            break
+        todo = again
+    return failed
+
+
+def _parent2tgt( paths, pfid, name, src_root, tgt_root ):
+    """ Target path of name in the directory pfid, None if not under src_root
+    """
+    parents = paths.get( pfid, [] )
+    if len( parents ) < 1 or name is None:
+        return None
+    return _src2tgt( os.path.join( parents[0], name ), src_root, tgt_root )
+
+
+def _sync_tree( src, tgt, fid, tmpbase, syncopts ):
+    """ Sync src and, if it is a directory, everything below it
+    :return int: number of items synced
+    """
+    _sync_one( src, tgt, fid, tmpbase, syncopts )
+    if not os.path.isdir( src ) or os.path.islink( src ):
+        return 1
+    items = [ i for i in treewalk.walk( src ) if i.absname != src ]
+    items.sort( key=lambda i: ( i.absname.count( os.sep ), i.absname ) )
+    for item in items:
+        _sync_one( item.absname, tgt + item.absname[ len( src ): ], None,
+                   tmpbase, syncopts )
+    return 1 + len( items )
+
+
+def _sync_one( src, tgt, fid, tmpbase, syncopts ):
+    src_item = fsitem.FSItem( src )
+    if fid is not None:
+        src_item.set_inode( fid )
+    if not src_item.exists():
+        # changed, then removed again later (handled by the removal)
+        return
+    parent = os.path.dirname( tgt )
+    if not os.path.isdir( parent ):
+        os.makedirs( parent )
+    if src_item.is_dir():
+        if not os.path.isdir( tgt ):
+            os.mkdir( tgt )
+        diropts = dict( ( k, syncopts[ k ] ) for k in
+            ( 'syncowner', 'syncgroup', 'syncperms', 'synctimes' ) if k in syncopts )
+        pylut.syncdir( src_item, fsitem.FSItem( tgt ), **diropts )
+    else:
+        pylut.syncfile( src_item, fsitem.FSItem( tgt ), tmpbase=tmpbase, **syncopts )
+
+
+def _remove( path ):
+    """ Remove path (file or whole directory tree), return number removed
+    """
+    try:
+        if os.path.isdir( path ) and not os.path.islink( path ):
+            return pylut.rmdir( path )
+        os.unlink( path )
+    except ( OSError ) as e:
+        if e.errno == errno.ENOENT:
+            return 0
+        raise e
+    return 1
+
+
+def _src2tgt( src, src_root, tgt_root ):
+    """ Map src path to the same path under tgt_root, None if not under src_root
+    """
+    if src == src_root:
+        return tgt_root
+    if not src.startswith( src_root + os.sep ):
+        return None
+    return tgt_root + src[ len( src_root ): ]
+
+
+class ChangelogError( pylut.PylutError ): pass
+
+
+if __name__ == '__main__':
+    raise UserWarning( 'Cmdline not supported' )
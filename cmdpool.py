@@ -0,0 +1,176 @@
+import os
+import sys
+import signal
+import struct
+import pickle
+import logging
+import threading
+import subprocess
+import queue
+from runcmd import Run_Cmd_Error, Run_Cmd_Timeout
+
+log = logging.getLogger( __name__ )
+
+# message framing on the pipes: 4 byte length + pickle
+_header = struct.Struct( '!I' )
+
+
+class CmdPool( object ):
+    """
+    Pool of long-lived helper processes that run commands on request
+    The helpers are small python processes started once, commands are sent
+    to them over pipes, so the (possibly huge) calling process never forks
+    on the hot path.  Each helper starts commands with close_fds (vfork /
+    posix_spawn where the platform allows).
+    Thread safe: each call borrows an idle helper, so up to size commands
+    run at once.
+    Use runcmd.set_pool( pool ) to route every runcmd() call through a pool.
+    This is opt-in: where CPython spawns with vfork, plain runcmd is faster
+    (see test/cmdpoolbench), so nothing sets a pool by default.
+    """
+
+    def __init__( self, size=4 ):
+        """
+        :param size int: number of helper processes
+        """
+        self.size = size
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._workers = []
+        for i in range( size ):
+            self._idle.put( self._start() )
+
+
+    def _start( self ):
+        w = subprocess.Popen( [ sys.executable, os.path.abspath( __file__ ) ],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                              close_fds=True )
+        with self._lock:
+            self._workers.append( w )
+        log.debug( 'started pool worker {0}'.format( w.pid ) )
+        return w
+
+
+    def _replace( self, w ):
+        """ Kill helper w, put a new helper in the idle queue
+        """
+        with self._lock:
+            self._workers.remove( w )
+        try:
+            w.kill()
+        except ( OSError ):
+            pass
+        w.wait()
+        try:
+            new = self._start()
+        except ( OSError ) as e:
+            # one helper less, don't let close() wait for it
+            log.warning( 'unable to restart pool worker: {0}'.format( e ) )
+            with self._lock:
+                self.size -= 1
+            return
+        self._idle.put( new )
+
+
+    def run( self, cmdlist, timeout=None ):
+        """
+        Run cmdlist in a helper process, same result as runcmd.runcmd
+        :param cmdlist list: full command, all elements str
+        :param timeout float: OPTIONAL seconds, see runcmd.runcmd
+        :return tuple: ( stdout, stderr )
+        """
+        w = self._idle.get()
+        done = False
+        try:
+            _send( w.stdin, ( cmdlist, timeout ) )
+            ( rc, output, errput ) = _recv( w.stdout )
+            done = True
+        except ( EOFError, OSError, pickle.UnpicklingError ) as e:
+            raise Run_Cmd_Error( code=None, reason='pool worker failed: {0}'.format( e ),
+                                 cmd=' '.join( cmdlist ) )
+        finally:
+            if done:
+                self._idle.put( w )
+            else:
+                # helper died, or was interrupted (ie: KeyboardInterrupt)
+                # mid-protocol, don't hand it out again
+                self._replace( w )
+        if rc is None:
+            raise Run_Cmd_Timeout( code=rc, reason='timeout after {0}s'.format( timeout ),
+                                   cmd=' '.join( cmdlist ) )
+        if rc != 0:
+            raise Run_Cmd_Error( code=rc, reason=errput, cmd=' '.join( cmdlist ),
+                                 output=output )
+        return ( output, errput )
+
+
+    def close( self ):
+        """
+        Stop all helper processes (waits for running commands)
+        """
+        for i in range( self.size ):
+            w = self._idle.get()
+            w.stdin.close()
+            w.wait()
+            w.stdout.close()
+        with self._lock:
+            self._workers = []
+
+
+    def __enter__( self ):
+        return self
+
+
+    def __exit__( self, *exc ):
+        self.close()
+
+
+def _send( f, obj ):
+    data = pickle.dumps( obj, protocol=2 )
+    f.write( _header.pack( len( data ) ) + data )
+    f.flush()
+
+
+def _recv( f ):
+    head = f.read( _header.size )
+    if len( head ) < _header.size:
+        raise EOFError( 'pipe closed' )
+    ( size, ) = _header.unpack( head )
+    data = f.read( size )
+    if len( data ) < size:
+        raise EOFError( 'pipe closed' )
+    return pickle.loads( data )
+
+
+def _worker( fin, fout ):
+    """
+    Helper process main loop: read ( cmdlist, timeout ), run it, reply with
+    ( returncode, stdout, stderr ); returncode is None on timeout
+    """
+    while True:
+        try:
+            ( cmdlist, timeout ) = _recv( fin )
+        except ( EOFError ):
+            return
+        try:
+            p = subprocess.Popen( cmdlist, stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE, close_fds=True,
+                                  start_new_session=timeout is not None )
+        except ( OSError ) as e:
+            _send( fout, ( 127, b'', str( e ).encode() ) )
+            continue
+        try:
+            ( output, errput ) = p.communicate( timeout=timeout )
+            rc = p.returncode
+        except ( subprocess.TimeoutExpired ):
+            try:
+                os.killpg( p.pid, signal.SIGKILL )
+            except ( OSError ):
+                pass
+            ( output, errput ) = p.communicate()
+            rc = None
+        _send( fout, ( rc, output, errput ) )
+
+
+if __name__ == '__main__':
+    _worker( sys.stdin.buffer, sys.stdout.buffer )
@@ -1,7 +1,13 @@
 import os
 import pylut
+import backend
+import throttle
 import stat
 import hashlib
+import operator
+import concurrent.futures
+import mountinfo
+import statx
 
 class FSItem( object ):
     """
@@ -9,19 +15,29 @@ class FSItem( object ):
     mountpoint, stat info (from os.lstat), stripe info, etc.
     """
 
+    # Millions of these are held in memory during a scan, so no __dict__
+    __slots__ = ( 'name', 'absname', 'mountpoint', 'parent',
+                  '_inode', '_statinfo', '_checksum', '_stripeinfo',
+                  '_direntry', '_faststat', '_byfid' )
+
     # stat info key names
     statinfo_keys = ( 'mode', 'ino', 'dev', 'nlink', 'uid',
                       'gid', 'size', 'atime', 'mtime', 'ctime' )
 
+    # stripe info key names (same as pylut.LustreStripeInfo.attrnames)
+    stripeinfo_keys = ( 'count', 'size', 'offset', 'pattern', 'gen', 'index_info' )
+
     # md5 checksum blocksize (assume bigger is better, faster)
     md5_blocksize = 512 * 1024 * 1024
 
-    def __init__( self, path, absname=None,  mountpoint=None ):
+    def __init__( self, path, absname=None,  mountpoint=None, faststat=False, byfid=False ):
         """
         Can instantiate with either a full path only OR pass in all three arguments.
         :param path str: either a full path or just a name
         :param absname str: OPTIONAL the absolute path to the file, if not provided, an attempt will be made to look it up
         :param mountpoint str: OPTIONAL path to the mountpoint, if not provided, an attempt will be made to look it up
+        :param faststat bool: OPTIONAL if True, stat() asks only for fields the MDS can answer, see stat()
+        :param byfid bool: OPTIONAL if True, stat and data are accessed by FID, see datapath()
         """
         self.name = os.path.basename( path )
         self.absname = absname
@@ -29,6 +45,10 @@ class FSItem( object ):
         self._inode      = None     #filesystem specific (Lustre==FID)
         self._statinfo   = None     #os.lstat
         self._checksum   = None     #hashlib.md5().hexdigest
+        self._stripeinfo = None     #pylut.LustreStripeInfo
+        self._direntry   = None     #os.DirEntry, see from_direntry
+        self._faststat   = faststat
+        self._byfid      = byfid
         if self.absname is None:
             self.absname = os.path.abspath( path )
         if self.mountpoint is None:
@@ -40,6 +60,34 @@ class FSItem( object ):
             self.parent = ''
 
 
+    @classmethod
+    def from_direntry( cls, entry, parent, fid=None, faststat=False, byfid=False ):
+        """
+        Create an FSItem from an os.DirEntry without any system calls
+        Absolute path and mountpoint come from the parent FSItem, file type
+        comes from the directory entry (d_type) and stat information is taken
+        from the DirEntry (cached there if it was already requested).
+        :param entry os.DirEntry: entry from os.scandir( parent.absname )
+        :param parent FSItem: the directory that was scanned
+        :param fid str: OPTIONAL filesystem specific identifier, if already known
+        :param faststat bool: OPTIONAL see FSItem.stat()
+        :param byfid bool: OPTIONAL see FSItem.datapath()
+        """
+        self = cls.__new__( cls )
+        self.name = entry.name
+        self.absname = os.path.join( parent.absname, entry.name )
+        self.mountpoint = parent.mountpoint
+        self.parent = parent.absname
+        self._inode = fid
+        self._statinfo = None
+        self._checksum = None
+        self._stripeinfo = None
+        self._direntry = entry
+        self._faststat = faststat
+        self._byfid = byfid
+        return self
+
+
     def __repr__( self ):
         return '<{0} {1} {2}>'.format( self.__class__.__name__, self._inode, self.absname )
 
@@ -52,42 +100,122 @@ class FSItem( object ):
         """
         Attempt to get a filesystem specific version of file identifier
         (for example: Lustre FID)
-        For normal inode, just use self.ino, which is part of stat and should be faster anyway
+        The lookup is done by the backend for this path, see backend.for_path;
+        on non-Lustre filesystems it is built from st_dev and st_ino, without
+        running lfs
         """
-        #TODO-call inode() method of appropriate module for type of filesystem
         if self._inode is None:
-            self._inode = pylut.inode( self.absname )
+            throttle.ops()
+            self._inode = backend.for_path( self.absname ).path2fid( self.absname )
         return self._inode
 
 
+    def datapath( self ):
+        """
+        Return the path used to stat and read the file
+        If byfid was requested and the FID is known, this is
+        <mountpoint>/.lustre/fid/<fid> (one MDS lookup instead of one per path
+        component), otherwise it is absname.
+        """
+        if self._byfid and self._inode is not None:
+            path = backend.for_path( self.absname ).fidpath( self.mountpoint, self._inode )
+            if path is not None:
+                return path
+        return self.absname
+
+
     def stat( self ):
         """
         Return file stat information, getting it if needed
+        If faststat was requested, only fields the Lustre MDS can answer
+        (mode, ino, nlink, uid, gid, ctime) are fetched, using statx; size,
+        atime and mtime are then None in the returned value and the
+        corresponding attributes (ie: self.size) fetch them on first use.
         """
-        #TODO - Lustre has a special (fast) stat call that doesn't touch OSS's.
-        #       Use this one unless size is specifically requested.
-        # Store statinfo as a local dict
+        # Keep the os.stat_result as-is, attributes are read via properties
         if self._statinfo is None:
-            st = os.lstat( self.absname )
-            self._statinfo = {}
-            for x in self.statinfo_keys:
-                k = 'st_{0}'.format( x )
-                self._statinfo[ x ] = getattr( st, k )
+            if self._faststat:
+                self._statinfo = statx.faststat( self.datapath() )
+                self._direntry = None
+            elif self._direntry is not None:
+                self._statinfo = self._direntry.stat( follow_symlinks=False )
+                self._direntry = None
+            else:
+                self._statinfo = os.lstat( self.datapath() )
         return self._statinfo
 
 
-    #TODO-stripeinfo is Lustre-specific, probably could monkeypatch it in from pylut
+    def fullstat( self ):
+        """
+        Return complete file stat information, including the fields (size,
+        atime, mtime) skipped by a fast stat
+        On Lustre, this glimpses every OST object of the file.
+        """
+        st = self._statinfo
+        if st is None or st.st_size is None:
+            self._statinfo = os.lstat( self.datapath() )
+            self._direntry = None
+        return self._statinfo
+
+
+    def lazysize( self ):
+        """
+        Return file size, accepting the (possibly stale) Lustre lazy
+        size-on-MDT if the accurate size is not already known
+        Falls back to the accurate size if lazy size is not available.
+        """
+        size = self.stat().st_size
+        if size is None:
+            try:
+                throttle.ops()
+                size = backend.for_path( self.absname ).getsom( self.datapath() )
+            except ( pylut.Run_Cmd_Error ):
+                size = self.size
+        return size
+
+
+    def set_stat( self, st ):
+        """
+        Set stat information from an existing os.stat_result
+        (for example, from os.DirEntry.stat), avoiding another lstat
+        """
+        self._statinfo = st
+
+
+    def set_inode( self, fid ):
+        """
+        Set the filesystem specific identifier (ie: Lustre FID) if it is
+        already known, avoiding a lookup
+        """
+        self._inode = fid
+
+
+    def set_byfid( self, byfid=True ):
+        """
+        Switch stat and data access to go by FID (or back to by path),
+        see datapath()
+        """
+        self._byfid = byfid
+
+
+    def set_stripeinfo( self, sinfo ):
+        """
+        Set stripe information if it is already known, avoiding a lookup
+        """
+        self._stripeinfo = sinfo
+
+
     def stripeinfo( self ):
         """
         Return stripe information, getting it if needed
         Lustre stripe is valid only for dirs and regular files
         None will be returned for non-regular files
         """
-        try:
-            rv = self._stripeinfo
-        except AttributeError:
+        if self._stripeinfo is None:
             if self.is_regular() or self.is_dir():
-                self._stripeinfo = pylut.getstripeinfo( self.absname )
+                throttle.ops()
+                self._stripeinfo = backend.for_path( self.absname ).getstripeinfo(
+                    self.datapath() )
             else:
                 self._stripeinfo = pylut.LustreStripeInfo()
         return self._stripeinfo
@@ -97,13 +225,20 @@ class FSItem( object ):
         """
         Return checksum of regular file, calculating it first if needed
         Return string of zeros for dirs and non-regular files
+        Reads draw from throttle.limiter if it has limits
         """
         if self._checksum is None:
             if self.exists():
                 if self.is_regular():
                     cksum = hashlib.md5()
-                    with open( self.absname, 'rb' ) as f:
-                        for chunk in iter( lambda: f.read( self.md5_blocksize ), b'' ):
+                    with open( self.datapath(), 'rb' ) as f:
+                        if throttle.limiter.active:
+                            sinfo = self.stripeinfo() if throttle.limiter.per_ost else None
+                            chunks = throttle.chunks(
+                                f, sinfo, size=os.fstat( f.fileno() ).st_size )
+                        else:
+                            chunks = iter( lambda: f.read( self.md5_blocksize ), b'' )
+                        for chunk in chunks:
                             cksum.update( chunk )
                     self._checksum = cksum.hexdigest()
                 else:
@@ -125,6 +260,8 @@ class FSItem( object ):
     def is_dir( self ):
         """ Returns True if entry is a directory, False otherwise
         """
+        if self._direntry is not None:
+            return self._direntry.is_dir( follow_symlinks=False )
         return stat.S_ISDIR( self.mode )
 
 
@@ -148,12 +285,16 @@ class FSItem( object ):
     def is_symlink( self ):
         """ Return True if entry is a symbolic link
         """
+        if self._direntry is not None:
+            return self._direntry.is_symlink()
         return stat.S_ISLNK( self.mode )
 
 
     def is_regular( self ):
         """ Return True if entry is a regular file; False otherwise
         """
+        if self._direntry is not None:
+            return self._direntry.is_file( follow_symlinks=False )
         return stat.S_ISREG( self.mode )
 
 
@@ -179,26 +320,82 @@ class FSItem( object ):
         self._statinfo = None
         self._inode = None
         self._checksum = None
-        #TODO-stripeinfo is Lustre-specific, probably could monkeypatch it in from pylut
-        try:
-            del self._stripeinfo
-        except ( AttributeError ):
-            pass
+        self._stripeinfo = None
+        self._direntry = None
+
 
+def _stat_property( name ):
+    """ Property for easy stat information lookup, ie: item.size
+    """
+    getter = operator.attrgetter( 'st_{0}'.format( name ) )
+    def fget( self ):
+        st = self._statinfo
+        if st is None:
+            st = self.stat()
+        val = getter( st )
+        if val is None:
+            # field was skipped by a fast stat
+            val = getter( self.fullstat() )
+        return val
+    fget.__name__ = name
+    fget.__doc__ = 'st_{0} from os.lstat'.format( name )
+    return property( fget )
+
+
+def _stripe_property( name ):
+    """ Property for easy stripeinfo lookup, ie: item.stripecount
+    """
+    getter = operator.attrgetter( name )
+    def fget( self ):
+        return getter( self.stripeinfo() )
+    fget.__name__ = 'stripe{0}'.format( name )
+    fget.__doc__ = '{0} from LustreStripeInfo'.format( name )
+    return property( fget )
 
-    def __getattr__( self, name ):
-        # allow easy stat information lookup
-        if name in self.statinfo_keys:
-            return self.stat()[ name ]
-        # allow easy stripeinfo lookup
-        #TODO-stripeinfo is Lustre-specific, probably could monkeypatch it in from pylut
-        if name.startswith( 'stripe' ):
-            return getattr( self.stripeinfo(), name[6:] )
-        raise AttributeError('{0} not found in {1}'.format( 
-            name, self.__class__.__name__) )
 
+for _k in FSItem.statinfo_keys:
+    setattr( FSItem, _k, _stat_property( _k ) )
+for _k in FSItem.stripeinfo_keys:
+    setattr( FSItem, 'stripe{0}'.format( _k ), _stripe_property( _k ) )
+del _k
 
-def getmountpoint( path ):        
+
+def prefetch_stat( items, workers=16 ):
+    """
+    Fill the stat cache of many FSItems concurrently (user-space statahead)
+    Hides MDS round trip latency by issuing the stats from a thread pool;
+    items that already have stat information are skipped.  Errors (ie: the
+    file doesn't exist) are ignored here, they will surface again when the
+    item is used.
+    :param items   list: FSItem instances
+    :param workers  int: max number of stats in flight (default=16)
+    :return int: number of items that were stat'd successfully
+    """
+    todo = [ i for i in items if i._statinfo is None ]
+    if len( todo ) < 1:
+        return 0
+    workers = min( workers, len( todo ) )
+    with concurrent.futures.ThreadPoolExecutor( workers ) as pool:
+        return sum( pool.map( _prefetch_one, todo ) )
+
+
+def _prefetch_one( item ):
+    try:
+        item.stat()
+    except ( OSError ):
+        return 0
+    return 1
+
+
+def getmountpoint( path ):
+    """
+    Return the mountpoint of the filesystem holding path
+    Uses the (cached) mount table from /proc/self/mountinfo if available,
+    otherwise walks up the path checking os.path.ismount at each level
+    """
+    table = mountinfo.mounttable()
+    if table is not None:
+        return table.getmountpoint( path )
     path = os.path.realpath( os.path.abspath( path ) )
     while path != os.path.sep:
         if os.path.ismount( path ):
@@ -0,0 +1,224 @@
+import time
+import bisect
+import logging
+import threading
+
+log = logging.getLogger( __name__ )
+
+# Latency histogram bucket upper bounds (seconds), last one catches the rest
+LATENCY_BUCKETS = ( 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                    0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, float( 'inf' ) )
+
+# Recording is opt-in, see enable()
+enabled = False
+
+
+class Histogram( object ):
+    """
+    Count of observations per bucket, plus total count and sum
+    """
+
+    def __init__( self, buckets=LATENCY_BUCKETS ):
+        self.bounds = buckets
+        self.counts = [ 0 ] * len( buckets )
+        self.count = 0
+        self.sum = 0.0
+
+
+    def observe( self, value ):
+        self.counts[ bisect.bisect_left( self.bounds, value ) ] += 1
+        self.count += 1
+        self.sum += value
+
+
+    def as_dict( self ):
+        """
+        Return dict with count, sum and buckets, buckets is a list of
+        ( upper bound, cumulative count ), same as Prometheus
+        """
+        cumulative = []
+        total = 0
+        for le, n in zip( self.bounds, self.counts ):
+            total += n
+            cumulative.append( ( le, total ) )
+        return { 'count': self.count, 'sum': self.sum, 'buckets': cumulative }
+
+
+class Registry( object ):
+    """
+    Named counters, gauges and latency histograms, thread safe
+    """
+
+    def __init__( self ):
+        self._lock = threading.Lock()
+        self.reset()
+
+
+    def reset( self ):
+        """ Drop all recorded values
+        """
+        with self._lock:
+            self._counters = {}
+            self._gauges = {}
+            self._histograms = {}
+
+
+    def incr( self, name, value=1, labels=None ):
+        if labels:
+            name = labelname( name, labels )
+        with self._lock:
+            self._counters[ name ] = self._counters.get( name, 0 ) + value
+
+
+    def gauge( self, name, value, labels=None ):
+        """ Set gauge name to value (a current level, not a running total)
+        """
+        if labels:
+            name = labelname( name, labels )
+        with self._lock:
+            self._gauges[ name ] = value
+
+
+    def observe( self, name, seconds ):
+        with self._lock:
+            try:
+                h = self._histograms[ name ]
+            except ( KeyError ):
+                h = self._histograms[ name ] = Histogram()
+            h.observe( seconds )
+
+
+    def snapshot( self ):
+        """
+        Return a copy of all values:
+        { 'counters': { name: value },
+          'gauges': { name: value },
+          'histograms': { name: Histogram.as_dict() } }
+        """
+        with self._lock:
+            return { 'counters': dict( self._counters ),
+                     'gauges': dict( self._gauges ),
+                     'histograms': dict( ( k, h.as_dict() )
+                                         for k, h in self._histograms.items() ) }
+
+
+class _Timer( object ):
+    """
+    Context manager that records the elapsed time of its block in histogram
+    name, and counts name.calls, name.errors and (if given) name.bytes
+    """
+    __slots__ = ( 'registry', 'name', 'nbytes', 'start' )
+
+    def __init__( self, registry, name, nbytes ):
+        self.registry = registry
+        self.name = name
+        self.nbytes = nbytes
+
+    def __enter__( self ):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__( self, exc_type, exc, tb ):
+        r = self.registry
+        r.observe( self.name, time.monotonic() - self.start )
+        r.incr( self.name + '.calls' )
+        if exc_type is not None and exc_type is not GeneratorExit:
+            # GeneratorExit: streamed output closed early by the caller
+            r.incr( self.name + '.errors' )
+        elif self.nbytes:
+            r.incr( self.name + '.bytes', self.nbytes )
+        return False
+
+
+class _NullTimer( object ):
+    """ Does nothing, used while recording is disabled
+    """
+    __slots__ = ()
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc, tb ):
+        return False
+
+_nulltimer = _NullTimer()
+
+
+# The process wide registry
+registry = Registry()
+
+
+def enable():
+    """ Start recording into registry
+    """
+    global enabled
+    enabled = True
+
+
+def disable():
+    """ Stop recording (recorded values are kept until reset)
+    """
+    global enabled
+    enabled = False
+
+
+def timer( name, nbytes=None ):
+    """
+    Return context manager that times its block as name, ie:
+        with metrics.timer( 'syncfile.copy', nbytes=size ):
+            ...
+    Costs one function call while recording is disabled.
+    """
+    if not enabled:
+        return _nulltimer
+    return _Timer( registry, name, nbytes )
+
+
+def incr( name, value=1, labels=None ):
+    """ Add value to counter name (if recording is enabled)
+        labels: OPTIONAL dict, recorded as part of the name, see labelname
+    """
+    if enabled:
+        registry.incr( name, value, labels )
+
+
+def gauge( name, value, labels=None ):
+    """ Set gauge name to value (if recording is enabled)
+    """
+    if enabled:
+        registry.gauge( name, value, labels )
+
+
+def observe( name, seconds ):
+    """ Add an observation to latency histogram name (if recording is enabled)
+    """
+    if enabled:
+        registry.observe( name, seconds )
+
+
+def labelname( name, labels ):
+    """
+    Return name with labels appended Prometheus style, ie:
+    syncfile.errors{reason="Checksum mismatch"}
+    """
+    return '{0}{{{1}}}'.format( name, ','.join(
+        '{0}="{1}"'.format( k, str( v ).replace( '\\', '\\\\' )
+                                       .replace( '"', '\\"' )
+                                       .replace( '\n', '\\n' ) )
+        for k, v in sorted( labels.items() ) ) )
+
+
+def snapshot():
+    """ See Registry.snapshot
+    """
+    return registry.snapshot()
+
+
+def reset():
+    """ See Registry.reset
+    """
+    registry.reset()
+
+
+if __name__ == '__main__':
+    raise UserWarning( 'Cmdline not supported' )
@@ -0,0 +1,257 @@
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+import metrics
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+log = logging.getLogger( __name__ )
+
+
+def prometheus_text( snapshot, prefix='pylut', extra=None ):
+    """
+    Format a metrics snapshot in the Prometheus text exposition format
+    Counters become <prefix>_<name>_total, gauges <prefix>_<name>, latency
+    histograms become <prefix>_<name>_seconds (buckets, sum and count); dots
+    in names are replaced with underscores, labels are kept.
+    :param snapshot dict: from metrics.snapshot()
+    :param extra dict: OPTIONAL name -> value, exported as gauges
+    :return str:
+    """
+    lines = []
+    typed = set()
+    def _family( name, kind ):
+        if name not in typed:
+            typed.add( name )
+            lines.append( '# TYPE {0} {1}'.format( name, kind ) )
+    for key in sorted( snapshot[ 'counters' ] ):
+        name, labels = _split( key )
+        pname = _promname( prefix, name ) + '_total'
+        _family( pname, 'counter' )
+        lines.append( '{0}{1} {2}'.format( pname, labels, _num( snapshot[ 'counters' ][ key ] ) ) )
+    for key in sorted( snapshot[ 'histograms' ] ):
+        name, labels = _split( key )
+        h = snapshot[ 'histograms' ][ key ]
+        pname = _promname( prefix, name ) + '_seconds'
+        _family( pname, 'histogram' )
+        for le, n in h[ 'buckets' ]:
+            lines.append( '{0}_bucket{1} {2}'.format(
+                pname, _addlabel( labels, 'le', _num( le ) ), n ) )
+        lines.append( '{0}_sum{1} {2}'.format( pname, labels, _num( h[ 'sum' ] ) ) )
+        lines.append( '{0}_count{1} {2}'.format( pname, labels, h[ 'count' ] ) )
+    gauges = dict( snapshot.get( 'gauges', {} ) )
+    gauges.update( extra or {} )
+    for key in sorted( gauges ):
+        name, labels = _split( key )
+        pname = _promname( prefix, name )
+        _family( pname, 'gauge' )
+        lines.append( '{0}{1} {2}'.format( pname, labels, _num( gauges[ key ] ) ) )
+    return ''.join( l + '\n' for l in lines )
+
+
+def derived( snapshot, prev=None, elapsed=None ):
+    """
+    Values computed from counters:
+      <counter>.rate       per second change since prev (if prev and elapsed)
+      <cache>.hit_ratio    hits / ( hits + misses ) for <cache>.hits counters
+    :return dict: name -> float
+    """
+    counters = snapshot[ 'counters' ]
+    rv = {}
+    if prev is not None and elapsed:
+        old = prev[ 'counters' ]
+        for key, v in counters.items():
+            name, labels = _split( key )
+            rv[ name + '.rate' + labels ] = ( v - old.get( key, 0 ) ) / float( elapsed )
+    for key, hits in counters.items():
+        if key.endswith( '.hits' ):
+            cache = key[ :-len( '.hits' ) ]
+            total = hits + counters.get( cache + '.misses', 0 )
+            if total > 0:
+                rv[ cache + '.hit_ratio' ] = hits / float( total )
+    return rv
+
+
+def write_textfile( path, text ):
+    """
+    Write text to path atomically (tmp file in the same directory, then
+    rename) so a reader such as the node-exporter textfile collector never
+    sees a partial file
+    """
+    dirname = os.path.dirname( os.path.abspath( path ) )
+    fd, tmp = tempfile.mkstemp( dir=dirname, prefix='.', suffix='.tmp' )
+    try:
+        with os.fdopen( fd, 'w' ) as f:
+            f.write( text )
+        os.chmod( tmp, 0o644 )
+        os.rename( tmp, path )
+    except BaseException:
+        os.unlink( tmp )
+        raise
+
+
+class Exporter( object ):
+    """
+    Periodically export the metrics registry
+        textfile: Prometheus text format file, rewritten atomically each time
+                  (for the node-exporter textfile collector, name it *.prom)
+        jsonlog:  one JSON record per export appended, with counters, gauges, derived
+                  rates and hit ratios, and histogram counts and sums
+        http_port: serve the Prometheus text at http://<http_host>:<port>/metrics
+    Start with start() (or use as a context manager), a final export is done
+    by stop().  Recording must be switched on separately, metrics.enable().
+    """
+
+    def __init__( self, textfile=None, jsonlog=None, interval=60, http_port=None,
+                  http_host='127.0.0.1', registry=None, prefix='pylut' ):
+        self.textfile = textfile
+        self.jsonlog = jsonlog
+        self.interval = interval
+        self.http_port = http_port
+        self.http_host = http_host
+        self.registry = registry if registry is not None else metrics.registry
+        self.prefix = prefix
+        self._prev = None
+        self._prevtime = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._httpd = None
+
+
+    def export( self ):
+        """
+        Take a snapshot and write it to all configured outputs
+        :return str: the Prometheus text
+        """
+        with self._lock:
+            now = time.time()
+            snap = self.registry.snapshot()
+            elapsed = None
+            if self._prevtime is not None:
+                elapsed = now - self._prevtime
+            extra = derived( snap, self._prev, elapsed )
+            text = prometheus_text( snap, prefix=self.prefix, extra=extra )
+            if self.textfile is not None:
+                write_textfile( self.textfile, text )
+            if self.jsonlog is not None:
+                record = { 'time': now,
+                           'counters': snap[ 'counters' ],
+                           'gauges': snap[ 'gauges' ],
+                           'derived': extra,
+                           'histograms': dict(
+                               ( k, { 'count': h[ 'count' ], 'sum': h[ 'sum' ] } )
+                               for k, h in snap[ 'histograms' ].items() ),
+                         }
+                with open( self.jsonlog, 'a' ) as f:
+                    f.write( json.dumps( record, sort_keys=True ) + '\n' )
+            self._prev = snap
+            self._prevtime = now
+        return text
+
+
+    def render( self ):
+        """
+        Return the Prometheus text for the current values, without writing
+        any output (used for http requests)
+        """
+        snap = self.registry.snapshot()
+        return prometheus_text( snap, prefix=self.prefix, extra=derived( snap ) )
+
+
+    def start( self ):
+        if self.http_port is not None:
+            self._start_http()
+        self._thread = threading.Thread( target=self._run, name='metricsexport' )
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+
+    def stop( self ):
+        """ Stop exporting, after one last export
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+
+    def _run( self ):
+        while True:
+            stopping = self._stop.wait( self.interval )
+            try:
+                self.export()
+            except ( OSError, IOError ) as e:
+                log.warning( 'metrics export failed: {0}'.format( e ) )
+            if stopping:
+                return
+
+
+    def _start_http( self ):
+        exporter = self
+        class _Handler( BaseHTTPRequestHandler ):
+            def do_GET( self ):
+                if self.path.split( '?' )[0] != '/metrics':
+                    self.send_error( 404 )
+                    return
+                body = exporter.render().encode()
+                self.send_response( 200 )
+                self.send_header( 'Content-Type', 'text/plain; version=0.0.4' )
+                self.send_header( 'Content-Length', str( len( body ) ) )
+                self.end_headers()
+                self.wfile.write( body )
+            def log_message( self, *a ):
+                pass
+        self._httpd = ThreadingHTTPServer( ( self.http_host, self.http_port ), _Handler )
+        self.http_port = self._httpd.server_address[1]
+        t = threading.Thread( target=self._httpd.serve_forever, name='metricshttp' )
+        t.daemon = True
+        t.start()
+
+
+    def __enter__( self ):
+        return self.start()
+
+
+    def __exit__( self, *exc ):
+        self.stop()
+
+
+def _split( key ):
+    """ 'a.b{x="y"}' -> ( 'a.b', '{x="y"}' )
+    """
+    i = key.find( '{' )
+    if i < 0:
+        return ( key, '' )
+    return ( key[ :i ], key[ i: ] )
+
+
+def _addlabel( labels, k, v ):
+    label = '{0}="{1}"'.format( k, v )
+    if not labels:
+        return '{' + label + '}'
+    return labels[ :-1 ] + ',' + label + '}'
+
+
+def _promname( prefix, name ):
+    name = ''.join( c if c.isalnum() or c == '_' else '_' for c in name )
+    if prefix:
+        name = prefix + '_' + name
+    return name
+
+
+def _num( v ):
+    if v == float( 'inf' ):
+        return '+Inf'
+    return repr( v )
+
+
+if __name__ == '__main__':
+    raise UserWarning( 'Cmdline not supported' )
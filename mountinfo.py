@@ -0,0 +1,185 @@
+import os
+import logging
+import threading
+
+log = logging.getLogger( __name__ )
+
+MOUNTINFO_PATH = '/proc/self/mountinfo'
+
+
+class MountInfo( object ):
+    """
+    class MountInfo( object )
+    One entry (line) of /proc/self/mountinfo
+    """
+    attrnames = ( 'mount_id', 'parent_id', 'devid', 'root', 'mountpoint',
+                  'options', 'fstype', 'source', 'super_options', )
+
+    def __init__( self, **kwargs ):
+        for k in self.attrnames:
+            setattr( self, k, kwargs.get( k ) )
+
+    @classmethod
+    def from_line( cls, line ):
+        """
+        Parse one line of /proc/self/mountinfo, see proc(5)
+        """
+        parts = line.split()
+        try:
+            sep = parts.index( '-', 6 )
+        except ( ValueError ) as e:
+            raise MountInfoError( reason='missing separator field', origin=line )
+        return cls( mount_id=int( parts[0] ),
+                    parent_id=int( parts[1] ),
+                    devid=parts[2],
+                    root=_unescape( parts[3] ),
+                    mountpoint=_unescape( parts[4] ),
+                    options=parts[5],
+                    fstype=parts[ sep + 1 ],
+                    source=_unescape( parts[ sep + 2 ] ),
+                    super_options=parts[ sep + 3 ] if len( parts ) > sep + 3 else '' )
+
+    def __repr__( self ):
+        return '<{0} {1} ({2})>'.format( self.__class__.__name__,
+            self.mountpoint, self.fstype )
+
+
+class MountTable( object ):
+    """
+    Mount table, parsed once from /proc/self/mountinfo
+    Answers "which mount holds this path" by longest prefix match; results are
+    cached per directory so repeated lookups for files in the same directory
+    cost no system calls.  Call refresh() after filesystems are (un)mounted.
+    """
+
+    # max number of cached directories, cache is cleared when exceeded
+    max_cachesize = 100000
+
+    def __init__( self, path=MOUNTINFO_PATH ):
+        self.path = path
+        self.lock = threading.Lock()
+        self.refresh()
+
+
+    def refresh( self ):
+        """
+        (Re-)read mount information and clear the directory cache
+        """
+        mounts = {}
+        with open( self.path ) as f:
+            for line in f:
+                if len( line.strip() ) < 1:
+                    continue
+                m = MountInfo.from_line( line )
+                # later entries are mounted on top of earlier ones
+                mounts[ m.mountpoint ] = m
+        with self.lock:
+            self.mounts = mounts
+            # longest first, so the first prefix match is the best match
+            self._ordered = sorted( mounts, key=len, reverse=True )
+            self._dircache = {}
+        log.debug( 'loaded {0} mounts from {1}'.format( len( mounts ), self.path ) )
+
+
+    def lookup( self, path ):
+        """
+        Return MountInfo for the mount that holds path
+        path is not resolved, use find() for paths that may contain symlinks
+        """
+        if path in self.mounts:
+            return self.mounts[ path ]
+        for mp in self._ordered:
+            if path.startswith( mp ) and ( mp == os.sep or path[ len( mp ) ] == os.sep ):
+                return self.mounts[ mp ]
+        return None
+
+
+    def find( self, path ):
+        """
+        Return MountInfo for the mount that holds path (absolute or relative)
+        Symlinks in the parent directories of path are resolved, the final
+        component is not (same as lstat).
+        """
+        path = os.path.abspath( path )
+        dirname, name = os.path.split( path )
+        try:
+            realdir, dirmount = self._dircache[ dirname ]
+        except ( KeyError ):
+            realdir = os.path.realpath( dirname )
+            dirmount = self.lookup( realdir )
+            with self.lock:
+                if len( self._dircache ) >= self.max_cachesize:
+                    self._dircache = {}
+                self._dircache[ dirname ] = ( realdir, dirmount )
+        if name:
+            # path may itself be a mountpoint
+            m = self.mounts.get( os.path.join( realdir, name ) )
+            if m is not None:
+                return m
+        return dirmount
+
+
+    def getmountpoint( self, path ):
+        """
+        Return the mountpoint (str) of the filesystem holding path
+        """
+        m = self.find( path )
+        if m is None:
+            return os.sep
+        return m.mountpoint
+
+
+def _unescape( field ):
+    """
+    Undo octal escapes (\\040 for space, etc.) used in mountinfo fields
+    """
+    if '\\' not in field:
+        return field
+    parts = field.split( '\\' )
+    rv = [ parts[0] ]
+    for p in parts[1:]:
+        rv.append( chr( int( p[:3], 8 ) ) + p[3:] )
+    return ''.join( rv )
+
+
+_mounttable = None
+
+def mounttable():
+    """
+    Return the shared MountTable instance, creating it on first use
+    Returns None if mount information is not available on this system
+    """
+    global _mounttable
+    if _mounttable is None:
+        try:
+            _mounttable = MountTable()
+        except ( IOError, OSError ) as e:
+            log.debug( 'mount table not available: {0}'.format( e ) )
+            return None
+    return _mounttable
+
+
+def refresh():
+    """
+    Refresh the shared MountTable (call after filesystems are (un)mounted)
+    """
+    t = mounttable()
+    if t is not None:
+        t.refresh()
+
+
+class MountInfoError( Exception ):
+    def __init__( self, reason, origin, *a, **k ):
+        super( MountInfoError, self ).__init__( *a, **k )
+        self.reason = reason
+        self.origin = origin
+
+    def __repr__( self ):
+        return "<{0} (reason={1} origin={2})>".format(
+            self.__class__.__name__, self.reason, self.origin )
+
+    __str__ = __repr__
+
+
+if __name__ == '__main__':
+    raise UserWarning( 'Cmdline not supported' )
@@ -1,10 +1,21 @@
-from runcmd import runcmd, Run_Cmd_Error
+from runcmd import runcmd, runcmd_stream, runcmd_async, Run_Cmd_Error
 import logging
 import os
 import shutil
 import fsitem
 import pprint
 import collections
+import errno
+import stat
+import re
+import threading
+import uuid
+import concurrent.futures
+import asyncio
+import metrics
+import tracing
+import backend
+import throttle
 
 log = logging.getLogger( __name__ )
 
@@ -129,12 +140,38 @@ def path2fid( path ):
     args = [ path ]
     retval = None
     ( output, errput ) = runcmd( cmd, opts, args )
-    retval = output.rstrip()
+    retval = os.fsdecode( output ).rstrip()
     return retval
 
 inode = path2fid
 
 
+async def path2fid_async( path, limit=None ):
+    """
+    asyncio version of path2fid
+    :param limit asyncio.Semaphore: OPTIONAL see runcmd.runcmd_async
+    """
+    cmd = [ env[ 'PYLUTLFSPATH' ], 'path2fid' ]
+    opts = None
+    args = [ path ]
+    ( output, errput ) = await runcmd_async( cmd, opts, args, limit=limit )
+    return os.fsdecode( output ).rstrip()
+
+
+# Directory, relative to the mountpoint, where Lustre exposes files by FID
+FIDDIR = os.path.join( '.lustre', 'fid' )
+
+def fidpath( mountpoint, fid ):
+    """
+    get the path that opens fid directly: <mountpoint>/.lustre/fid/<fid>
+    This is a single lookup on the MDS, regardless of how deep the real
+    path of the file is
+    """
+    if isinstance( fid, bytes ):
+        fid = os.fsdecode( fid )
+    return os.path.join( mountpoint, FIDDIR, fid )
+
+
 def fid2path( fsname, fid ):
     """
     get all paths for a single fid
@@ -144,10 +181,199 @@ def fid2path( fsname, fid ):
     args = [ fsname, fid ]
     retval = None
     ( output, errput ) = runcmd( cmd, opts, args )
-    paths = output.split()
+    # one path per line (paths may contain spaces)
+    paths = os.fsdecode( output ).splitlines()
     return paths
 
 
+def fid2path_bulk( fsname, fids, batchsize=100, workers=4 ):
+    """
+    get all paths for many fids
+    FIDs are resolved batchsize at a time per "lfs fid2path" invocation, with
+    up to workers invocations running in parallel.
+    FIDs that can't be resolved (ie: no longer exist) are left out of the
+    result.  Keys of the result are the FIDs as passed in; FIDs are compared
+    in a canonical form, so "0x200000400:0x1:0x0" matches lfs output
+    "[0x200000400:0x1:0x0]".
+    :param fsname str: filesystem name or mountpoint
+    :param fids iterable: FIDs (str)
+    :return dict: fid -> list of paths (str)
+    """
+    fids = list( fids )
+    batches = [ fids[ i:i + batchsize ] for i in range( 0, len( fids ), batchsize ) ]
+    rv = {}
+    if len( batches ) < 1:
+        return rv
+    with concurrent.futures.ThreadPoolExecutor( min( workers, len( batches ) ) ) as pool:
+        for result in pool.map( lambda b: _fid2path_batch( fsname, b ), batches ):
+            rv.update( result )
+    return rv
+
+
+def _fid2path_batch( fsname, fids ):
+    """
+    Resolve a batch of fids with a single "lfs fid2path" invocation
+    lfs exits non-zero if any fid fails, but still prints the paths of the
+    others.  Fids found in stdout are kept, fids named in stderr are dropped
+    and only the remaining fids (if any) are retried.  If a failed run gives
+    no way to tell which fids are bad, the batch is split in half instead.
+    Keys of the result are the fids as passed in, whatever spelling lfs
+    prints them with.
+    """
+    byfid = {}
+    for fid in fids:
+        byfid.setdefault( _normfid( fid ), [] ).append( fid )
+    rv = {}
+    todo = list( byfid )
+    while todo:
+        cmd = [ env[ 'PYLUTLFSPATH' ], 'fid2path' ]
+        opts = None
+        args = [ '--print-fid', fsname ] + todo
+        failed = None
+        try:
+            ( output, errput ) = runcmd( cmd, opts, args )
+        except ( Run_Cmd_Error ) as e:
+            log.debug( 'fid2path batch of {0} failed: {1}'.format( len( todo ), e ) )
+            ( output, errput ) = ( e.output, e.reason )
+            failed = e
+        found = _parse_fid2path( output )
+        for nfid, paths in found.items():
+            for fid in byfid.get( nfid, [] ):
+                rv[ fid ] = paths
+        if failed is None:
+            break
+        bad = set( _normfid( f ) for f in _FIDRE.findall( _tostr( errput ) ) )
+        rest = [ f for f in todo if f not in found and f not in bad ]
+        if len( rest ) == len( todo ):
+            # no progress, can't tell which fids are bad
+            if len( todo ) == 1:
+                break
+            half = len( todo ) // 2
+            for part in ( todo[ :half ], todo[ half: ] ):
+                for nfid, paths in _fid2path_batch( fsname, part ).items():
+                    for fid in byfid[ nfid ]:
+                        rv[ fid ] = paths
+            break
+        todo = rest
+    return rv
+
+
+def _parse_fid2path( output ):
+    """ Parse "lfs fid2path --print-fid" output into normalized fid -> paths
+    """
+    rv = {}
+    for line in _tostr( output ).splitlines():
+        # "<fid> <path>", path may contain spaces
+        fid, sep, path = line.partition( ' ' )
+        if not sep:
+            continue
+        rv.setdefault( _normfid( fid ), [] ).append( path )
+    return rv
+
+
+_FIDRE = re.compile( r'\[?0x[0-9a-fA-F]+:0x[0-9a-fA-F]+:0x[0-9a-fA-F]+\]?' )
+
+def _normfid( fid ):
+    """
+    Canonical spelling of a FID ( "[0x<seq>:0x<oid>:0x<ver>]", lowercase,
+    no leading zeros ), so differently written FIDs compare equal
+    Strings that don't parse as a FID are returned unchanged
+    """
+    fid = _tostr( fid )
+    try:
+        parts = [ int( p, 16 ) for p in fid.strip().strip( '[]' ).split( ':' ) ]
+    except ( ValueError ):
+        return fid
+    if len( parts ) != 3:
+        return fid
+    return '[0x{0:x}:0x{1:x}:0x{2:x}]'.format( *parts )
+
+
+def _tostr( val ):
+    if val is None:
+        return ''
+    if isinstance( val, bytes ):
+        return os.fsdecode( val )
+    return val
+
+
+class Fid2PathCache( object ):
+    """
+    LRU cache of fid -> paths, for one filesystem
+    Lookups that miss are resolved in bulk with fid2path_bulk.  Entries must
+    be invalidated explicitly when files are renamed, linked or removed.
+    """
+
+    def __init__( self, fsname, maxsize=100000, batchsize=100, workers=4 ):
+        self.fsname = fsname
+        self.maxsize = maxsize
+        self.batchsize = batchsize
+        self.workers = workers
+        self.hits = 0
+        self.misses = 0
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def resolve( self, fids ):
+        """
+        Return dict of fid -> list of paths, for the fids that can be resolved
+        """
+        rv = {}
+        missing = []
+        with self._lock:
+            for fid in fids:
+                try:
+                    rv[ fid ] = self._cache[ _normfid( fid ) ]
+                    self._cache.move_to_end( _normfid( fid ) )
+                    self.hits += 1
+                except ( KeyError ):
+                    missing.append( fid )
+                    self.misses += 1
+        metrics.incr( 'fid2path_cache.hits', len( rv ) )
+        metrics.incr( 'fid2path_cache.misses', len( missing ) )
+        if missing:
+            found = fid2path_bulk( self.fsname, missing,
+                                   batchsize=self.batchsize, workers=self.workers )
+            with self._lock:
+                for fid, paths in found.items():
+                    self._cache[ _normfid( fid ) ] = paths
+                    self._cache.move_to_end( _normfid( fid ) )
+                while len( self._cache ) > self.maxsize:
+                    self._cache.popitem( last=False )
+            rv.update( found )
+        return rv
+
+
+    def invalidate( self, fids=None ):
+        """
+        Drop fids from the cache (all entries if fids is None)
+        """
+        with self._lock:
+            if fids is None:
+                self._cache.clear()
+                return
+            for fid in fids:
+                self._cache.pop( _normfid( fid ), None )
+
+
+    def __len__( self ):
+        return len( self._cache )
+
+
+def getsom( path ):
+    """
+    get lazy size-on-MDT for a single path
+    Answered by the MDS alone (no OST glimpse), but may be stale
+    return size as int
+    """
+    cmd = [ env[ 'PYLUTLFSPATH' ], 'getsom' ]
+    opts = None
+    args = [ '-s', path ]
+    ( output, errput ) = runcmd( cmd, opts, args )
+    return int( output.strip() )
+
+
 #TODO - adjust this to take FSItem as input, then can check type without incurring
 #       overhead
 #       syncfile already expects FSItem, so pylut already depends on fsitem
@@ -164,6 +390,23 @@ def getstripeinfo( path ):
 #    if os.path.isdir( path ):
 #        args.insert( 0, '-d' )
     ( output, errput ) = runcmd( cmd, opts, args )
+    return _parse_getstripe( output, errput )
+
+
+async def getstripeinfo_async( path, limit=None ):
+    """ asyncio version of getstripeinfo
+        limit: OPTIONAL asyncio.Semaphore, see runcmd.runcmd_async
+    """
+    cmd = [ env[ 'PYLUTLFSPATH' ], 'getstripe' ]
+    opts = None
+    args = [ path ]
+    ( output, errput ) = await runcmd_async( cmd, opts, args, limit=limit )
+    return _parse_getstripe( output, errput )
+
+
+def _parse_getstripe( output, errput ):
+    output = os.fsdecode( output )
+    errput = os.fsdecode( errput )
     if True in [ 'has no stripe info' in x for x in (output, errput) ]:
         sinfo = LustreStripeInfo()
     else:
@@ -184,6 +427,18 @@ def setstripeinfo( path, count=None, size=None, offset=None ):
         If path is an existing fifo, i/o will block (forever?)
         Output: (no return value)
     """
+    ( output, errput ) = runcmd( *_setstripe_cmd( path, count, size, offset ) )
+
+
+async def setstripeinfo_async( path, count=None, size=None, offset=None, limit=None ):
+    """ asyncio version of setstripeinfo
+        limit: OPTIONAL asyncio.Semaphore, see runcmd.runcmd_async
+    """
+    cmd, opts, args = _setstripe_cmd( path, count, size, offset )
+    ( output, errput ) = await runcmd_async( cmd, opts, args, limit=limit )
+
+
+def _setstripe_cmd( path, count, size, offset ):
     cmd = [ env[ 'PYLUTLFSPATH' ], 'setstripe' ]
     opts = None
     args = [ path ]
@@ -191,14 +446,68 @@ def setstripeinfo( path, count=None, size=None, offset=None ):
         args[0:0] = ['-c', int( count ) ]
     if size:
         args[0:0] = ['-S', int( size ) ]
-    if offset:
+    if offset is not None:
+        # 0 is a valid OST index
         args[0:0] = ['-i', int( offset ) ]
-    ( output, errput ) = runcmd( cmd, opts, args )
+    return ( cmd, opts, args )
+
+
+# pylut.find() keyword -> lfs find option
+_find_opts = collections.OrderedDict( (
+    ( 'type',         '--type' ),
+    ( 'name',         '--name' ),
+    ( 'mtime',        '--mtime' ),
+    ( 'ctime',        '--ctime' ),
+    ( 'atime',        '--atime' ),
+    ( 'size',         '--size' ),
+    ( 'stripe_count', '--stripe-count' ),
+    ( 'stripe_size',  '--stripe-size' ),
+    ( 'pool',         '--pool' ),
+    ( 'maxdepth',     '--maxdepth' ),
+    ) )
+
+def find( path, items=False, timeout=None, **filters ):
+    """
+    Generator of paths under path that match all filters, using lfs find
+    Filtering is done inside lfs, results are streamed (NUL separated) as
+    they are found, so memory use doesn't depend on the number of results.
+    Filter values are passed to lfs find as-is, with the usual find syntax,
+    ie: mtime='-1' (modified less than 1 day ago), size='+1G', type='f',
+    stripe_count=4, pool='flash'.
+    :param path str: top of the tree to search
+    :param items bool: if True, yield fsitem.FSItem instead of str
+    :param timeout float: OPTIONAL max seconds for the whole search, lfs is
+                          killed and runcmd.Run_Cmd_Timeout raised after that
+    :param filters: any of type, name, mtime, ctime, atime, size,
+                    stripe_count, stripe_size, pool, maxdepth
+    """
+    unknown = set( filters ) - set( _find_opts )
+    if unknown:
+        raise UserWarning( 'Unsupported find filter(s): {0}'.format(
+            ', '.join( sorted( unknown ) ) ) )
+    path = os.path.abspath( path )
+    cmd = [ env[ 'PYLUTLFSPATH' ], 'find' ]
+    opts = None
+    args = [ path ]
+    for k, opt in _find_opts.items():
+        if filters.get( k ) is not None:
+            args.extend( [ opt, filters[ k ] ] )
+    args.append( '--print0' )
+    mountpoint = None
+    if items:
+        mountpoint = fsitem.getmountpoint( path )
+    for rec in runcmd_stream( cmd, opts, args, sep=b'\0', timeout=timeout ):
+        p = os.fsdecode( rec )
+        if items:
+            yield fsitem.FSItem( p, absname=p, mountpoint=mountpoint )
+        else:
+            yield p
 
 
 def syncfile( src_path, tgt_path, tmpbase=None, keeptmp=False,
               synctimes=False, syncperms=False, syncowner=False, syncgroup=False,
-              pre_checksums=False, post_checksums=True ):
+              pre_checksums=False, post_checksums=True, byfid=False,
+              stripe_offset=None ):
     """
     Lustre stripe aware file sync
     Copies a file to temporary location, then creates a hardlink for the target.
@@ -222,12 +531,19 @@ def syncfile( src_path, tgt_path, tmpbase=None, keeptmp=False,
     copies.  It is up to the user of this function to remove the tmp files at
     a later time.
     The tmpbase parameter cannot be None (this requirement may be removed in
-    a future version).  tmpbase will be created if necessary.  The tmpbase
-    directory structure will not be removed and therefore must be cleaned up
-    manually.
+    a future version).  tmpbase will be created if necessary.  tmpbase
+    subdirectories are shared between concurrent syncfile calls and are
+    never removed here; they, and tmp files kept with keeptmp=True, can be
+    cleaned up later with cleantmpbase().
     If post_checksums=True (default), the checksums for src and tgt should be
     immediately available on the same parameters that were passed in (ie:
     src_path.checksum() and tgt_path.checksum() )
+    If byfid=True, src data and stat are read through
+    <mountpoint>/.lustre/fid/<fid> instead of the src path (see
+    FSItem.datapath), src_path is switched to byfid access.
+    A newly created tgt (or tmp) file gets the stripe count and size of src;
+    stripe_offset selects the OST of its first stripe (default: let Lustre
+    choose), see scheduler.OstScheduler.
     :param src_path FSItem:
     :param tgt_path FSItem:
     :param tmpbase    str: absolute path to directory where tmp files will be created
@@ -241,12 +557,168 @@ def syncfile( src_path, tgt_path, tmpbase=None, keeptmp=False,
     :param post_checksums bool: if source was copied to target, compare checksums 
                                 to verify target was written correctly 
                                 (default=True)
+    :param byfid bool: access src by FID instead of by path (default=False)
+    :param stripe_offset int: OPTIONAL first OST index for a newly created file
     :return two-tuple: 
         1. fsitem.FSItem: full path to tmpfile (even if keeptmp=False)
         2. action_taken: dict with keys of 'data_copy' and 'meta_update' and values
             of True or False depending on the action taken
         2. sync_results: output from rsync --itemize-changes
     """
+    syncopts = { 'synctimes': synctimes,
+                 'syncperms': syncperms,
+                 'syncowner': syncowner,
+                 'syncgroup': syncgroup,
+                 'pre_checksums': pre_checksums,
+                 'post_checksums': post_checksums,
+               }
+    with _Phase( 'syncfile', src=src_path.absname ):
+        try:
+            rv = _syncfile( src_path, tgt_path, tmpbase, keeptmp, byfid, syncopts,
+                            stripe_offset )
+        except ( SyncError ) as e:
+            _count_error( e )
+            raise
+    _count_actions( rv[1] )
+    return rv
+
+
+def _syncfile( src_path, tgt_path, tmpbase, keeptmp, byfid, syncopts, stripe_offset=None ):
+    with _Phase( 'syncfile.compare' ):
+        plan = _syncfile_plan( src_path, tgt_path, tmpbase, keeptmp, byfid, syncopts )
+    _syncfile_mktmpdir( plan )
+    if plan.do_setstripe:
+        # Set stripe to create the new file with the expected stripe information
+        with _Phase( 'syncfile.setstripe' ):
+            sinfo = plan.src_path.stripeinfo()
+            log.debug( 'setstripe (create) {0}'.format( plan.setstripe_tgt ) )
+            throttle.ops()
+            try:
+                backend.for_path( str( plan.setstripe_tgt ) ).setstripeinfo(
+                    str( plan.setstripe_tgt ), count=sinfo.count, size=sinfo.size,
+                    offset=stripe_offset )
+            except ( Run_Cmd_Error ) as e:
+                msg = 'Setstripe failed for {0}'.format( plan.setstripe_tgt )
+                raise SyncError( msg, e )
+    if plan.do_rsync:
+        with _Phase( 'syncfile.copy', nbytes=_copybytes( plan ) ):
+            if plan.do_setstripe and throttle.limiter.active:
+                # Rate limited copy, rsync then only updates metadata
+                _throttled_copy( plan )
+            elif plan.do_setstripe and plan.rsync_src.size > int( env[ 'PYLUTRSYNCMAXSIZE' ] ):
+                # DD for large files
+                ( output, errput ) = runcmd( *_dd_cmd( plan ) )
+                _dd_check( plan, output, errput )
+            # Do the rsync
+            try:
+                ( output, errput ) = runcmd( *_rsync_cmd( plan ) )
+            except ( Run_Cmd_Error ) as e:
+                raise SyncError( reason=e.reason, origin=e )
+            _rsync_check( plan, output, errput )
+    with _Phase( 'syncfile.link' ):
+        _syncfile_finish( plan )
+    _syncfile_checksums( plan )
+    return ( plan.tmp_path, plan.sync_action )
+
+
+async def syncfile_async( src_path, tgt_path, tmpbase=None, keeptmp=False,
+                          synctimes=False, syncperms=False, syncowner=False,
+                          syncgroup=False, pre_checksums=False,
+                          post_checksums=True, byfid=False, stripe_offset=None,
+                          limit=None ):
+    """
+    asyncio version of syncfile, same parameters and return value
+    lfs, dd and rsync run as asyncio subprocesses, so many syncs can be in
+    flight from one thread.  Comparing existing files (stat, FID lookups) and
+    post_checksums still block, they are run in the loop's default executor.
+    :param limit asyncio.Semaphore: OPTIONAL see runcmd.runcmd_async
+    """
+    syncopts = { 'synctimes': synctimes,
+                 'syncperms': syncperms,
+                 'syncowner': syncowner,
+                 'syncgroup': syncgroup,
+                 'pre_checksums': pre_checksums,
+                 'post_checksums': post_checksums,
+               }
+    with _Phase( 'syncfile', src=src_path.absname ):
+        try:
+            rv = await _syncfile_async( src_path, tgt_path, tmpbase, keeptmp, byfid,
+                                        syncopts, limit, stripe_offset )
+        except ( SyncError ) as e:
+            _count_error( e )
+            raise
+    _count_actions( rv[1] )
+    return rv
+
+
+async def _syncfile_async( src_path, tgt_path, tmpbase, keeptmp, byfid, syncopts, limit,
+                           stripe_offset=None ):
+    loop = asyncio.get_running_loop()
+    if src_path._inode is None:
+        await throttle.ops_async()
+        try:
+            src_path.set_inode( await backend.for_path( src_path.absname ).path2fid_async(
+                src_path.absname, limit=limit ) )
+        except ( Run_Cmd_Error ) as e:
+            raise SyncError( reason=e.reason, origin=e )
+    with _Phase( 'syncfile.compare' ):
+        plan = await loop.run_in_executor( None, _syncfile_plan,
+            src_path, tgt_path, tmpbase, keeptmp, byfid, syncopts )
+    # makedirs, link and unlink wait on the MDS, keep them off the loop
+    await loop.run_in_executor( None, _syncfile_mktmpdir, plan )
+    if plan.do_setstripe:
+        with _Phase( 'syncfile.setstripe' ):
+            sinfo = plan.src_path._stripeinfo
+            if sinfo is None:
+                src_backend = backend.for_path( plan.src_path.absname )
+                await throttle.ops_async()
+                sinfo = await src_backend.getstripeinfo_async( plan.src_path.datapath(),
+                                                               limit=limit )
+                plan.src_path.set_stripeinfo( sinfo )
+            await throttle.ops_async()
+            log.debug( 'setstripe (create) {0}'.format( plan.setstripe_tgt ) )
+            try:
+                await backend.for_path( str( plan.setstripe_tgt ) ).setstripeinfo_async(
+                    str( plan.setstripe_tgt ), count=sinfo.count, size=sinfo.size,
+                    offset=stripe_offset, limit=limit )
+            except ( Run_Cmd_Error ) as e:
+                msg = 'Setstripe failed for {0}'.format( plan.setstripe_tgt )
+                raise SyncError( msg, e )
+    if plan.do_rsync:
+        with _Phase( 'syncfile.copy', nbytes=_copybytes( plan ) ):
+            if plan.do_setstripe and throttle.limiter.active:
+                await loop.run_in_executor( None, _throttled_copy, plan )
+            elif plan.do_setstripe and plan.rsync_src.size > int( env[ 'PYLUTRSYNCMAXSIZE' ] ):
+                ( output, errput ) = await runcmd_async( *_dd_cmd( plan ), limit=limit )
+                _dd_check( plan, output, errput )
+            try:
+                ( output, errput ) = await runcmd_async( *_rsync_cmd( plan ), limit=limit )
+            except ( Run_Cmd_Error ) as e:
+                raise SyncError( reason=e.reason, origin=e )
+            _rsync_check( plan, output, errput )
+    with _Phase( 'syncfile.link' ):
+        await loop.run_in_executor( None, _syncfile_finish, plan )
+    await loop.run_in_executor( None, _syncfile_checksums, plan )
+    return ( plan.tmp_path, plan.sync_action )
+
+
+class _SyncfilePlan( object ):
+    """
+    What syncfile decided needs to be done, see _syncfile_plan
+    """
+    def __init__( self, **kwargs ):
+        for k, v in kwargs.items():
+            setattr( self, k, v )
+
+
+def _syncfile_plan( src_path, tgt_path, tmpbase, keeptmp, byfid, syncopts ):
+    """
+    Decide what syncfile has to do, based on what already exists on the tgt FS
+    Invalid tmp and tgt files are removed here, everything else (creating,
+    copying, linking) is left to the caller, so the same decisions can be
+    executed either blocking (syncfile) or with asyncio (syncfile_async).
+    :return _SyncfilePlan:
+    """
     if tmpbase is None:
         #TODO - If tmpbase is None, create one at the mountpoint
         # tmpbase = _pathjoin( 
@@ -258,6 +730,8 @@ def syncfile( src_path, tgt_path, tmpbase=None, keeptmp=False,
         srcfid = src_path.inode()
     except ( Run_Cmd_Error ) as e:
         raise SyncError( reason=e.reason, origin=e )
+    if byfid:
+        src_path.set_byfid( True )
     tmpdir = _pathjoin( tmpbase, hex( hash( srcfid ) )[-5:] )
     tmp_path = fsitem.FSItem( os.path.join( tmpdir, srcfid ) )
     log.debug( 'tmp_path:{0}'.format( tmp_path ) )
@@ -265,7 +739,6 @@ def syncfile( src_path, tgt_path, tmpbase=None, keeptmp=False,
     do_mktmpdir = False
     do_setstripe = False
     setstripe_tgt = None
-    setstripe_stripeinfo = None
     do_rsync = False
     rsync_src = None
     rsync_tgt = None
@@ -274,23 +747,20 @@ def syncfile( src_path, tgt_path, tmpbase=None, keeptmp=False,
     hardlink_tgt = None
     do_checksums = False
     sync_action = { 'data_copy': False, 'meta_update': False }
-    syncopts = { 'synctimes': synctimes,
-                 'syncperms': syncperms,
-                 'syncowner': syncowner,
-                 'syncgroup': syncgroup,
-                 'pre_checksums': pre_checksums,
-                 'post_checksums': post_checksums,
-               }
     tmp_exists, tmp_data_ok, tmp_meta_ok = ( False, ) * 3
     tgt_exists, tgt_data_ok, tgt_meta_ok = ( False, ) * 3
-    tmp_exists = tmp_path.exists()
-    if tmp_exists:
-        log.debug( 'tmp exists, comparing tmp to src' )
-        tmp_data_ok, tmp_meta_ok = _compare_files( src_path, tmp_path, syncopts )
-    tgt_exists = tgt_path.exists()
-    if tgt_exists:
-        log.debug( 'tgt exists, comparing tgt to src' )
-        tgt_data_ok, tgt_meta_ok = _compare_files( src_path, tgt_path, syncopts )
+    with tracing.span( 'syncfile.tmp_check', cat='syncfile' ):
+        tmp_exists = tmp_path.exists()
+        if tmp_exists:
+            log.debug( 'tmp exists, comparing tmp to src' )
+            with tracing.span( '_compare_files', cat='syncfile' ):
+                tmp_data_ok, tmp_meta_ok = _compare_files( src_path, tmp_path, syncopts )
+    with tracing.span( 'syncfile.tgt_check', cat='syncfile' ):
+        tgt_exists = tgt_path.exists()
+        if tgt_exists:
+            log.debug( 'tgt exists, comparing tgt to src' )
+            with tracing.span( '_compare_files', cat='syncfile' ):
+                tgt_data_ok, tgt_meta_ok = _compare_files( src_path, tgt_path, syncopts )
     if tmp_exists and tgt_exists:
         log.debug( 'tmp and tgt exist' )
         if tmp_path.inode() == tgt_path.inode():
@@ -380,7 +850,6 @@ def syncfile( src_path, tgt_path, tmpbase=None, keeptmp=False,
                             meta_update = True )
         if src_path.is_regular():
             do_setstripe = True
-            setstripe_stripeinfo = src_path.stripeinfo()
         if keeptmp:
             do_mktmpdir = True
             setstripe_tgt = tmp_path #will be ignored if do_setstripe is False
@@ -398,81 +867,168 @@ def syncfile( src_path, tgt_path, tmpbase=None, keeptmp=False,
             rsync_src = src_path
             rsync_tgt = tgt_path
             do_checksums = True
-    if do_mktmpdir:
-        # Ensure tmpdir exists
-        log.debug( 'create tmpdir {0}'.format( tmpdir ) )
-        try:
-            os.makedirs( tmpdir )
-        except ( OSError ) as e:
-            # OSError: [Errno 17] File exists
-            if e.errno != 17:
-                raise SyncError(
-                    'Unable to create tmpdir {0}'.format( tmpdir ),
-                    e
-                    )
-    if do_setstripe:
-        # Set stripe to create the new file with the expected stripe information
-        log.debug( 'setstripe (create) {0}'.format( setstripe_tgt ) )
-        try:
-            setstripeinfo( setstripe_tgt,
-                           count=setstripe_stripeinfo.count,
-                           size=setstripe_stripeinfo.size )
-        except ( Run_Cmd_Error ) as e:
-            msg = 'Setstripe failed for {0}'.format( setstripe_tgt )
-            raise SyncError( msg, e )
-        if rsync_src.size > env[ 'PYLUTRSYNCMAXSIZE' ]:
-            # DD for large files
-            # TODO - replace dd with ddrescue (for efficient handling of sparse files)
-            cmd = [ '/bin/dd' ]
-            opts = { 'bs': 4194304,
-                     'if': rsync_src,
-                     'of': rsync_tgt,
-                     'status': 'noxfer',
-                   }
-            args = None
-            ( output, errput ) = runcmd( cmd, opts, args )
-            if len( errput.splitlines() ) > 2:
-                #TODO - it is hackish to ignore errors based on line count, better is to
-                #       use a dd that supports "status=none"
-                raise UserWarning( "errors during dd of '{0}' -> '{1}': output='{2}' errors='{3}'".format( 
-                    rsync_src, rsync_tgt, output, errput ) )
-    if do_rsync:
-        # Do the rsync
-        cmd = [ env[ 'PYLUTRSYNCPATH' ] ]
-        opts = { '--compress-level': 0 }
-        args = [ '-l', '-A', '-X', '--super', '--inplace', '--specials' ]
-        if synctimes:
-            args.append( '-t' )
-        if syncperms:
-            args.append( '-p' )
-        if syncowner:
-            args.append( '-o' )
-        if syncgroup:
-            args.append( '-g' )
-        args.extend( [ rsync_src, rsync_tgt ] )
-        try:
-            ( output, errput ) = runcmd( cmd, opts, args )
-        except ( Run_Cmd_Error ) as e:
-            raise SyncError( reason=e.reason, origin=e )
-        if len( errput ) > 0:
-            raise SyncError( 
-                reason="errors during sync of '{0}' -> '{1}'".format(
-                    rsync_src, rsync_tgt),
-                origin="output='{0}' errors='{1}'".format( output, errput ) )
-    if do_hardlink:
-        log.debug( 'hardlink {0} <- {1}'.format( hardlink_src, hardlink_tgt ) )
+    return _SyncfilePlan( src_path=src_path, tgt_path=tgt_path, keeptmp=keeptmp,
+        syncopts=syncopts, tmpdir=tmpdir, tmp_path=tmp_path, sync_action=sync_action,
+        do_mktmpdir=do_mktmpdir, do_setstripe=do_setstripe, setstripe_tgt=setstripe_tgt,
+        do_rsync=do_rsync, rsync_src=rsync_src, rsync_tgt=rsync_tgt,
+        do_hardlink=do_hardlink, hardlink_src=hardlink_src, hardlink_tgt=hardlink_tgt,
+        do_checksums=do_checksums, data_copied=False )
+
+
+def _syncfile_mktmpdir( plan ):
+    if not plan.do_mktmpdir:
+        return
+    # Ensure tmpdir exists
+    tmpdir = plan.tmpdir
+    log.debug( 'create tmpdir {0}'.format( tmpdir ) )
+    try:
+        os.makedirs( tmpdir )
+    except ( OSError ) as e:
+        # OSError: [Errno 17] File exists
+        if e.errno != 17:
+            raise SyncError(
+                'Unable to create tmpdir {0}'.format( tmpdir ),
+                e
+                )
+
+
+def _count_actions( sync_action ):
+    if metrics.enabled:
+        for k, v in sync_action.items():
+            if v:
+                metrics.incr( 'syncfile.action', labels={ 'action': k } )
+
+
+# quoted strings and paths, removed from error reasons used as metric labels
+_reason_details = re.compile( r"'[^']*'|\S*/\S*" )
+
+def _count_error( e ):
+    if metrics.enabled:
+        reason = e.reason
+        if isinstance( reason, bytes ):
+            reason = os.fsdecode( reason )
+        reason = str( reason ).strip().split( '\n' )[0]
+        reason = _reason_details.sub( '_', reason )[:80]
+        metrics.incr( 'syncfile.errors', labels={ 'reason': reason } )
+
+
+class _Phase( object ):
+    """
+    Context manager for one step of syncfile: metrics timer and trace span
+    """
+    __slots__ = ( 'timer', 'span' )
+
+    def __init__( self, name, nbytes=None, **args ):
+        self.timer = metrics.timer( name, nbytes=nbytes )
+        self.span = tracing.span( name, cat='syncfile', **args )
+
+    def __enter__( self ):
+        self.timer.__enter__()
+        self.span.__enter__()
+        return self
+
+    def __exit__( self, exc_type, exc, tb ):
+        self.span.__exit__( exc_type, exc, tb )
+        self.timer.__exit__( exc_type, exc, tb )
+        return False
+
+
+def _copybytes( plan ):
+    """ Bytes of data copied for plan, for metrics (None if not recording)
+    """
+    if metrics.enabled and plan.sync_action[ 'data_copy' ]:
+        return plan.rsync_src.size
+    return None
+
+
+def _dd_cmd( plan ):
+    # TODO - replace dd with ddrescue (for efficient handling of sparse files)
+    cmd = [ '/bin/dd' ]
+    opts = { 'bs': 4194304,
+             'if': plan.rsync_src.datapath(),
+             'of': plan.rsync_tgt,
+             'status': 'noxfer',
+           }
+    args = None
+    return ( cmd, opts, args )
+
+
+def _throttled_copy( plan ):
+    """
+    Copy the data of a new file in chunks drawn from throttle.limiter
+    (instead of dd or rsync) and mark plan.data_copied, so the rsync that
+    follows compares sizes only and just syncs metadata
+    """
+    src = plan.rsync_src
+    # already known from the setstripe
+    sinfo = src.stripeinfo() if throttle.limiter.per_ost else None
+    try:
+        with open( src.datapath(), 'rb' ) as fin:
+            size = os.fstat( fin.fileno() ).st_size
+            with open( str( plan.rsync_tgt ), 'r+b' ) as fout:
+                for data in throttle.chunks( fin, sinfo, size=size ):
+                    fout.write( data )
+    except ( OSError ) as e:
+        raise SyncError( 'Copy failed for {0} -> {1}'.format( src, plan.rsync_tgt ), e )
+    plan.data_copied = True
+
+
+def _dd_check( plan, output, errput ):
+    if len( errput.splitlines() ) > 2:
+        #TODO - it is hackish to ignore errors based on line count, better is to
+        #       use a dd that supports "status=none"
+        raise UserWarning( "errors during dd of '{0}' -> '{1}': output='{2}' errors='{3}'".format( 
+            plan.rsync_src, plan.rsync_tgt, output, errput ) )
+
+
+def _rsync_cmd( plan ):
+    syncopts = plan.syncopts
+    cmd = [ env[ 'PYLUTRSYNCPATH' ] ]
+    opts = { '--compress-level': 0 }
+    args = [ '-l', '-A', '-X', '--super', '--inplace', '--specials' ]
+    if syncopts[ 'synctimes' ]:
+        args.append( '-t' )
+    if syncopts[ 'syncperms' ]:
+        args.append( '-p' )
+    if syncopts[ 'syncowner' ]:
+        args.append( '-o' )
+    if syncopts[ 'syncgroup' ]:
+        args.append( '-g' )
+    if plan.data_copied:
+        # tgt mtime is the copy time, don't let rsync copy the data again
+        args.append( '--size-only' )
+    args.extend( [ plan.rsync_src.datapath(), plan.rsync_tgt ] )
+    return ( cmd, opts, args )
+
+
+def _rsync_check( plan, output, errput ):
+    if len( errput ) > 0:
+        raise SyncError( 
+            reason="errors during sync of '{0}' -> '{1}'".format(
+                plan.rsync_src, plan.rsync_tgt),
+            origin="output='{0}' errors='{1}'".format( output, errput ) )
+
+
+def _syncfile_finish( plan ):
+    """ Hardlink, then remove tmp file (unless keeptmp)
+    """
+    tmp_path = plan.tmp_path
+    if plan.do_hardlink:
+        log.debug( 'hardlink {0} <- {1}'.format( plan.hardlink_src, plan.hardlink_tgt ) )
         try:
-            os.link( str( hardlink_src ), str( hardlink_tgt ) )
+            with tracing.span( 'syncfile.hardlink', cat='syncfile' ):
+                os.link( str( plan.hardlink_src ), str( plan.hardlink_tgt ) )
         except ( OSError ) as e:
             raise SyncError( 
                 reason='Caught exception for link {0} -> {1}'.format(
-                    hardlink_src, hardlink_tgt ),
+                    plan.hardlink_src, plan.hardlink_tgt ),
                 origin=e )
     # Delete tmp
-    if keeptmp is False:
+    if plan.keeptmp is False:
         log.debug( 'unlink tmpfile {0}'.format( tmp_path ) )
         try:
-            os.unlink( str( tmp_path ) )
+            with tracing.span( 'syncfile.unlink', cat='syncfile' ):
+                os.unlink( str( tmp_path ) )
         except ( OSError ) as e:
             # OSError: [Errno 2] No such file or directory
             if e.errno != 2:
@@ -481,26 +1037,214 @@ def syncfile( src_path, tgt_path, tmpbase=None, keeptmp=False,
                     e
                     )
         #tmp_path.update()
-        # TODO - replace rmtree with safer alternative
-        #        walk dirs backwards and rmdir each
-        #shutil.rmtree( tmpbase ) #this will force delete everything, careful
-    if do_checksums and post_checksums:
+        # The hash tmpdir is shared with concurrent syncfile calls, leave it
+        # for cleantmpbase to remove
+
+
+def _syncfile_checksums( plan ):
+    if plan.do_checksums and plan.syncopts[ 'post_checksums' ]:
         # Compare checksums to verify target file was written accurately
-        src_checksum = src_path.checksum()
-        tgt_checksum = tgt_path.checksum()
+        src_path = plan.src_path
+        tgt_path = plan.tgt_path
+        with _Phase( 'syncfile.checksum' ):
+            src_checksum = src_path.checksum()
+            tgt_checksum = tgt_path.checksum()
         if src_checksum != tgt_checksum:
             reason = 'Checksum mismatch'
             origin = 'src_file={sf}, tgt_file={tf}, '\
                      'src_checksum={sc}, tgt_checksum={tc}'.format(
                         sf=src_path, tf=tgt_path, sc=src_checksum, tc=tgt_checksum )
             raise SyncError( reason, origin )
-    return ( tmp_path, sync_action )
 
 
-def rmdir( path ):
-    # could call os.walk() and remove everything
-    # faster would be to move path to a known DELETEME dir and delete it later
-    raise UserWarning( 'Not Implemented' )
+def rmdir( path, trash=None, workers=8 ):
+    """
+    Remove the directory tree at path (similar to "rm -rf", but faster)
+    The tree is first renamed into the trash directory, so that it disappears
+    from the namespace immediately, then its contents are deleted bottom-up by
+    a pool of worker threads.  Symlinks are never followed (a symlink is
+    removed, never the thing it points to).
+    :param path     str: directory to remove
+    :param trash    str: OPTIONAL existing directory, on the same filesystem as
+                         path, to hold the tree while it is deleted
+                         (default is the parent directory of path)
+    :param workers  int: number of parallel unlink/rmdir threads (default=8)
+    :return int: number of filesystem entries removed
+    """
+    path = os.path.abspath( path )
+    try:
+        st = os.lstat( path )
+    except ( OSError ) as e:
+        raise RmdirError( reason=str( e ), origin=e )
+    if not stat.S_ISDIR( st.st_mode ):
+        raise RmdirError( reason='Not a directory', origin=path )
+    if trash is None:
+        trash = os.path.dirname( path )
+    doomed = os.path.join( trash, '.pylutrm.{0}'.format( uuid.uuid4().hex ) )
+    log.debug( 'rename {0} -> {1}'.format( path, doomed ) )
+    try:
+        os.rename( path, doomed )
+    except ( OSError ) as e:
+        raise RmdirError(
+            reason='Unable to move {0} to trash {1}'.format( path, trash ),
+            origin=e )
+    return _TreeRemover( workers ).remove( doomed )
+
+
+def cleantmpbase( tmpbase, needed=None, workers=8 ):
+    """
+    Remove tmp files (created by syncfile with keeptmp=True) from tmpbase
+    A tmp file is named for the FID of its source file and is only kept as a
+    hardlink anchor for the remaining links of that source file.  Tmp files
+    for which needed( fid ) returns False are unlinked; hash directories left
+    empty are removed.  If needed is None, all tmp files are removed.
+    tmpbase itself is not removed.
+    :param tmpbase  str: same tmpbase that was passed to syncfile
+    :param needed  func: OPTIONAL callable( fid ) returning True if the tmp
+                         file for fid must be kept
+    :param workers  int: number of parallel threads (default=8)
+    :return int: number of tmp files removed
+    """
+    def _clean_tmpdir( tmpdir ):
+        removed = 0
+        with os.scandir( tmpdir ) as it:
+            for entry in it:
+                if needed is not None and needed( entry.name ):
+                    continue
+                if entry.is_dir( follow_symlinks=False ):
+                    removed += _TreeRemover( 1 ).remove( entry.path )
+                else:
+                    os.unlink( entry.path )
+                    removed += 1
+        _rmdir_if_empty( tmpdir )
+        return removed
+
+    with os.scandir( tmpbase ) as it:
+        tmpdirs = [ e.path for e in it if e.is_dir( follow_symlinks=False ) ]
+    with concurrent.futures.ThreadPoolExecutor( workers ) as pool:
+        return sum( pool.map( _clean_tmpdir, tmpdirs ) )
+
+
+class _TreeRemover( object ):
+    """
+    Parallel bottom-up removal of a directory tree
+    Each directory is scanned by one task, non-directory entries are unlinked
+    in batches and subdirectories are scanned as new tasks.  A directory is
+    removed as soon as the last task referencing it has finished.
+    """
+
+    # number of entries to unlink per task
+    unlink_batchsize = 1000
+
+    def __init__( self, workers ):
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.pending = {}   #dirpath -> [ num_tasks, parent_dirpath ]
+        self.finished = threading.Event()
+        self.removed = 0
+        self.errors = []
+        self.pool = None
+
+    def remove( self, top ):
+        self.pool = concurrent.futures.ThreadPoolExecutor( self.workers )
+        try:
+            self._add_dir( top, None )
+            self.finished.wait()
+        finally:
+            self.pool.shutdown()
+        if self.errors:
+            raise RmdirError(
+                reason='{0} errors removing {1}'.format( len( self.errors ), top ),
+                origin=self.errors )
+        return self.removed
+
+    def _add_dir( self, path, parent ):
+        with self.lock:
+            self.pending[ path ] = [ 1, parent ]
+            if parent is not None:
+                self.pending[ parent ][ 0 ] += 1
+        self.pool.submit( self._task, self._scan, path, path )
+
+    def _task( self, fn, path, *args ):
+        # Run one task, then always drop its reference to path, so that
+        # remove() can't wait forever on a task that died unexpectedly
+        try:
+            fn( *args )
+        except ( Exception ) as e:
+            self._error( e )
+        finally:
+            self._release( path )
+
+    def _scan( self, path ):
+        batch = []
+        try:
+            with os.scandir( path ) as it:
+                for entry in it:
+                    if entry.is_dir( follow_symlinks=False ):
+                        self._add_dir( entry.path, path )
+                        continue
+                    batch.append( entry.path )
+                    if len( batch ) >= self.unlink_batchsize:
+                        self._add_unlink( batch, path )
+                        batch = []
+        except ( OSError ) as e:
+            self._error( e )
+        if batch:
+            self._unlink( batch )
+
+    def _add_unlink( self, paths, parent ):
+        with self.lock:
+            self.pending[ parent ][ 0 ] += 1
+        self.pool.submit( self._task, self._unlink, parent, paths )
+
+    def _unlink( self, paths ):
+        count = 0
+        for p in paths:
+            try:
+                os.unlink( p )
+                count += 1
+            except ( OSError ) as e:
+                self._error( e )
+        with self.lock:
+            self.removed += count
+
+    def _release( self, path ):
+        # Drop one reference to path, rmdir it (and possibly its ancestors)
+        # once no tasks refer to it anymore
+        while path is not None:
+            with self.lock:
+                info = self.pending[ path ]
+                info[ 0 ] -= 1
+                if info[ 0 ] > 0:
+                    return
+                del self.pending[ path ]
+            try:
+                os.rmdir( path )
+                with self.lock:
+                    self.removed += 1
+            except ( Exception ) as e:
+                self._error( e )
+            path = info[ 1 ]
+        self.finished.set()
+
+    def _error( self, e ):
+        log.debug( 'error during tree removal: {0}'.format( e ) )
+        with self.lock:
+            self.errors.append( e )
+
+
+def _rmdir_if_empty( path ):
+    """
+    Remove directory path if it is empty, silently ignore if it is not empty
+    or doesn't exist
+    """
+    try:
+        os.rmdir( path )
+    except ( OSError ) as e:
+        # OSError: [Errno 2] No such file or directory
+        # OSError: [Errno 39] Directory not empty
+        if e.errno not in ( errno.ENOENT, errno.ENOTEMPTY, errno.EEXIST ):
+            raise e
 
 
 def syncdir( src_path, tgt_path,
@@ -553,6 +1297,8 @@ def _compare_files( f1, f2, syncopts ):
     if f2.ctime > f1.ctime:
         return( data_ok, meta_ok )
     # Check for data changes
+    # (for FSItems using faststat, this is where the accurate size and mtime
+    #  get fetched, only when the ctime check above didn't already decide)
     if f1.size != f2.size:
         data_ok = False
     elif syncopts[ 'synctimes' ] and f1.mtime != f2.mtime:
@@ -603,6 +1349,8 @@ class PylutError( Exception ):
 
 class SyncError( PylutError ): pass
 
+class RmdirError( PylutError ): pass
+
 class LustreStripeInfoError( PylutError ): pass
 
 
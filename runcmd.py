@@ -1,17 +1,26 @@
 #!/bin/env python
 
+import os
+import signal
+import asyncio
 import subprocess
+import threading
 import logging
+import re
+import metrics
+import tracing
 
 log = logging.getLogger( __name__ )
 
 
 class Run_Cmd_Error( Exception ):
-    def __init__( self, code, reason, cmd, *a, **k ):
+    def __init__( self, code, reason, cmd, output=None, *a, **k ):
         super( Run_Cmd_Error, self ).__init__( *a, **k )
         self.code = code
         self.reason = reason
         self.cmd = cmd
+        # stdout of the failed command, if it was collected
+        self.output = output
 
     def __repr__( self ):
         return "<{0} (code={1} msg={2} cmd={3})>".format(
@@ -20,7 +29,22 @@ class Run_Cmd_Error( Exception ):
     __str__ = __repr__
 
 
-def runcmd( cmdlist, opts=None, args=None ):
+class Run_Cmd_Timeout( Run_Cmd_Error ): pass
+
+
+# see set_pool
+_pool = None
+
+def set_pool( pool ):
+    """ Route all runcmd() calls through pool (ie: cmdpool.CmdPool), so
+        this process doesn't fork for each command; None to go back to
+        running commands directly
+    """
+    global _pool
+    _pool = pool
+
+
+def runcmd( cmdlist, opts=None, args=None, timeout=None ):
     """ Run a command on the linux command line.
         INPUTS:
           cmdlist   = list - command to run
@@ -28,25 +52,221 @@ def runcmd( cmdlist, opts=None, args=None ):
                              subcommands, they go here)
           opts      = dict - converted to key=value args
           args      = list - converted to cmdline args
+          timeout   = float - OPTIONAL seconds to wait for the command
         OUTPUTS:
           tuple = ( stdout, stderr )
         NOTES:
           opts and args are used as-is, if elements are expected to be
           prefixed with a dash or multiple dashes, you must add them
           yourself.
+          If timeout is given, the command runs in its own session (process
+          group); if it runs longer than timeout, that whole process group
+          is killed and Run_Cmd_Timeout is raised.  Without a timeout the
+          command stays in the caller's process group, so Ctrl-C and
+          signals sent to the group reach it too.
+          If a pool was set with set_pool(), the command is run by the pool.
     """
-    if opts is not None:
-        cmdlist.extend( [ "{0}={1}".format( k, v ) for k, v in opts.items() ] )
-    if args is not None:
-        cmdlist.extend( map( str, args ) )
-    log.debug( "cmdlist: {0}".format( cmdlist ) )
-    subp = subprocess.Popen( cmdlist, stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE )
+    _buildcmd( cmdlist, opts, args )
+    name = _metricname( cmdlist )
+    with metrics.timer( name ), tracing.span( name, cat='runcmd', cmd=cmdlist ):
+        if _pool is not None:
+            return _pool.run( cmdlist, timeout=timeout )
+        return _runcmd( cmdlist, timeout )
+
+
+def _runcmd( cmdlist, timeout ):
+    group = timeout is not None
+    subp = _popen( cmdlist, group )
     log.debug( "about to call subp.communicate..." )
-    ( output, errput ) = subp.communicate()
+    try:
+        ( output, errput ) = subp.communicate( timeout=timeout )
+    except ( subprocess.TimeoutExpired ):
+        _kill( subp, group )
+        ( output, errput ) = subp.communicate()
+        raise( Run_Cmd_Timeout( code=subp.returncode,
+            reason='timeout after {0}s'.format( timeout ), cmd=' '.join( cmdlist ) ) )
+    except BaseException:
+        # KeyboardInterrupt etc, don't leave the command behind
+        _kill( subp, group )
+        raise
     log.debug( "finished" )
     rc = subp.returncode
     log.debug( "got returncode '{0}'".format( rc ) )
     if rc != 0:
-        raise( Run_Cmd_Error( code=rc, reason=errput, cmd=' '.join( cmdlist ) ) )
+        raise( Run_Cmd_Error( code=rc, reason=errput, cmd=' '.join( cmdlist ),
+                              output=output ) )
+    return ( output, errput )
+
+
+def runcmd_stream( cmdlist, opts=None, args=None, sep=b'\n', bufsize=65536,
+                   timeout=None ):
+    """ Run a command on the linux command line, yielding stdout as it arrives
+        INPUTS:
+          cmdlist   = list - command to run (same as runcmd)
+          opts      = dict - converted to key=value args (same as runcmd)
+          args      = list - converted to cmdline args (same as runcmd)
+          sep       = bytes - record separator (ie: b'\0' for -print0 output)
+                              if None, raw chunks are yielded as read
+          bufsize   = int - max bytes read from stdout at once
+          timeout   = float - OPTIONAL max seconds for the whole command
+        OUTPUTS:
+          generator of records (bytes, without sep)
+        NOTES:
+          Memory use is constant, only the current chunk of stdout is held.
+          stderr is drained in a thread so the command can't block on it.
+          Raises Run_Cmd_Error after the last record if the command failed,
+          Run_Cmd_Timeout if it ran longer than timeout.
+          Closing the generator early kills the command.  If timeout is
+          given, the command runs in its own session and a timeout (or
+          closing early) kills its whole process group.
+    """
+    _buildcmd( cmdlist, opts, args )
+    name = _metricname( cmdlist )
+    with metrics.timer( name ), tracing.span( name, cat='runcmd', cmd=cmdlist ):
+        yield from _runcmd_stream( cmdlist, sep, bufsize, timeout )
+
+
+def _runcmd_stream( cmdlist, sep, bufsize, timeout ):
+    group = timeout is not None
+    subp = _popen( cmdlist, group )
+    errchunks = []
+    errthread = threading.Thread( target=lambda: errchunks.append( subp.stderr.read() ) )
+    errthread.daemon = True
+    errthread.start()
+    timer = None
+    timedout = threading.Event()
+    if timeout is not None:
+        def _expire():
+            timedout.set()
+            _kill( subp, group )
+        timer = threading.Timer( timeout, _expire )
+        timer.daemon = True
+        timer.start()
+    try:
+        tail = b''
+        for chunk in iter( lambda: subp.stdout.read1( bufsize ), b'' ):
+            if sep is None:
+                yield chunk
+                continue
+            records = ( tail + chunk ).split( sep )
+            tail = records.pop()
+            for rec in records:
+                yield rec
+        rc = subp.wait()
+        if timedout.is_set():
+            raise( Run_Cmd_Timeout( code=rc,
+                reason='timeout after {0}s'.format( timeout ), cmd=' '.join( cmdlist ) ) )
+        if len( tail ) > 0:
+            yield tail
+    finally:
+        if timer is not None:
+            timer.cancel()
+        if subp.returncode is None:
+            _kill( subp, group )
+        subp.stdout.close()
+        errthread.join()
+        subp.stderr.close()
+    log.debug( "got returncode '{0}'".format( rc ) )
+    if rc != 0:
+        raise( Run_Cmd_Error( code=rc, reason=b''.join( errchunks ),
+                              cmd=' '.join( cmdlist ) ) )
+
+
+async def runcmd_async( cmdlist, opts=None, args=None, timeout=None, limit=None ):
+    """ asyncio version of runcmd
+        INPUTS:
+          cmdlist, opts, args, timeout - same as runcmd
+          limit     = asyncio.Semaphore - OPTIONAL, held while the command
+                      runs; share one semaphore between all commands that
+                      count against the same concurrency limit
+        OUTPUTS:
+          tuple = ( stdout, stderr )
+        NOTES:
+          Many commands can be in flight from a single thread.  If the
+          awaiting task is cancelled, the command is killed.  If timeout is
+          given, the command runs in its own session and a timeout (or
+          cancel) kills its whole process group.
+    """
+    _buildcmd( cmdlist, opts, args )
+    name = _metricname( cmdlist )
+    if limit is None:
+        with metrics.timer( name ), tracing.span( name, cat='runcmd', cmd=cmdlist ):
+            return await _runcmd_async( cmdlist, timeout )
+    async with limit:
+        with metrics.timer( name ), tracing.span( name, cat='runcmd', cmd=cmdlist ):
+            return await _runcmd_async( cmdlist, timeout )
+
+
+async def _runcmd_async( cmdlist, timeout ):
+    group = timeout is not None
+    subp = await asyncio.create_subprocess_exec( *cmdlist,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        start_new_session=group )
+    try:
+        ( output, errput ) = await asyncio.wait_for( subp.communicate(), timeout )
+    except ( asyncio.TimeoutError ):
+        await _kill_async( subp, group )
+        raise( Run_Cmd_Timeout( code=subp.returncode,
+            reason='timeout after {0}s'.format( timeout ), cmd=' '.join( cmdlist ) ) )
+    except BaseException:
+        # cancelled, don't leave the command behind
+        await _kill_async( subp, group )
+        raise
+    rc = subp.returncode
+    log.debug( "got returncode '{0}'".format( rc ) )
+    if rc != 0:
+        raise( Run_Cmd_Error( code=rc, reason=errput, cmd=' '.join( cmdlist ),
+                              output=output ) )
     return ( output, errput )
+
+
+async def _kill_async( subp, group ):
+    _signal( subp, group )
+    await subp.wait()
+
+
+_subcommand = re.compile( '^[a-z][a-z0-9_]*$' )
+
+def _metricname( cmdlist ):
+    """ Metric name for the kind of command, ie: runcmd.lfs.getstripe
+    """
+    parts = [ 'runcmd', os.path.basename( cmdlist[0] ) ]
+    if len( cmdlist ) > 1 and _subcommand.match( cmdlist[1] ):
+        parts.append( cmdlist[1] )
+    return '.'.join( parts )
+
+
+def _buildcmd( cmdlist, opts, args ):
+    if opts is not None:
+        cmdlist.extend( [ "{0}={1}".format( k, v ) for k, v in opts.items() ] )
+    if args is not None:
+        cmdlist.extend( map( str, args ) )
+    log.debug( "cmdlist: {0}".format( cmdlist ) )
+
+
+def _popen( cmdlist, group ):
+    # group: own session (process group), so children of the command can be
+    # killed too; only used where needed, as the command then no longer
+    # gets the signals (ie: Ctrl-C) sent to the caller's process group
+    return subprocess.Popen( cmdlist, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, start_new_session=group )
+
+
+def _kill( subp, group ):
+    """ Kill subp (its whole process group if group) and reap it
+    """
+    _signal( subp, group )
+    subp.wait()
+
+
+def _signal( subp, group ):
+    try:
+        if group:
+            log.debug( "killing process group {0}".format( subp.pid ) )
+            os.killpg( subp.pid, signal.SIGKILL )
+        else:
+            log.debug( "killing process {0}".format( subp.pid ) )
+            subp.kill()
+    except ( OSError ):
+        # already gone
+        pass
@@ -0,0 +1,300 @@
+import time
+import logging
+import threading
+import concurrent.futures
+import metrics
+import pylut
+from runcmd import Run_Cmd_Error
+
+log = logging.getLogger( __name__ )
+
+# Default cap on the bytes being copied from (or to) one OST at a time
+DEFAULT_OST_BYTES = 256 * 1024 * 1024
+
+
+def stripe_bytes( size, count, stripesize ):
+    """
+    Split size bytes over the stripes of a RAID0 layout
+    :param size int: file size
+    :param count int: number of stripes (objects)
+    :param stripesize int: bytes per stripe chunk
+    :return list: bytes stored in each stripe object, in stripe order
+    """
+    if not count or count < 1 or not size:
+        return []
+    stripesize = int( stripesize or size )
+    ( full, rest ) = divmod( int( size ), stripesize )
+    ( rounds, extra ) = divmod( full, count )
+    rv = []
+    for k in range( count ):
+        n = ( rounds + ( 1 if k < extra else 0 ) ) * stripesize
+        if k == extra:
+            n += rest
+        rv.append( n )
+    return rv
+
+
+def ost_bytes( stripeinfo, size ):
+    """
+    Bytes of a file stored on each OST, from LustreStripeInfo.index_info
+    :return dict: OST index -> bytes (empty if the layout lists no objects,
+                  ie: the file is not on Lustre)
+    """
+    if not stripeinfo.index_info:
+        return {}
+    osts = [ i[ pylut.LustreStripeInfo.index_obdidx ] for i in stripeinfo.index_info ]
+    rv = {}
+    for ost, n in zip( osts, stripe_bytes( size, len( osts ), stripeinfo.size ) ):
+        if n:
+            rv[ ost ] = rv.get( ost, 0 ) + n
+    return rv
+
+
+class _Job( object ):
+    """ One syncfile call waiting to be dispatched, with its per OST cost
+    """
+    __slots__ = ( 'src', 'tgt', 'src_bytes', 'tgt_stripes', 'offset', 'tgt_bytes',
+                  'queued', 'skips' )
+
+    def __init__( self, src, tgt, src_bytes, tgt_stripes ):
+        self.src = src
+        self.tgt = tgt
+        self.src_bytes = src_bytes
+        self.tgt_stripes = tgt_stripes
+        self.offset = None
+        self.tgt_bytes = {}
+        self.queued = time.monotonic()
+        self.skips = 0
+
+
+class OstScheduler( object ):
+    """
+    Run pylut.syncfile for many files with a pool of threads, dispatching
+    them so that no single OST is oversubscribed
+    Every file's size is split over the OSTs in its source layout
+    (LustreStripeInfo.index_info), and the scheduler keeps the sum of bytes
+    in flight per source OST and per target OST.  From a window of pending
+    files it dispatches the oldest one whose OSTs all stay under
+    max_ost_bytes (an idle OST always accepts one file, however large).
+    Files held back too often (maxskips) stop later files from overtaking
+    them, so big files on a busy OST are delayed, not starved.
+    The target layout is chosen here too, if tgt_osts (the number of OSTs
+    of the target filesystem) is given: new target files get the source
+    stripe count and size, with the first stripe (stripe_offset) on the
+    least loaded run of target OSTs.  Without tgt_osts Lustre places target
+    files and only the source side is balanced.
+    Decisions are recorded with metrics (when enabled):
+      scheduler.dispatched                   counter, files started
+      scheduler.deferred{side,ost}           counter, times a file was held
+                                             back because of that OST
+      scheduler.stalls                       counter, times nothing could be
+                                             dispatched and the scheduler waited
+      scheduler.ost_bytes{side,ost}          counter, bytes dispatched per OST
+      scheduler.inflight_bytes{side,ost}     gauge, bytes in flight per OST
+      scheduler.running, scheduler.pending   gauges, files in flight / waiting
+      scheduler.queue_wait                   histogram, seconds from queued to
+                                             dispatched
+    """
+
+    def __init__( self, workers=8, max_ost_bytes=DEFAULT_OST_BYTES, tgt_osts=None,
+                  window=256, maxskips=64, syncfile=None ):
+        """
+        :param workers       int: max number of syncfile calls in flight
+        :param max_ost_bytes int: cap on bytes in flight per OST
+        :param tgt_osts      int: OPTIONAL number of OSTs of the target
+                                  filesystem, enables target placement
+        :param window        int: number of pending files considered at once
+        :param maxskips      int: times a file may be overtaken
+        :param syncfile     func: OPTIONAL called instead of pylut.syncfile
+                                  (same signature)
+        """
+        self.workers = workers
+        self.max_ost_bytes = max_ost_bytes
+        self.tgt_osts = tgt_osts
+        self.window = window
+        self.maxskips = maxskips
+        self.syncfile = syncfile if syncfile is not None else pylut.syncfile
+        self._cond = threading.Condition()
+        self._inflight = { 'src': {}, 'tgt': {} }
+        self._running = 0
+        self._rr = 0
+
+
+    def sync( self, pairs, tmpbase, **syncopts ):
+        """
+        Sync files, in roughly the given order
+        :param pairs iterable: ( src FSItem, tgt FSItem ) tuples, regular
+                               files or links (directories must exist)
+        :param tmpbase str: passed to syncfile
+        :param syncopts: passed to syncfile
+        :return dict: counts of 'synced', 'data_copy' and 'bytes' (copied) and
+                      a list of 'errors'
+        """
+        rv = { 'synced': 0, 'data_copy': 0, 'bytes': 0, 'errors': [] }
+        pairs = iter( pairs )
+        pending = []
+        exhausted = False
+        # futures of calls that raised something syncfile errors don't cover
+        failed = set()
+        def _done( f ):
+            if f.exception() is not None:
+                failed.add( f )
+        with concurrent.futures.ThreadPoolExecutor( self.workers ) as pool:
+            while True:
+                while not exhausted and len( pending ) < self.window:
+                    try:
+                        ( src, tgt ) = next( pairs )
+                    except ( StopIteration ):
+                        exhausted = True
+                        break
+                    pending.append( self._job( src, tgt ) )
+                if not pending:
+                    break
+                with self._cond:
+                    job = self._pick( pending )
+                    while job is None:
+                        metrics.incr( 'scheduler.stalls' )
+                        self._cond.wait()
+                        job = self._pick( pending )
+                    pending.remove( job )
+                    self._reserve( job )
+                    metrics.gauge( 'scheduler.pending', len( pending ) )
+                pool.submit( self._run, job, tmpbase, syncopts, rv ).add_done_callback( _done )
+        for f in failed:
+            f.result()
+        return rv
+
+
+    def _job( self, src, tgt ):
+        try:
+            si = src.stripeinfo()
+            size = src.size if src.is_regular() else 0
+        except ( OSError, Run_Cmd_Error ) as e:
+            # syncfile will report it
+            log.debug( 'no layout for {0}: {1}'.format( src, e ) )
+            return _Job( src, tgt, {}, [] )
+        src_bytes = ost_bytes( si, size )
+        count = len( si.index_info ) if si.index_info else ( si.count or 0 )
+        if self.tgt_osts and count < 0:
+            count = self.tgt_osts
+        return _Job( src, tgt, src_bytes, stripe_bytes( size, count, si.size ) )
+
+
+    def _pick( self, pending ):
+        """ Return first pending job that fits, None if none does (lock held)
+        """
+        if self._running >= self.workers:
+            return None
+        for job in pending:
+            ( offset, tgt_bytes ) = self._place( job )
+            blocked = self._blocked( 'src', job.src_bytes )
+            if blocked is None:
+                blocked = self._blocked( 'tgt', tgt_bytes )
+            if blocked is None:
+                job.offset = offset
+                job.tgt_bytes = tgt_bytes
+                return job
+            job.skips += 1
+            metrics.incr( 'scheduler.deferred',
+                          labels={ 'side': blocked[0], 'ost': blocked[1] } )
+            if job.skips > self.maxskips:
+                # no more overtaking, wait for its OSTs to drain
+                return None
+        return None
+
+
+    def _place( self, job ):
+        """
+        Choose the stripe offset for a new target file: the start of the run
+        of target OSTs with the smallest peak load once the file is added
+        :return two-tuple: ( offset or None, dict of target OST -> bytes )
+        """
+        if not self.tgt_osts or not job.tgt_stripes:
+            return ( None, {} )
+        n = self.tgt_osts
+        load = self._inflight[ 'tgt' ]
+        best = None
+        for i in range( n ):
+            o = ( self._rr + i ) % n
+            peak = max( load.get( ( o + k ) % n, 0 ) + b
+                        for k, b in enumerate( job.tgt_stripes ) )
+            if best is None or peak < best[0]:
+                best = ( peak, o )
+        offset = best[1]
+        tgt_bytes = {}
+        for k, b in enumerate( job.tgt_stripes ):
+            ost = ( offset + k ) % n
+            tgt_bytes[ ost ] = tgt_bytes.get( ost, 0 ) + b
+        return ( offset, tgt_bytes )
+
+
+    def _blocked( self, side, nbytes ):
+        """ Return ( side, ost ) of the first OST nbytes doesn't fit on, or None
+        """
+        load = self._inflight[ side ]
+        for ost, b in nbytes.items():
+            busy = load.get( ost, 0 )
+            if busy and busy + b > self.max_ost_bytes:
+                return ( side, ost )
+        return None
+
+
+    def _reserve( self, job ):
+        self._running += 1
+        if job.offset is not None:
+            self._rr = ( job.offset + len( job.tgt_stripes ) ) % self.tgt_osts
+        self._account( job, 1 )
+        metrics.incr( 'scheduler.dispatched' )
+        metrics.observe( 'scheduler.queue_wait', time.monotonic() - job.queued )
+        for side, nbytes in ( ( 'src', job.src_bytes ), ( 'tgt', job.tgt_bytes ) ):
+            for ost, b in nbytes.items():
+                metrics.incr( 'scheduler.ost_bytes', b, labels={ 'side': side, 'ost': ost } )
+
+
+    def _release( self, job ):
+        with self._cond:
+            self._running -= 1
+            self._account( job, -1 )
+            self._cond.notify()
+
+
+    def _account( self, job, sign ):
+        for side, nbytes in ( ( 'src', job.src_bytes ), ( 'tgt', job.tgt_bytes ) ):
+            load = self._inflight[ side ]
+            for ost, b in nbytes.items():
+                load[ ost ] = load.get( ost, 0 ) + sign * b
+                if load[ ost ] == 0:
+                    del load[ ost ]
+                metrics.gauge( 'scheduler.inflight_bytes', load.get( ost, 0 ),
+                               labels={ 'side': side, 'ost': ost } )
+        metrics.gauge( 'scheduler.running', self._running )
+
+
+    def inflight( self ):
+        """
+        Return copy of the bytes in flight:
+        { 'src': { ost: bytes }, 'tgt': { ost: bytes } }
+        """
+        with self._cond:
+            return dict( ( k, dict( v ) ) for k, v in self._inflight.items() )
+
+
+    def _run( self, job, tmpbase, syncopts, rv ):
+        try:
+            ( tmp, action ) = self.syncfile( job.src, job.tgt, tmpbase=tmpbase,
+                                             stripe_offset=job.offset, **syncopts )
+        except ( OSError, pylut.PylutError, Run_Cmd_Error ) as e:
+            with self._cond:
+                rv[ 'errors' ].append( e )
+        else:
+            with self._cond:
+                rv[ 'synced' ] += 1
+                if action[ 'data_copy' ]:
+                    rv[ 'data_copy' ] += 1
+                    rv[ 'bytes' ] += job.src.size
+        finally:
+            self._release( job )
+
+
+if __name__ == '__main__':
+    raise UserWarning( 'Cmdline not supported' )
@@ -0,0 +1,147 @@
+import os
+import ctypes
+import logging
+
+log = logging.getLogger( __name__ )
+
+# Field mask bits, see statx(2)
+STATX_TYPE        = 0x00000001
+STATX_MODE        = 0x00000002
+STATX_NLINK       = 0x00000004
+STATX_UID         = 0x00000008
+STATX_GID         = 0x00000010
+STATX_ATIME       = 0x00000020
+STATX_MTIME       = 0x00000040
+STATX_CTIME       = 0x00000080
+STATX_INO         = 0x00000100
+STATX_SIZE        = 0x00000200
+STATX_BLOCKS      = 0x00000400
+STATX_BASIC_STATS = 0x000007ff
+
+# Fields that can be answered by the Lustre MDS alone; size, blocks, atime
+# and mtime require a glimpse of every OST object of the file
+STATX_MDS_ONLY = STATX_TYPE | STATX_MODE | STATX_INO | STATX_NLINK | \
+                 STATX_UID | STATX_GID | STATX_CTIME
+
+AT_FDCWD            = -100
+AT_SYMLINK_NOFOLLOW = 0x100
+AT_STATX_DONT_SYNC  = 0x4000
+
+
+class _StatxTimestamp( ctypes.Structure ):
+    _fields_ = [ ( 'tv_sec', ctypes.c_int64 ),
+                 ( 'tv_nsec', ctypes.c_uint32 ),
+                 ( '_reserved', ctypes.c_int32 ), ]
+
+
+class _Statx( ctypes.Structure ):
+    _fields_ = [ ( 'stx_mask', ctypes.c_uint32 ),
+                 ( 'stx_blksize', ctypes.c_uint32 ),
+                 ( 'stx_attributes', ctypes.c_uint64 ),
+                 ( 'stx_nlink', ctypes.c_uint32 ),
+                 ( 'stx_uid', ctypes.c_uint32 ),
+                 ( 'stx_gid', ctypes.c_uint32 ),
+                 ( 'stx_mode', ctypes.c_uint16 ),
+                 ( '_spare0', ctypes.c_uint16 ),
+                 ( 'stx_ino', ctypes.c_uint64 ),
+                 ( 'stx_size', ctypes.c_uint64 ),
+                 ( 'stx_blocks', ctypes.c_uint64 ),
+                 ( 'stx_attributes_mask', ctypes.c_uint64 ),
+                 ( 'stx_atime', _StatxTimestamp ),
+                 ( 'stx_btime', _StatxTimestamp ),
+                 ( 'stx_ctime', _StatxTimestamp ),
+                 ( 'stx_mtime', _StatxTimestamp ),
+                 ( 'stx_rdev_major', ctypes.c_uint32 ),
+                 ( 'stx_rdev_minor', ctypes.c_uint32 ),
+                 ( 'stx_dev_major', ctypes.c_uint32 ),
+                 ( 'stx_dev_minor', ctypes.c_uint32 ),
+                 ( '_spare2', ctypes.c_uint64 * 14 ), ]
+
+
+def _load_statx():
+    try:
+        libc = ctypes.CDLL( None, use_errno=True )
+        fn = libc.statx
+    except ( OSError, AttributeError ) as e:
+        log.debug( 'statx not available: {0}'.format( e ) )
+        return None
+    fn.argtypes = [ ctypes.c_int, ctypes.c_char_p, ctypes.c_int,
+                    ctypes.c_uint, ctypes.POINTER( _Statx ) ]
+    fn.restype = ctypes.c_int
+    return fn
+
+_statx = _load_statx()
+
+
+def available():
+    """ Return True if the statx system call can be used
+    """
+    return _statx is not None
+
+
+def statx( path, mask=STATX_BASIC_STATS, flags=AT_SYMLINK_NOFOLLOW ):
+    """
+    Call statx(2) on path, requesting only the fields in mask
+    Does not follow symlinks (same as os.lstat) unless flags says otherwise.
+    Falls back to os.lstat if statx is not available.
+    :param path str: path to stat
+    :param mask int: bitwise OR of STATX_* fields that are needed
+    :param flags int: AT_* flags
+    :return os.stat_result: fields that were not returned by the filesystem
+                            (not in the returned stx_mask) are None
+    """
+    if _statx is None:
+        return os.lstat( path )
+    buf = _Statx()
+    rc = _statx( AT_FDCWD, os.fsencode( path ), flags, mask, ctypes.byref( buf ) )
+    if rc != 0:
+        err = ctypes.get_errno()
+        raise OSError( err, os.strerror( err ), path )
+    return _to_stat_result( buf )
+
+
+def _to_stat_result( buf ):
+    got = buf.stx_mask
+    def _field( bit, val ):
+        if got & bit:
+            return val
+        return None
+    def _times( bit, ts ):
+        if got & bit:
+            return ( ts.tv_sec, ts.tv_sec + ts.tv_nsec * 1e-9,
+                     ts.tv_sec * 1000000000 + ts.tv_nsec )
+        return ( None, None, None )
+    atime = _times( STATX_ATIME, buf.stx_atime )
+    mtime = _times( STATX_MTIME, buf.stx_mtime )
+    ctime = _times( STATX_CTIME, buf.stx_ctime )
+    mode = None
+    if got & ( STATX_TYPE | STATX_MODE ):
+        mode = buf.stx_mode
+    dev = os.makedev( buf.stx_dev_major, buf.stx_dev_minor )
+    return os.stat_result(
+        ( mode,
+          _field( STATX_INO, buf.stx_ino ),
+          dev,
+          _field( STATX_NLINK, buf.stx_nlink ),
+          _field( STATX_UID, buf.stx_uid ),
+          _field( STATX_GID, buf.stx_gid ),
+          _field( STATX_SIZE, buf.stx_size ),
+          atime[0], mtime[0], ctime[0] ),
+        { 'st_atime': atime[1], 'st_mtime': mtime[1], 'st_ctime': ctime[1],
+          'st_atime_ns': atime[2], 'st_mtime_ns': mtime[2], 'st_ctime_ns': ctime[2],
+          'st_blksize': buf.stx_blksize,
+          'st_blocks': _field( STATX_BLOCKS, buf.stx_blocks ),
+          'st_rdev': os.makedev( buf.stx_rdev_major, buf.stx_rdev_minor ), } )
+
+
+def faststat( path ):
+    """
+    Stat path asking only for fields the Lustre MDS can answer
+    (STATX_MDS_ONLY), size, blocks, atime and mtime will be None
+    """
+    return statx( path, mask=STATX_MDS_ONLY,
+                  flags=AT_SYMLINK_NOFOLLOW | AT_STATX_DONT_SYNC )
+
+
+if __name__ == '__main__':
+    raise UserWarning( 'Cmdline not supported' )
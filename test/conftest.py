@@ -1,7 +1,72 @@
 import pytest
+import os
+import backend
+import metrics
+import pylut
 import pstestdir
 
 @pytest.fixture( scope="module" )
 def testdir():
     pstestdir.reset()
     return pstestdir
+
+
+def _mktree( top, depth=3, fanout=3, nfiles=5, filename='f{0}', size=None,
+             symlink=False ):
+    """
+    Create a small directory tree: nfiles files per directory (file i has
+    i bytes, or size bytes if given), fanout subdirectories "d<i>" per level
+    and, if symlink, a link "link" -> f0 in each directory
+    Return list of all paths, top first
+    """
+    paths = [ top ]
+    os.makedirs( top )
+    for i in range( nfiles ):
+        p = os.path.join( top, filename.format( i ) )
+        with open( p, 'wb' ) as fh:
+            fh.write( b'x' * ( i if size is None else size ) )
+        paths.append( p )
+    if symlink:
+        os.symlink( filename.format( 0 ), os.path.join( top, 'link' ) )
+        paths.append( os.path.join( top, 'link' ) )
+    if depth > 0:
+        for i in range( fanout ):
+            paths.extend( _mktree( os.path.join( top, 'd{0}'.format( i ) ),
+                                   depth - 1, fanout, nfiles, filename, size, symlink ) )
+    return paths
+
+
+@pytest.fixture
+def mktree():
+    """ Tree builder, see _mktree """
+    return _mktree
+
+
+@pytest.fixture
+def sim( tmp_path ):
+    """ tmp_path handled by a simulated Lustre backend with 4 OSTs """
+    root = str( tmp_path )
+    b = backend.SimBackend( root, osts=4 )
+    backend.register( root, b )
+    yield b
+    backend.unregister( root )
+
+
+@pytest.fixture
+def recording():
+    """ metrics enabled, starting from an empty registry """
+    metrics.reset()
+    metrics.enable()
+    yield metrics
+    metrics.disable()
+    metrics.reset()
+
+
+@pytest.fixture
+def rsync( monkeypatch ):
+    """ path to rsync, the bench stand-in if PYLUTRSYNCPATH doesn't exist """
+    if not os.path.exists( pylut.env[ 'PYLUTRSYNCPATH' ] ):
+        monkeypatch.setitem( pylut.env, 'PYLUTRSYNCPATH', os.path.join(
+            os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ),
+            'bench', 'fakersync' ) )
+    return pylut.env[ 'PYLUTRSYNCPATH' ]
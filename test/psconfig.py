@@ -25,3 +25,22 @@ CHMOD_CHOICES     = [0o777,0o775,0o755,0o770,0o750,0o700,
 
 PERMS_ACL_USERS = ['aloftus']
 PERMS_ACL_GROUPS = [ 'users' ]
+
+# Generator settings (see pstestdir.py)
+WORKERS    = 8
+BATCH_SIZE = 256
+# min, max subdirectories per directory
+DIR_FANOUT = ( 1, 8 )
+# pareto shape for how files spread over directories (lower is more skewed)
+DIR_FILE_SKEW = 1.5
+# list of ( weight, min bytes, max bytes ), empty: uniform up to MAX_FILE_SIZE
+SIZE_DISTRIBUTION = []
+# roughly what a scratch filesystem looks like: mostly small files, a long tail
+REALISTIC_SIZES = [ ( 40, 0, 4*1024 ),
+                    ( 35, 4*1024, 1024*1024 ),
+                    ( 20, 1024*1024, 64*1024*1024 ),
+                    ( 5, 64*1024*1024, 1024*1024*1024 ) ]
+# set to False on filesystems without "lfs setstripe"
+SET_STRIPES = True
+# if set, reset() writes a manifest of the tree to this file
+MANIFEST = None
@@ -1,32 +1,52 @@
 # Code to create a randomized directory structure for testing psync
 # Intent is to use this in a pytest fixture
+#
+# Trees are built in two steps:
+#   1. plan: every object (type, path, size, stripe info, perms, link target)
+#      is drawn from a random.Random seeded with config.SEED, so the same
+#      config always gives the same tree, whatever the number of workers
+#   2. create: directories level by level, then files, then links, in
+#      batches of config.BATCH_SIZE run by config.WORKERS threads; files
+#      of a batch with the same layout share one "lfs setstripe" call
+# The result is kept in objects/files/directories and can be written to
+# (and read back from) a manifest, so callers don't need to re-scan the tree.
 
-from __future__ import print_function
 from runcmd import runcmd
 
+import concurrent.futures
+import collections
+import itertools
 import psconfig
 import random
 import string
-import sys
+import json
+import math
+import zlib
 import os
-import socket
 import shutil
 import stat
 import pwd
 import grp
 import logging
 import pprint
-#import posix1e
 
 class FileObject( object ):
-    def __init__( self, path, typ, tgt ):
+    __slots__ = ( 'path', 'typ', 'tgt', '_stat', 'stripecount', 'stripesize' )
+
+    def __init__( self, path, typ, tgt, st=None ):
         self.path = path
         self.typ  = typ
         self.tgt  = tgt
-        self.stat = os.lstat( path )
+        self._stat = st
         self.stripecount = None
         self.stripesize = None
 
+    @property
+    def stat( self ):
+        if self._stat is None:
+            self._stat = os.lstat( self.path )
+        return self._stat
+
     def set_stripe_info( self, count, size=None ):
        self.stripecount = count
        self.stripesize = size
@@ -59,43 +79,282 @@ class FileObject( object ):
         return self.stat.st_ino
 
 
-def weighted_picks(sequence, relative_odds):
-    table = [ z for x, y in zip(sequence, relative_odds) for z in [x]*y ]
-    while True:
-        yield random.choice(table)
+class _ManifestStat( object ):
+    """ The lstat fields kept in a manifest, stands in for os.stat_result
+    """
+    __slots__ = ( 'st_ino', 'st_mode', 'st_size' )
+
+    def __init__( self, ino, mode, size ):
+        self.st_ino = ino
+        self.st_mode = mode
+        self.st_size = size
+
+
+# One planned object
+#   typ: one of 'd', 'f', 'p', 's', 'l' (symlink) or 'h' (hardlink)
+#   tgt: symlink target, or path of the hardlink target
+#   stripe: ( count, size ) or None
+#   mode, uid, gid: None means leave as created
+_Entry = collections.namedtuple( '_Entry',
+    ( 'typ', 'path', 'tgt', 'size', 'stripe', 'mode', 'uid', 'gid', 'depth' ) )
+
+NAME_CHARS = string.ascii_lowercase + string.ascii_uppercase + string.digits
+
 
+def weighted_picks( rnd, sequence, relative_odds, k ):
+    return rnd.choices( sequence, weights=relative_odds, k=k )
 
-def rand_newfilepath():
-    filepath = ''
-    dir = random.choice( directories ).path
-    chars = string.ascii_lowercase + string.ascii_uppercase + string.digits
-    while len( filepath ) < 1:
-        name = ''.join(random.sample( chars, random.randint(1,10) ) )
-        filepath = os.path.join( dir, name )
-        if os.path.lexists( filepath ):
-            filepath = ''
-    logging.debug( filepath )
-    return ( dir, name, filepath )
+
+def _filesize( rnd ):
+    """ File size drawn from config.SIZE_DISTRIBUTION
+    SIZE_DISTRIBUTION is a list of ( weight, min, max ), a bucket is picked
+    by weight and the size is log-uniform within the bucket (so small sizes
+    within a bucket are as likely as large ones).  If it is empty, sizes are
+    uniform between 0 and MAX_FILE_SIZE.
+    """
+    dist = getattr( config, 'SIZE_DISTRIBUTION', None )
+    if not dist:
+        return rnd.randint( 0, config.MAX_FILE_SIZE )
+    ( weight, lo, hi ) = rnd.choices( dist, weights=[ d[0] for d in dist ] )[0]
+    if hi <= lo:
+        return lo
+    return int( math.exp( rnd.uniform( math.log( lo + 1 ), math.log( hi + 1 ) ) ) ) - 1
+
+
+def _newname( rnd, parent, taken ):
+    while True:
+        name = ''.join( rnd.sample( NAME_CHARS, rnd.randint( 1, 10 ) ) )
+        path = os.path.join( parent, name )
+        if path not in taken:
+            taken.add( path )
+            return path
+
+
+def _ids():
+    """ uids and gids for chown, users/groups not on this host are skipped
+    """
+    uids = []
+    for user in config.PERMS_USERS:
+        try:
+            uids.append( pwd.getpwnam( user ).pw_uid )
+        except ( KeyError ):
+            logging.debug( 'No such user {0}, skipped'.format( user ) )
+    gids = []
+    for group in config.PERMS_GROUPS:
+        try:
+            gids.append( grp.getgrnam( group ).gr_gid )
+        except ( KeyError ):
+            logging.debug( 'No such group {0}, skipped'.format( group ) )
+    return ( uids or [ os.getuid() ], gids or [ os.getgid() ] )
+
+
+def plan( top, num_objects, seed ):
+    """
+    Decide every object of the tree below top, without touching the filesystem
+    :return list of _Entry: parents before children, hardlink and symlink
+                            targets before the links
+    """
+    rnd = random.Random( seed )
+    ( uids, gids ) = _ids()
+    types = [ 'f' ] #force one file first, so there is something to link to
+    types.extend( weighted_picks( rnd,
+        ( 'f', 'd', 'l', 'p', 's', 'h' ),
+        ( config.FILE_WEIGHT, config.DIR_WEIGHT, config.SYMLINK_WEIGHT,
+          config.FIFO_WEIGHT, config.SOCKET_WEIGHT, config.HARDLINK_WEIGHT ),
+        num_objects - 1 ) )
+    counts = collections.Counter( types )
+    taken = set()
+    def perms( typ ):
+        if typ == 'd':
+            mode = rnd.choice( config.CHMOD_DIR_CHOICES )
+        else:
+            mode = rnd.choice( config.CHMOD_CHOICES )
+        uid = uids[ int( rnd.random() * len( uids ) ) ]
+        gid = gids[ int( rnd.random() * len( gids ) ) ]
+        return ( mode, uid, gid )
+    def stripe():
+        return ( rnd.choice( config.FILE_STRIPE_COUNTS ),
+                 rnd.choice( config.FILE_STRIPE_SIZES ) )
+    # directories, breadth first, each parent gets DIR_FANOUT subdirs
+    ( fanout_min, fanout_max ) = config.DIR_FANOUT
+    dirs = [ ( top, 0 ) ]
+    entries = []
+    parent = 0
+    room = rnd.randint( fanout_min, fanout_max )
+    for i in range( counts[ 'd' ] ):
+        while room < 1:
+            if parent + 1 < len( dirs ):
+                parent += 1
+                room = rnd.randint( fanout_min, fanout_max )
+            else:
+                room = 1 # DIR_FANOUT allows 0, but the tree must grow
+        ( ppath, pdepth ) = dirs[ parent ]
+        path = _newname( rnd, ppath, taken )
+        dirs.append( ( path, pdepth + 1 ) )
+        entries.append( _Entry( 'd', path, None, 0, stripe(), *perms( 'd' ),
+                                depth=pdepth + 1 ) )
+        room -= 1
+    # files, spread over the directories with a skewed (pareto) weight, so
+    # a few directories get most of the files
+    skew = [ rnd.paretovariate( config.DIR_FILE_SKEW ) for d in dirs ]
+    others = [ t for t in types if t != 'd' ]
+    parents = rnd.choices( dirs, weights=skew, k=len( others ) )
+    linkable = []
+    links = []
+    for typ, ( ppath, pdepth ) in zip( others, parents ):
+        path = _newname( rnd, ppath, taken )
+        if typ == 'f':
+            e = _Entry( 'f', path, None, _filesize( rnd ), stripe(), *perms( 'f' ),
+                        depth=pdepth + 1 )
+        elif typ in ( 'p', 's' ):
+            e = _Entry( typ, path, None, 0, None, *perms( typ ), depth=pdepth + 1 )
+        else:
+            links.append( ( typ, path, pdepth + 1 ) )
+            continue
+        entries.append( e )
+        linkable.append( e )
+    everything = [ top ] + [ e.path for e in entries ]
+    for typ, path, depth in links:
+        if typ == 'h':
+            tgt = rnd.choice( linkable ).path
+            entries.append( _Entry( 'h', path, tgt, 0, None, None, None, None, depth ) )
+        else:
+            tgt = rnd.choice( everything )
+            ( mode, uid, gid ) = perms( 'l' )
+            entries.append( _Entry( 'l', path, tgt, 0, None, None, uid, gid, depth ) )
+        everything.append( path )
+    return entries
 
 
-def rand_path():
-    inode = random.choice( objects.keys() )
-    path = random.choice( objects[ inode ] ).path
-    return path
+def _datablock( seed ):
+    return random.Random( seed ).randbytes( 1048576 )
 
 
-def set_rand_stripeinfo( path ):
-    cnt = random.choice( config.FILE_STRIPE_COUNTS )
-    sz = random.choice( config.FILE_STRIPE_SIZES )
-    cmd = [ 'lfs', 'setstripe' ]
+def set_stripeinfo( paths, count, size ):
+    """ One "lfs setstripe" for all paths (creates files that don't exist)
+    """
+    cmd = [ os.environ.get( 'PYLUTLFSPATH', 'lfs' ), 'setstripe' ]
     opts = None
-    args = [ '-c', cnt, '-S', sz, path ]
+    args = [ '-c', count, '-S', size ] + list( paths )
     ( out, err ) = runcmd( cmd, opts, args )
-    return ( cnt, sz )
+    return ( count, size )
+
+
+def _create_batch( batch, block, setstripes ):
+    """
+    Create the entries of batch (all of the same kind: directories of one
+    level, files and specials, or links)
+    :return list of ( _Entry, os.stat_result )
+    """
+    if setstripes:
+        bystripe = collections.defaultdict( list )
+        for e in batch:
+            if e.stripe is not None and e.typ == 'f':
+                bystripe[ e.stripe ].append( e.path )
+        for ( count, size ), paths in bystripe.items():
+            set_stripeinfo( paths, count, size )
+    dirstripes = collections.defaultdict( list )
+    for n, e in enumerate( batch ):
+        if e.typ == 'd':
+            os.mkdir( e.path )
+            if setstripes:
+                dirstripes[ e.stripe ].append( e.path )
+        elif e.typ == 'f':
+            flags = os.O_WRONLY
+            if not setstripes:
+                flags |= os.O_CREAT | os.O_EXCL
+            fd = os.open( e.path, flags, 0o600 )
+            try:
+                _writedata( fd, e.size, block, zlib.crc32( e.path.encode() ) % len( block ) )
+            finally:
+                os.close( fd )
+        elif e.typ == 'p':
+            os.mkfifo( e.path )
+        elif e.typ == 's':
+            # mknod instead of bind(), which would need a chdir (not thread safe)
+            # for paths longer than sun_path
+            os.mknod( e.path, 0o600 | stat.S_IFSOCK )
+        elif e.typ == 'l':
+            os.symlink( e.tgt, e.path )
+        elif e.typ == 'h':
+            os.link( e.tgt, e.path )
+    for ( count, size ), paths in dirstripes.items():
+        set_stripeinfo( paths, count, size )
+    created = []
+    for e in batch:
+        if e.mode is not None:
+            os.chmod( e.path, e.mode )
+        if e.uid is not None:
+            os.lchown( e.path, e.uid, e.gid )
+        created.append( ( e, os.lstat( e.path ) ) )
+    return created
+
+
+def _writedata( fd, size, block, offset ):
+    view = memoryview( block )
+    while size > 0:
+        n = min( size, len( block ) - offset )
+        size -= os.write( fd, view[ offset:offset + n ] )
+        offset = 0
+
+
+def _batches( entries, batchsize ):
+    it = iter( entries )
+    while True:
+        batch = list( itertools.islice( it, batchsize ) )
+        if not batch:
+            return
+        yield batch
+
+
+def create( top, entries, workers=None, batchsize=None, setstripes=None ):
+    """
+    Create planned entries below top (which must exist)
+    Directories are created one depth level at a time, then files, fifos
+    and sockets, then hard and symbolic links; each step is split in batches
+    run in parallel.
+    """
+    workers = workers or config.WORKERS
+    batchsize = batchsize or config.BATCH_SIZE
+    if setstripes is None:
+        setstripes = config.SET_STRIPES
+    block = _datablock( config.SEED )
+    bylevel = collections.defaultdict( list )
+    for e in entries:
+        if e.typ == 'd':
+            bylevel[ e.depth ].append( e )
+    steps = [ bylevel[ d ] for d in sorted( bylevel ) ]
+    steps.append( [ e for e in entries if e.typ in ( 'f', 'p', 's' ) ] )
+    steps.append( [ e for e in entries if e.typ in ( 'h', 'l' ) ] )
+    with concurrent.futures.ThreadPoolExecutor( workers ) as pool:
+        for step in steps:
+            futures = [ pool.submit( _create_batch, batch, block, setstripes )
+                        for batch in _batches( step, batchsize ) ]
+            for f in futures:
+                for e, st in f.result():
+                    _save( e, st, setstripes )
+
+
+def _save( e, st, setstripes ):
+    typ = e.typ
+    tgt = e.tgt if typ == 'l' else None
+    stripe = e.stripe
+    if typ == 'h':
+        first = objects[ st.st_ino ][0]
+        typ = first.typ
+        stripe = ( first.stripecount, first.stripesize )
+    f = save_path_info( e.path, typ, tgt=tgt, st=st )
+    if typ == 'd':
+        directories.append( f )
+    else:
+        files.append( f )
+    if setstripes and stripe is not None and stripe[0] is not None:
+        f.set_stripe_info( *stripe )
+    return f
 
 
-def save_path_info( path, typ, tgt=None ):
-    f = FileObject( path, typ, tgt )
+def save_path_info( path, typ, tgt=None, st=None ):
+    f = FileObject( path, typ, tgt, st )
     inode = f.inode()
     if inode not in objects:
         objects[ inode ] = []
@@ -103,147 +362,67 @@ def save_path_info( path, typ, tgt=None ):
     return f
 
 
-def create_directory():
-    (parent, fn, path) = rand_newfilepath()
-    os.makedirs( path )
-    d = save_path_info( path, 'd' )
-    directories.append( d )
-    #TODO - uncomment for set stripe info
-    ( cnt, sz ) = set_rand_stripeinfo( path )
-    d.set_stripe_info( cnt, sz )
-
-
-def create_file():
-    (parent, fn, path) = rand_newfilepath()
-    #TODO - uncomment for set stripe info
-    ( stripe_cnt, stripe_sz ) = set_rand_stripeinfo( path )
-    filesize = random.randint(0, config.MAX_FILE_SIZE )
-    with open( path, 'wb') as f:
-        f.write( os.urandom( filesize ) )
-    f = save_path_info( path, 'f' )
-    files.append( f )
-    #TODO - uncomment for set stripe info
-    f.set_stripe_info( stripe_cnt, stripe_sz )
-
-
-def create_fifo():
-    (parent, fn, path) = rand_newfilepath()
-    os.mkfifo( path )
-    f = save_path_info( path, 'p' )
-    files.append( f )
-
-
-def create_socket():
-    (parent, fn, path) = rand_newfilepath()
-    oldwd = os.getcwd()
-    os.chdir( parent )
-    sock = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
-    sock.bind( fn )
-    os.chdir( oldwd )
-    f = save_path_info( path, 's' )
-    files.append( f )
-
-
-def create_symlink():
-    (parent, fn, path) = rand_newfilepath()    
-    target = rand_path()
-    os.symlink( target, path )
-    f = save_path_info( path, 'l', tgt=target )
-    files.append( f )
-
-
-def create_hardlink():
-    (parent, fn, path) = rand_newfilepath()    
-    target = random.choice( files )
-    os.link( target.path, path )
-    f = save_path_info( path, target.typ )
-    files.append( f )
-    f.set_stripe_info( target.stripecount, target.stripesize )
-
-
-def perms_chmod(path, type):
-    if type is 'd':
-        mode = random.choice( config.CHMOD_DIR_CHOICES )
-    else:
-        mode = random.choice( config.CHMOD_CHOICES )
-    if type is not 'l':
-        os.chmod(path, mode)
-
-
-def perms_chown(path):
-    os.lchown(path, random.choice(uids), random.choice(gids))
-
-
-def perms_acl(path,type):
-    if type is 'd':
-        return
-    acl_users = random.sample( config.PERMS_ACL_USERS, random.randint(0,len(config.PERMS_ACL_USERS)) )
-    acl_groups = random.sample( config.PERMS_ACL_GROUPS, random.randint(0,len(config.PERMS_ACL_GROUPS)) )
-    ac_u = []
-    ac_g = []
-    ac = []
-    for user in acl_users:
-        if type is 'd' and user == pwd.getpwuid(os.getuid()).pw_name:
-            ac_u.append("u:" + user + ":r" + random.choice(['w','-']) + "x")
-        else:
-            ac_u.append("u:" + user + ":r" + random.choice(['w','-']) + random.choice(['x','-']))
-    
-    for group in acl_groups:
-        ac_g.append("g:" + random.choice(config.PERMS_ACL_GROUPS) + ":" + random.choice(['r','-']) + random.choice(['w','-']) + random.choice(['x','-']))
-    if len(ac_u) > 0:
-        ac.append(','.join(ac_u))
-    if len(ac_g) > 0:
-        ac.append(','.join(ac_g))
-    if random.random() < 0.5:
-        ac_o = "o::" + random.choice(['r','-']) + random.choice(['w','-']) + random.choice(['x','-'])
-        ac.append(ac_o)
-    text=','.join(ac)
-#    acl = posix1e.ACL(text=text)
-#    path2 = os.path.join(os.getcwd(), path)
-#    acl.applyto(path2)
+def write_manifest( path ):
+    """
+    Write objects as JSON lines: a header with the config used, then one
+    line per path
+    """
+    with open( path, 'w' ) as fh:
+        fh.write( json.dumps( { 'seed': config.SEED,
+                                'num_objects': config.NUM_OBJECTS,
+                                'source': source,
+                                'target': target } ) + '\n' )
+        for f in itertools.chain( directories, files ):
+            st = f.stat
+            fh.write( json.dumps( [ f.path, f.typ, f.tgt, st.st_ino, st.st_mode,
+                                    st.st_size,
+                                    f.stripecount, f.stripesize ] ) + '\n' )
+
+
+def load_manifest( path ):
+    """
+    Load objects, files and directories from a manifest written by
+    write_manifest, without looking at the tree
+    """
+    global objects, files, directories, source, target
+    objects = {}
+    files = []
+    directories = []
+    with open( path ) as fh:
+        header = json.loads( next( fh ) )
+        source = header[ 'source' ]
+        target = header[ 'target' ]
+        for line in fh:
+            ( p, typ, tgt, ino, mode, size, cnt, sz ) = json.loads( line )
+            f = save_path_info( p, typ, tgt=tgt, st=_ManifestStat( ino, mode, size ) )
+            f.set_stripe_info( cnt, sz )
+            if typ == 'd':
+                directories.append( f )
+            else:
+                files.append( f )
+    return header
 
 
 def initialize():
-    global objects, directories
+    global objects, directories, source, target
     os.makedirs( config.SOURCE_DIR )
     os.makedirs( config.DEST_DIR )
+    source = os.path.abspath( config.SOURCE_DIR )
+    target = os.path.abspath( config.DEST_DIR )
     directories.append( FileObject( config.SOURCE_DIR, 'd', None ) )
-    #force create one file first, otherwise a hardlink or softlink first will fail
-    create_file()
-    parts, weights = zip( ( create_file,       config.FILE_WEIGHT     ),
-                          ( create_directory,  config.DIR_WEIGHT      ),
-                          ( create_symlink,    config.SYMLINK_WEIGHT  ),
-                          ( create_fifo,       config.FIFO_WEIGHT     ),
-                          ( create_socket,     config.SOCKET_WEIGHT   ),
-                          ( create_hardlink,   config.HARDLINK_WEIGHT )
-                        )
-    rand_choice = weighted_picks( parts, weights )
-    for i in range( config.NUM_OBJECTS - 1 ):
-        create = next( rand_choice )
-        logging.debug( 'About to: {0}'.format( create ) )
-        create()
-    #chmod
-    for inode, elems in objects.iteritems():
-        f = elems[0]
-        #logging.debug( 'Change Perms: {0} {1}'.format( f.typ, f.path ) )
-        perms_chmod( f.path, f.typ )
-        perms_chown( f.path )
-#        perms_acl(path, type)
+    entries = plan( config.SOURCE_DIR, config.NUM_OBJECTS, config.SEED )
+    create( config.SOURCE_DIR, entries )
+    if config.MANIFEST:
+        write_manifest( config.MANIFEST )
     return ( objects, files )
 
 
 def mk_all_tgtdirs():
     global objects, files, directories
     for d in directories:
-        try:
-            tgtpath = d.path.replace( config.SOURCE_DIR, config.DEST_DIR, 1 )
-            #logging.debug( "Attempting to mkdir '{0}'".format( tgtpath ) )
-            os.makedirs( tgtpath )
-        except ( OSError ) as e:
-            if e.errno == 17:
-                pass
-            else:
-                raise e
+        tgtpath = d.path.replace( config.SOURCE_DIR, config.DEST_DIR, 1 )
+        #logging.debug( "Attempting to mkdir '{0}'".format( tgtpath ) )
+        os.makedirs( tgtpath, exist_ok=True )
 
 
 def reset_config():
@@ -259,35 +438,65 @@ def reset():
     for d in [ config.SOURCE_DIR, config.DEST_DIR, config.TMP_DIR ]:
         try:
             shutil.rmtree( d )
-        except ( OSError ) as e:
-            if e.errno == 2: # OSError: [Errno 2] No such file or directory:
-                pass
-            else:
-                raise e
+        except ( FileNotFoundError ):
+            pass
     initialize()
-    
+
 # make it possible to have a copy of psconfig variables accessible by name
-CFG = type( 'CFG', 
-            (object,), 
+CFG = type( 'CFG',
+            (object,),
             {k:getattr(psconfig,k) for k in dir(psconfig) if not k.startswith('__')} )
 config = CFG()
 
 objects = {}
 files = []
 directories = []
-uids = [pwd.getpwnam(user).pw_uid for user in config.PERMS_USERS]
-gids = [grp.getgrnam(group).gr_gid for group in config.PERMS_GROUPS]
+source = os.path.abspath( config.SOURCE_DIR )
+target = os.path.abspath( config.DEST_DIR )
+
+
+def process_cmdline():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Create a randomized (seeded) directory tree' )
+    parser.add_argument( '--objects', '-n', type=int, default=config.NUM_OBJECTS )
+    parser.add_argument( '--seed', type=int, default=config.SEED )
+    parser.add_argument( '--workers', '-w', type=int, default=config.WORKERS )
+    parser.add_argument( '--batchsize', type=int, default=config.BATCH_SIZE )
+    parser.add_argument( '--source', default=config.SOURCE_DIR )
+    parser.add_argument( '--dest', default=config.DEST_DIR )
+    parser.add_argument( '--tmp', default=config.TMP_DIR )
+    parser.add_argument( '--nostripes', action='store_true',
+        help='do not run "lfs setstripe" (for non-Lustre filesystems)' )
+    parser.add_argument( '--realistic', action='store_true',
+        help='use psconfig.REALISTIC_SIZES as the file size distribution' )
+    parser.add_argument( '--manifest', '-m',
+        help='write a manifest to this file instead of listing the tree' )
+    parser.add_argument( '--debug', action='store_true' )
+    return parser.parse_args()
 
 
 if __name__ == '__main__':
-    logging.basicConfig( level=logging.DEBUG )
-#    random.seed( a=config.SEED )
-        
+    args = process_cmdline()
+    logging.basicConfig( level=logging.DEBUG if args.debug else logging.INFO )
+    config.NUM_OBJECTS = args.objects
+    config.SEED = args.seed
+    config.WORKERS = args.workers
+    config.BATCH_SIZE = args.batchsize
+    config.SOURCE_DIR = args.source
+    config.DEST_DIR = args.dest
+    config.TMP_DIR = args.tmp
+    config.MANIFEST = args.manifest
+    if args.nostripes:
+        config.SET_STRIPES = False
+    if args.realistic:
+        config.SIZE_DISTRIBUTION = config.REALISTIC_SIZES
     reset()
-    for inode,elems in objects.iteritems():
-        print( inode, end=' ' )
-        print( *elems, sep='\n' + ' '*20 )
+    if not args.manifest:
+        for inode,elems in objects.items():
+            print( inode, end=' ' )
+            print( *elems, sep='\n' + ' '*20 )
 
 #    pprint.pprint( objects )
-        
+
 # vim:set softtabstop=4 shiftwidth=4 tabstop=4 expandtab:
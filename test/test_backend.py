@@ -0,0 +1,204 @@
+import os
+import struct
+import asyncio
+import threading
+import pytest
+import backend
+import fsitem
+import pylut
+from runcmd import Run_Cmd_Error
+
+
+def _touch( path, data=b'' ):
+    with open( path, 'wb' ) as f:
+        f.write( data )
+    return str( path )
+
+
+def test_sim_fids( sim, tmp_path ):
+    a = _touch( tmp_path / 'a' )
+    b = _touch( tmp_path / 'b' )
+    os.link( a, str( tmp_path / 'a2' ) )
+    fa = sim.path2fid( a )
+    assert fa == '[0x200000400:0x1:0x0]'
+    assert sim.path2fid( b ) == '[0x200000400:0x2:0x0]'
+    assert sim.path2fid( a ) == fa
+    assert sim.path2fid( str( tmp_path / 'a2' ) ) == fa
+    assert sorted( sim.fid2path( str( tmp_path ), fa ) ) == [ a, str( tmp_path / 'a2' ) ]
+    os.unlink( a )
+    assert sim.fid2path( str( tmp_path ), fa ) == [ str( tmp_path / 'a2' ) ]
+    with pytest.raises( Run_Cmd_Error ) as einfo:
+        sim.path2fid( a )
+    assert einfo.value.code == 2
+    assert 'No such file or directory' in einfo.value.reason
+
+
+def test_sim_layouts( sim, tmp_path ):
+    f = _touch( tmp_path / 'f' )
+    si = sim.getstripeinfo( f )
+    assert ( si.count, si.size, si.pattern ) == ( 1, 1048576, 1 )
+    assert si.index_info == [ ( si.offset, 1, 0 ) ]
+    # new files get objects round-robin, with per-OST object ids
+    sim.setstripeinfo( str( tmp_path / 'g' ), count=3, size=4194304 )
+    si = sim.getstripeinfo( str( tmp_path / 'g' ) )
+    assert ( si.count, si.size ) == ( 3, 4194304 )
+    assert [ i[0] for i in si.index_info ] == [ ( si.offset + k ) % 4 for k in range( 3 ) ]
+    # stripe count -1 is all OSTs
+    sim.setstripeinfo( str( tmp_path / 'h' ), count=-1 )
+    assert sim.getstripeinfo( str( tmp_path / 'h' ) ).count == 4
+    with pytest.raises( Run_Cmd_Error ) as einfo:
+        sim.setstripeinfo( f, count=2 )
+    assert einfo.value.code == 17
+
+
+def test_sim_dir_default( sim, tmp_path ):
+    d = tmp_path / 'd'
+    d.mkdir()
+    assert sim.getstripeinfo( str( d ) ).count == 1
+    sim.setstripeinfo( str( d ), count=2, size=2097152 )
+    si = sim.getstripeinfo( str( d ) )
+    assert ( si.count, si.size, si.offset, si.index_info ) == ( 2, 2097152, -1, None )
+    _touch( d / 'x' )
+    assert sim.getstripeinfo( str( d / 'x' ) ).count == 2
+    sim.setstripeinfo( str( d / 'y' ) )
+    assert sim.getstripeinfo( str( d / 'y' ) ).size == 2097152
+
+
+def test_sim_fsitem( sim, tmp_path ):
+    f = fsitem.FSItem( _touch( tmp_path / 'f', b'hello' ) )
+    assert f.inode() == sim.path2fid( f.absname )
+    assert f.stripecount == 1
+    g = fsitem.FSItem( f.absname, byfid=True )
+    g.set_inode( f.inode() )
+    assert g.datapath() == f.absname
+    sock = tmp_path / 's'
+    os.mkfifo( str( sock ) )
+    assert fsitem.FSItem( str( sock ) ).stripeinfo().count is None
+
+
+def test_sim_async( sim, tmp_path ):
+    f = str( tmp_path / 'f' )
+    async def run():
+        await sim.setstripeinfo_async( f, count=2 )
+        return ( await sim.path2fid_async( f ), await sim.getstripeinfo_async( f ) )
+    ( fid, si ) = asyncio.run( run() )
+    assert fid == sim.path2fid( f )
+    assert si.count == 2
+
+
+def test_registry( tmp_path, monkeypatch ):
+    monkeypatch.setattr( backend, 'autodetect', False )
+    root = str( tmp_path / 'sim' )
+    b = backend.SimBackend( root )
+    backend.register( root, b )
+    try:
+        assert backend.for_path( root ) is b
+        assert backend.for_path( os.path.join( root, 'x', 'y' ) ) is b
+        assert isinstance( backend.for_path( root + 'x' ), backend.LfsBackend )
+    finally:
+        backend.unregister( root )
+    assert isinstance( backend.for_path( root ), backend.LfsBackend )
+
+
+def test_parse_lov():
+    hdr = struct.pack( '<IIQQIHH', backend.LOV_USER_MAGIC_V1, 1, 5, 0, 1048576, 2, 7 )
+    objs = struct.pack( '<QQII', 100, 0, 0, 3 ) + struct.pack( '<QQII', 200, 0, 0, 4 )
+    si = backend.parse_lov( hdr + objs )
+    assert ( si.count, si.size, si.offset, si.pattern, si.gen ) == ( 2, 1048576, 3, 1, 7 )
+    assert si.index_info == [ ( 3, 100, 0 ), ( 4, 200, 0 ) ]
+    v3 = struct.pack( '<IIQQIHH', backend.LOV_USER_MAGIC_V3, 1, 5, 0, 1048576, 1, 0 )
+    si = backend.parse_lov( v3 + b'pool'.ljust( 16, b'\0' ) + objs[:24] )
+    assert si.index_info == [ ( 3, 100, 0 ) ]
+    # directory default layout: no objects
+    si = backend.parse_lov( backend.pack_lov( count=-1, size=4194304 ) )
+    assert ( si.count, si.size, si.offset, si.index_info ) == ( -1, 4194304, -1, None )
+    with pytest.raises( backend.LayoutError ):
+        backend.parse_lov( struct.pack( '<IIQQIHH', 0x0bd60bd0, 0, 0, 0, 0, 0, 0 ) )
+
+
+def test_posix( tmp_path ):
+    b = backend.PosixBackend()
+    f = _touch( tmp_path / 'f', b'abc' )
+    st = os.lstat( f )
+    assert b.path2fid( f ) == '0x{0:x}:0x{1:x}'.format( st.st_dev, st.st_ino )
+    assert b.getstripeinfo( f ).count is None
+    assert b.getsom( f ) == 3
+    b.setstripeinfo( str( tmp_path / 'g' ), count=4 )
+    assert os.path.getsize( str( tmp_path / 'g' ) ) == 0
+    b.setstripeinfo( str( tmp_path ), count=4 )
+    with pytest.raises( Run_Cmd_Error ) as einfo:
+        b.setstripeinfo( f )
+    assert einfo.value.code == 17
+    with pytest.raises( Run_Cmd_Error ) as einfo:
+        b.path2fid( str( tmp_path / 'missing' ) )
+    assert einfo.value.code == 2
+
+
+def test_autodetect( tmp_path, monkeypatch ):
+    import mountinfo
+    p = tmp_path / 'mountinfo'
+    p.write_text(
+        '22 1 0:21 / / rw - ext4 /dev/sda1 rw\n'
+        '40 22 0:35 / /mnt/lustre rw - lustre 10.0.0.1@o2ib:/fs1 rw\n'
+        '41 40 0:36 / /mnt/lustre/nfs rw - nfs4 server:/export rw\n' )
+    monkeypatch.setattr( mountinfo, '_mounttable', mountinfo.MountTable( str( p ) ) )
+    assert isinstance( backend.for_path( '/mnt/lustre/a/b' ), backend.LfsBackend )
+    assert isinstance( backend.for_path( '/mnt/lustre/nfs/a' ), backend.PosixBackend )
+    assert isinstance( backend.for_path( '/home/a' ), backend.PosixBackend )
+    nfs = backend.PosixBackend()
+    backend.set_fstype( 'nfs4', nfs )
+    try:
+        assert backend.for_path( '/mnt/lustre/nfs/a' ) is nfs
+    finally:
+        backend.set_fstype( 'nfs4', None )
+    monkeypatch.setattr( backend, 'autodetect', False )
+    assert isinstance( backend.for_path( '/home/a' ), backend.LfsBackend )
+
+
+def test_posix_fsitem_no_lfs( tmp_path, monkeypatch ):
+    # non-Lustre paths must not run lfs
+    def _nolfs( *a, **k ):
+        raise AssertionError( 'lfs called' )
+    monkeypatch.setattr( pylut, 'runcmd', _nolfs )
+    monkeypatch.setattr( pylut, 'getsom', _nolfs )
+    f = fsitem.FSItem( _touch( tmp_path / 'f', b'abc' ) )
+    if not isinstance( backend.for_path( f.absname ), backend.PosixBackend ):
+        pytest.skip( 'tmp_path is on Lustre' )
+    assert f.inode() == '0x{0:x}:0x{1:x}'.format( f.dev, f.ino )
+    assert f.stripeinfo().count is None
+
+
+def test_syncfile_async_sim( sim, rsync, tmp_path, monkeypatch ):
+    """
+    syncfile_async reuses a known src stripeinfo and keeps tmpdir creation
+    and linking off the event loop thread
+    """
+    srcs = []
+    for n in ( 'a', 'b' ):
+        sim.setstripeinfo( str( tmp_path / n ), count=2 )
+        _touch( tmp_path / n, b'x' * 100 )
+        srcs.append( fsitem.FSItem( str( tmp_path / n ) ) )
+    srcs[0].set_stripeinfo( sim.getstripeinfo( srcs[0].absname ) )
+    getstripe = []
+    orig = sim.getstripeinfo_async
+    async def _getstripe( path, limit=None ):
+        getstripe.append( path )
+        return await orig( path, limit=limit )
+    monkeypatch.setattr( sim, 'getstripeinfo_async', _getstripe )
+    threads = []
+    for name in ( '_syncfile_mktmpdir', '_syncfile_finish' ):
+        def _record( plan, fn=getattr( pylut, name ) ):
+            threads.append( threading.get_ident() )
+            return fn( plan )
+        monkeypatch.setattr( pylut, name, _record )
+    async def run():
+        return await asyncio.gather( *[
+            pylut.syncfile_async( s, fsitem.FSItem( s.absname + '.tgt' ),
+                                  tmpbase=str( tmp_path / 'tmp' ) )
+            for s in srcs ] )
+    asyncio.run( run() )
+    assert getstripe == [ srcs[1].absname ]
+    assert len( threads ) == 4
+    assert threading.get_ident() not in threads
+    for s in srcs:
+        assert sim.getstripeinfo( s.absname + '.tgt' ).count == 2
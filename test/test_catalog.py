@@ -0,0 +1,69 @@
+import pytest
+import os
+import numpy
+import catalog
+import pylut
+
+
+@pytest.fixture
+def tree( tmpdir, mktree ):
+    top = os.path.join( str( tmpdir ), 'tree' )
+    return ( top, mktree( top, depth=2, nfiles=4, filename='f {0}' ) )
+
+
+def test_from_walk( tree ):
+    top, paths = tree
+    cat = catalog.Catalog.from_walk( top, workers=4 )
+    assert len( cat ) == len( paths )
+    assert sorted( os.path.join( top, p ) if p else top for p in cat.relpaths() ) \
+        == sorted( paths )
+    for i in range( len( cat ) ):
+        assert cat.relpath( i ) == cat.relpaths()[i]
+    e = cat.entries
+    assert ( e[ 'path_id' ] == numpy.arange( len( cat ) ) ).all()
+    assert ( e[ 'parent_id' ] < e[ 'path_id' ] ).all()
+
+
+def test_item( tree ):
+    top, paths = tree
+    cat = catalog.Catalog.from_walk( top )
+    for f in cat.items():
+        st = os.lstat( f.absname )
+        assert ( f.ino, f.mode, f.size, f.nlink, f.uid, f.gid ) == \
+               ( st.st_ino, st.st_mode, st.st_size, st.st_nlink, st.st_uid, st.st_gid )
+        assert f.stat().st_mtime_ns == st.st_mtime_ns
+        assert f._inode is None
+
+
+def test_fid_and_layout( tree ):
+    top, paths = tree
+    cat = catalog.Catalog( top )
+    st = os.lstat( paths[1] )
+    s1 = pylut.LustreStripeInfo( count=2, size=1048576, offset=3 )
+    s2 = pylut.LustreStripeInfo( count=2, size=1048576, offset=5 )
+    s3 = pylut.LustreStripeInfo( count=4, size=1048576, offset=5 )
+    cat.add( '', -1, os.lstat( top ) )
+    for i, s in enumerate( ( s1, s2, s3, None ) ):
+        cat.add( 'f{0}'.format( i ), 0, st,
+                 fid='[0x200000400:0x{0:x}:0x0]'.format( i + 1 ), stripeinfo=s )
+    assert list( cat.entries[ 'layout_id' ] ) == [ -1, 0, 0, 1, -1 ]
+    assert len( cat.layouts ) == 2
+    f = cat.item( 3 )
+    assert f.inode() == '[0x200000400:0x3:0x0]'
+    assert ( f.stripecount, f.stripesize ) == ( 4, 1048576 )
+
+
+def test_save_load( tree, tmpdir ):
+    top, paths = tree
+    cat = catalog.Catalog.from_walk( top )
+    dest = os.path.join( str( tmpdir ), 'catalog' )
+    cat.save( dest )
+    for mmap in ( True, False ):
+        cat2 = catalog.Catalog.load( dest, mmap=mmap )
+        assert len( cat2 ) == len( cat )
+        assert cat2.root == cat.root
+        assert ( cat2.entries == cat.entries ).all()
+        assert cat2.relpaths() == cat.relpaths()
+    assert isinstance( catalog.Catalog.load( dest ).entries, numpy.memmap )
+    with pytest.raises( catalog.CatalogError ):
+        cat2.add( 'x', 0, os.lstat( top ) )
@@ -0,0 +1,178 @@
+import pytest
+import os
+import changelog
+import pylut
+
+
+sample_records = """\
+1 02MKDIR 15:15:21.977666834 2018.01.09 0x0 t=[0x200000402:0x1:0x0] j=mkdir.500 ef=0xf u=500:500 nid=10.128.11.159@tcp p=[0x200000007:0x1:0x0] pics
+2 01CREAT 15:15:36.687592024 2018.01.09 0x0 t=[0x200000402:0x2:0x0] j=cp.500 ef=0xf u=500:500 nid=10.128.11.159@tcp p=[0x200000402:0x1:0x0] chloe.jpg
+3 17MTIME 15:15:37.687592024 2018.01.09 0x7 t=[0x200000402:0x2:0x0] j=cp.500 ef=0xf u=500:500 nid=10.128.11.159@tcp
+4 01CREAT 15:15:38.687592024 2018.01.09 0x0 t=[0x200000402:0x3:0x0] ef=0xf u=500:500 nid=10.128.11.159@tcp p=[0x200000402:0x1:0x0] my file.txt
+5 01CREAT 15:15:39.687592024 2018.01.09 0x0 t=[0x200000402:0x4:0x0] ef=0xf u=500:500 nid=10.128.11.159@tcp p=[0x200000402:0x1:0x0] tmp
+6 06UNLNK 15:15:41.305116815 2018.01.09 0x1 t=[0x200000402:0x4:0x0] ef=0xf u=500:500 nid=10.128.11.159@tcp p=[0x200000402:0x1:0x0] tmp
+7 08RENME 13:06:34.155563658 2018.01.09 0x0 t=[0:0x0:0x0] ef=0xf u=500:500 nid=10.128.11.159@tcp p=[0x200000007:0x1:0x0] new name s=[0x200000402:0x5:0x0] sp=[0x200000007:0x1:0x0] old name
+8 10OPEN  13:06:35.155563658 2018.01.09 0x4a t=[0x200000402:0x5:0x0] ef=0x7 u=0:0 nid=0@lo m=-w-
+"""
+
+
+@pytest.fixture
+def source( tmpdir ):
+    p = os.path.join( str( tmpdir ), 'changelog' )
+    with open( p, 'w' ) as f:
+        f.write( sample_records )
+    return p
+
+
+def test_parse( source ):
+    records = changelog.ChangelogReader( 'fs-MDT0000', 'cl1', source=source ).read()
+    assert [ r.type for r in records ] == [ 'MKDIR', 'CREAT', 'MTIME', 'CREAT',
+        'CREAT', 'UNLNK', 'RENME', 'OPEN' ]
+    assert records[1].tfid == '[0x200000402:0x2:0x0]'
+    assert records[1].pfid == '[0x200000402:0x1:0x0]'
+    assert records[1].name == 'chloe.jpg'
+    assert records[3].name == 'my file.txt'
+    assert records[5].flags == 1
+    r = records[6]
+    assert ( r.name, r.sname ) == ( 'new name', 'old name' )
+    assert ( r.sfid, r.spfid ) == ( '[0x200000402:0x5:0x0]', '[0x200000007:0x1:0x0]' )
+
+
+def test_parse_name_with_fields():
+    """ Names containing "s=" or "sp=" are not taken for fields """
+    line = '7 08RENME 13:06:34.155563658 2018.01.09 0x0 t=[0:0x0:0x0] ef=0xf ' \
+           'u=500:500 nid=10.128.11.159@tcp p=[0x200000007:0x1:0x0] a s=b ' \
+           's=[0x200000402:0x5:0x0] sp=[0x200000007:0x1:0x0] old sp=x'
+    r = changelog.ChangelogRecord.from_line( line )
+    assert ( r.name, r.sname ) == ( 'a s=b', 'old sp=x' )
+    assert ( r.sfid, r.spfid ) == ( '[0x200000402:0x5:0x0]', '[0x200000007:0x1:0x0]' )
+
+
+def test_changeset( source ):
+    records = changelog.ChangelogReader( 'fs-MDT0000', 'cl1', source=source ).read()
+    cs = changelog.ChangeSet.from_records( records )
+    assert cs.count == 8
+    assert cs.last_recno == 8
+    assert cs.changed == set( [ '[0x200000402:0x1:0x0]', '[0x200000402:0x2:0x0]',
+                                '[0x200000402:0x3:0x0]', '[0x200000402:0x5:0x0]' ] )
+    assert cs.removed == set( [ ( '[0x200000402:0x1:0x0]', 'tmp' ),
+                                ( '[0x200000007:0x1:0x0]', 'old name' ) ] )
+
+
+def test_clear( source ):
+    reader = changelog.ChangelogReader( 'fs-MDT0000', 'cl1', source=source )
+    reader.clear( 5 )
+    assert [ r.recno for r in reader.read() ] == [ 6, 7, 8 ]
+    assert reader.startrec == 6
+
+
+def test_incremental_sync( source, tmpdir, monkeypatch ):
+    src = os.path.join( str( tmpdir ), 'src' )
+    tgt = os.path.join( str( tmpdir ), 'tgt' )
+    os.makedirs( os.path.join( src, 'pics' ) )
+    for n in ( 'chloe.jpg', 'my file.txt' ):
+        open( os.path.join( src, 'pics', n ), 'w' ).close()
+    open( os.path.join( src, 'new name' ), 'w' ).close()
+    os.makedirs( os.path.join( tgt, 'pics' ) )
+    for n in ( 'old name', os.path.join( 'pics', 'tmp' ) ):
+        open( os.path.join( tgt, n ), 'w' ).close()
+    fids = { '[0x200000007:0x1:0x0]': src,
+             '[0x200000402:0x1:0x0]': os.path.join( src, 'pics' ),
+             '[0x200000402:0x2:0x0]': os.path.join( src, 'pics', 'chloe.jpg' ),
+             '[0x200000402:0x3:0x0]': os.path.join( src, 'pics', 'my file.txt' ),
+             '[0x200000402:0x5:0x0]': os.path.join( src, 'new name' ) }
+    resolved = []
+    def fid2path( mnt, wanted ):
+        resolved.append( set( wanted ) )
+        return dict( ( f, [ fids[f] ] ) for f in wanted if f in fids )
+    synced = []
+    monkeypatch.setattr( pylut, 'syncfile',
+        lambda s, t, **k: synced.append( ( str( s ), str( t ) ) ) )
+    monkeypatch.setattr( pylut, 'syncdir',
+        lambda s, t, **k: synced.append( ( str( s ), str( t ) ) ) )
+    reader = changelog.ChangelogReader( 'fs-MDT0000', 'cl1', source=source )
+    rv = changelog.incremental_sync( reader, src, tgt, tmpbase=None,
+                                     fid2path=fid2path, synctimes=True )
+    assert len( resolved ) == 1
+    assert rv[ 'errors' ] == []
+    assert ( rv[ 'records' ], rv[ 'renamed' ], rv[ 'deleted' ], rv[ 'synced' ] ) == \
+           ( 8, 1, 1, 4 )
+    assert not os.path.lexists( os.path.join( tgt, 'old name' ) )
+    assert os.path.isfile( os.path.join( tgt, 'new name' ) )
+    assert not os.path.lexists( os.path.join( tgt, 'pics', 'tmp' ) )
+    # parents are synced before their children
+    order = [ s for s, t in synced ]
+    assert order.index( os.path.join( src, 'pics' ) ) < \
+           order.index( os.path.join( src, 'pics', 'chloe.jpg' ) )
+    assert set( t for s, t in synced ) == set( [
+        os.path.join( tgt, 'pics' ), os.path.join( tgt, 'new name' ),
+        os.path.join( tgt, 'pics', 'chloe.jpg' ), os.path.join( tgt, 'pics', 'my file.txt' ) ] )
+    # consumed records were cleared
+    assert reader.read() == []
+
+
+rename_records = """\
+1 08RENME 13:06:34.155563658 2018.01.09 0x0 t=[0:0x0:0x0] ef=0xf u=500:500 nid=10.128.11.159@tcp p=[0x200000007:0x1:0x0] new s=[0x200000402:0x1:0x0] sp=[0x200000007:0x1:0x0] old
+"""
+
+
+@pytest.fixture
+def renamed_dir( tmpdir, monkeypatch ):
+    """
+    Source dir "old" (with a subtree) renamed to "new", the changelog only
+    has the rename record
+    """
+    top = str( tmpdir )
+    src = os.path.join( top, 'src' )
+    tgt = os.path.join( top, 'tgt' )
+    for root in ( src, tgt ):
+        os.makedirs( os.path.join( root, 'old', 'sub' ) )
+        for n in ( 'a', os.path.join( 'sub', 'b' ) ):
+            open( os.path.join( root, 'old', n ), 'w' ).close()
+    os.rename( os.path.join( src, 'old' ), os.path.join( src, 'new' ) )
+    source = os.path.join( top, 'changelog' )
+    with open( source, 'w' ) as f:
+        f.write( rename_records )
+    fids = { '[0x200000007:0x1:0x0]': src,
+             '[0x200000402:0x1:0x0]': os.path.join( src, 'new' ) }
+    def fid2path( mnt, wanted ):
+        return dict( ( f, [ fids[f] ] ) for f in wanted if f in fids )
+    synced = []
+    monkeypatch.setattr( pylut, 'syncfile',
+        lambda s, t, **k: synced.append( str( t ) ) )
+    monkeypatch.setattr( pylut, 'syncdir',
+        lambda s, t, **k: synced.append( str( t ) ) )
+    reader = changelog.ChangelogReader( 'fs-MDT0000', 'cl1', source=source )
+    return ( reader, src, tgt, fid2path, synced )
+
+
+def test_incremental_sync_rename_dir( renamed_dir ):
+    """
+    Verify a renamed directory keeps its contents on the target
+    """
+    reader, src, tgt, fid2path, synced = renamed_dir
+    rv = changelog.incremental_sync( reader, src, tgt, tmpbase=None,
+                                     fid2path=fid2path )
+    assert rv[ 'errors' ] == []
+    assert ( rv[ 'renamed' ], rv[ 'deleted' ], rv[ 'synced' ] ) == ( 1, 0, 1 )
+    assert not os.path.lexists( os.path.join( tgt, 'old' ) )
+    assert os.path.isfile( os.path.join( tgt, 'new', 'a' ) )
+    assert os.path.isfile( os.path.join( tgt, 'new', 'sub', 'b' ) )
+    assert synced == [ os.path.join( tgt, 'new' ) ]
+
+
+def test_incremental_sync_rename_dir_fallback( renamed_dir ):
+    """
+    Verify a renamed directory whose old name is missing on the target is
+    synced recursively
+    """
+    reader, src, tgt, fid2path, synced = renamed_dir
+    pylut.rmdir( os.path.join( tgt, 'old' ) )
+    rv = changelog.incremental_sync( reader, src, tgt, tmpbase=None,
+                                     fid2path=fid2path )
+    assert rv[ 'errors' ] == []
+    assert ( rv[ 'renamed' ], rv[ 'synced' ] ) == ( 0, 4 )
+    assert synced == [ os.path.join( tgt, 'new' ),
+                       os.path.join( tgt, 'new', 'a' ),
+                       os.path.join( tgt, 'new', 'sub' ),
+                       os.path.join( tgt, 'new', 'sub', 'b' ) ]
@@ -0,0 +1,75 @@
+import pytest
+import sys
+import threading
+import cmdpool
+import runcmd
+from runcmd import Run_Cmd_Error, Run_Cmd_Timeout
+
+
+def _py( code ):
+    return [ sys.executable, '-c', code ]
+
+
+@pytest.fixture
+def pool():
+    p = cmdpool.CmdPool( size=2 )
+    yield p
+    p.close()
+
+
+def test_run( pool ):
+    assert pool.run( _py( "print( 'hi' )" ) ) == ( b'hi\n', b'' )
+    with pytest.raises( Run_Cmd_Error ) as einfo:
+        pool.run( _py( "import sys; sys.stderr.write( 'bad' ); sys.exit( 2 )" ) )
+    assert ( einfo.value.code, einfo.value.reason ) == ( 2, b'bad' )
+    with pytest.raises( Run_Cmd_Error ) as einfo:
+        pool.run( [ '/nonexistent/cmd' ] )
+    assert einfo.value.code == 127
+    with pytest.raises( Run_Cmd_Timeout ):
+        pool.run( _py( "import time; time.sleep( 30 )" ), timeout=0.5 )
+    # pool still usable after errors
+    assert pool.run( [ 'echo', 'again' ] )[0] == b'again\n'
+
+
+def test_threads( pool ):
+    results = {}
+    def one( i ):
+        results[ i ] = pool.run( [ 'echo', str( i ) ] )[0]
+    threads = [ threading.Thread( target=one, args=( i, ) ) for i in range( 20 ) ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == { i: '{0}\n'.format( i ).encode() for i in range( 20 ) }
+
+
+def test_worker_died( pool ):
+    w = pool._idle.get()
+    w.kill()
+    w.wait()
+    pool._idle.put( w )
+    with pytest.raises( Run_Cmd_Error ):
+        for i in range( 2 ):
+            pool.run( [ 'true' ] )
+    assert pool.run( [ 'echo', 'ok' ] )[0] == b'ok\n'
+
+
+def test_interrupted( pool, monkeypatch ):
+    """ A helper interrupted mid-command is replaced, not lost
+    """
+    def interrupt( f ):
+        raise KeyboardInterrupt()
+    with monkeypatch.context() as m:
+        m.setattr( cmdpool, '_recv', interrupt )
+        with pytest.raises( KeyboardInterrupt ):
+            pool.run( [ 'true' ] )
+    assert pool._idle.qsize() == 2
+    assert pool.run( [ 'echo', 'ok' ] )[0] == b'ok\n'
+
+
+def test_set_pool( pool ):
+    runcmd.set_pool( pool )
+    try:
+        assert runcmd.runcmd( [ 'echo' ], opts={ 'a': 1 }, args=[ 'b' ] )[0] == b'a=1 b\n'
+    finally:
+        runcmd.set_pool( None )
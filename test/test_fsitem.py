@@ -0,0 +1,155 @@
+import pytest
+import os
+import fsitem
+import pylut
+import statx
+import backend
+
+
+@pytest.fixture
+def lfs_tmpdir( tmpdir ):
+    """ tmpdir, handled as Lustre (lfs) instead of autodetected as posix """
+    backend.register( str( tmpdir ), backend.LfsBackend() )
+    yield tmpdir
+    backend.unregister( str( tmpdir ) )
+
+
+@pytest.fixture
+def scandir( tmpdir ):
+    top = str( tmpdir )
+    with open( os.path.join( top, 'file' ), 'wb' ) as f:
+        f.write( b'x' * 100 )
+    os.mkdir( os.path.join( top, 'dir' ) )
+    os.symlink( 'file', os.path.join( top, 'link' ) )
+    parent = fsitem.FSItem( top )
+    with os.scandir( top ) as it:
+        entries = { e.name: e for e in it }
+    return ( parent, entries )
+
+
+def test_from_direntry( scandir, monkeypatch ):
+    parent, entries = scandir
+    # no system calls allowed while building items and checking types
+    def _fail( *a, **k ):
+        raise AssertionError( 'unexpected system call' )
+    for name in ( 'lstat', 'stat' ):
+        monkeypatch.setattr( os, name, _fail )
+    monkeypatch.setattr( fsitem, 'getmountpoint', _fail )
+    items = { n: fsitem.FSItem.from_direntry( e, parent, fid='[0x1:0x2:0x0]' )
+              for n, e in entries.items() }
+    monkeypatch.undo()
+    assert items[ 'file' ].is_regular()
+    assert items[ 'dir' ].is_dir()
+    assert items[ 'link' ].is_symlink()
+    assert not items[ 'link' ].is_regular()
+    for n, f in items.items():
+        assert f.absname == os.path.join( parent.absname, n )
+        assert f.mountpoint == parent.mountpoint
+        assert f.parent == parent.absname
+        assert f.inode() == '[0x1:0x2:0x0]'
+    assert items[ 'file' ].size == 100
+    assert items[ 'link' ].size == len( 'file' )
+
+
+def test_update_drops_direntry( scandir ):
+    parent, entries = scandir
+    f = fsitem.FSItem.from_direntry( entries[ 'file' ], parent )
+    f.stat()
+    with open( f.absname, 'ab' ) as fh:
+        fh.write( b'y' )
+    assert f.size == 100
+    f.update()
+    assert f.size == 101
+
+
+def test_statx_matches_lstat( tmpdir ):
+    path = os.path.join( str( tmpdir ), 'file' )
+    with open( path, 'wb' ) as f:
+        f.write( b'x' * 10 )
+    st = os.lstat( path )
+    stx = statx.statx( path )
+    for k in ( 'st_mode', 'st_ino', 'st_dev', 'st_nlink', 'st_uid', 'st_gid',
+               'st_size', 'st_mtime_ns', 'st_ctime_ns' ):
+        assert getattr( stx, k ) == getattr( st, k )
+    fst = statx.faststat( path )
+    assert ( fst.st_mode, fst.st_ino, fst.st_ctime_ns ) == \
+           ( st.st_mode, st.st_ino, st.st_ctime_ns )
+
+
+def test_faststat_lazy_fields( tmpdir, monkeypatch ):
+    path = os.path.join( str( tmpdir ), 'file' )
+    with open( path, 'wb' ) as f:
+        f.write( b'x' * 10 )
+    # simulate a filesystem (ie: Lustre) that returns only the requested fields
+    st = os.lstat( path )
+    partial = os.stat_result( tuple( st[:6] ) + ( None, None, None, st[9] ),
+                              { 'st_ctime': st.st_ctime } )
+    monkeypatch.setattr( statx, 'faststat', lambda p: partial )
+    f = fsitem.FSItem( path, faststat=True )
+    assert f.is_regular()
+    assert f.ctime == st.st_ctime
+    assert f.stat().st_size is None
+    # size is fetched (full stat) on first use only
+    assert f.size == 10
+    assert f.stat().st_size == 10
+    assert f.mtime == st.st_mtime
+
+
+def test_lazysize_fallback( lfs_tmpdir, monkeypatch ):
+    path = os.path.join( str( lfs_tmpdir ), 'file' )
+    with open( path, 'wb' ) as f:
+        f.write( b'x' * 10 )
+    st = os.lstat( path )
+    partial = os.stat_result( tuple( st[:6] ) + ( None, None, None, st[9] ) )
+    monkeypatch.setattr( statx, 'faststat', lambda p: partial )
+    monkeypatch.setattr( pylut, 'getsom', lambda p: 7 )
+    assert fsitem.FSItem( path, faststat=True ).lazysize() == 7
+    def _nosom( p ):
+        raise pylut.Run_Cmd_Error( code=1, reason='not supported', cmd='lfs getsom' )
+    monkeypatch.setattr( pylut, 'getsom', _nosom )
+    assert fsitem.FSItem( path, faststat=True ).lazysize() == 10
+    assert fsitem.FSItem( path ).lazysize() == 10
+
+
+def test_prefetch_stat( tmpdir ):
+    paths = []
+    for i in range( 50 ):
+        p = os.path.join( str( tmpdir ), 'f{0}'.format( i ) )
+        with open( p, 'wb' ) as f:
+            f.write( b'x' * i )
+        paths.append( p )
+    items = [ fsitem.FSItem( p ) for p in paths ]
+    items.append( fsitem.FSItem( os.path.join( str( tmpdir ), 'missing' ) ) )
+    items[0].stat()
+    assert fsitem.prefetch_stat( items, workers=8 ) == 49
+    for i, f in enumerate( items[:-1] ):
+        assert f._statinfo is not None
+        assert f.size == i
+    assert items[-1].exists() == False
+
+
+def test_byfid( lfs_tmpdir, monkeypatch ):
+    # plain directory standing in for <mountpoint>/.lustre/fid
+    mnt = str( lfs_tmpdir )
+    monkeypatch.setattr( pylut, 'FIDDIR', 'fakefid' )
+    os.mkdir( os.path.join( mnt, 'fakefid' ) )
+    deep = os.path.join( mnt, *[ 'd{0}'.format( i ) for i in range( 10 ) ] )
+    os.makedirs( deep )
+    path = os.path.join( deep, 'file' )
+    with open( path, 'wb' ) as f:
+        f.write( b'x' * 10 )
+    fid = '[0x200000400:0x1:0x0]'
+    os.link( path, os.path.join( mnt, 'fakefid', fid ) )
+    f = fsitem.FSItem( path, mountpoint=mnt, byfid=True )
+    # FID not known yet, path is used
+    assert f.datapath() == path
+    f.set_inode( fid )
+    assert f.datapath() == os.path.join( mnt, 'fakefid', fid )
+    assert f.absname == path
+    # stat and data must not touch the path any more
+    os.rename( path, path + '.moved' )
+    assert f.size == 10
+    assert f.checksum() == fsitem.FSItem( path + '.moved' ).checksum()
+    f.set_byfid( False )
+    f.update()
+    assert f.exists() == False
@@ -0,0 +1,69 @@
+import pytest
+import sys
+import metrics
+import runcmd
+
+
+def test_disabled():
+    metrics.reset()
+    assert metrics.enabled == False
+    with metrics.timer( 'x', nbytes=10 ):
+        metrics.incr( 'y' )
+    metrics.gauge( 'z', 1 )
+    assert metrics.snapshot() == { 'counters': {}, 'gauges': {}, 'histograms': {} }
+
+
+def test_timer( recording ):
+    with metrics.timer( 'op', nbytes=100 ):
+        pass
+    with pytest.raises( ValueError ):
+        with metrics.timer( 'op', nbytes=100 ):
+            raise ValueError()
+    metrics.incr( 'files', 3 )
+    snap = metrics.snapshot()
+    assert snap[ 'counters' ] == { 'op.calls': 2, 'op.errors': 1, 'op.bytes': 100,
+                                   'files': 3 }
+    h = snap[ 'histograms' ][ 'op' ]
+    assert h[ 'count' ] == 2
+    assert h[ 'buckets' ][-1] == ( float( 'inf' ), 2 )
+    metrics.reset()
+    assert metrics.snapshot()[ 'counters' ] == {}
+
+
+def test_gauge( recording ):
+    metrics.gauge( 'inflight', 5, labels={ 'ost': 1 } )
+    metrics.gauge( 'inflight', 2, labels={ 'ost': 1 } )
+    assert metrics.snapshot()[ 'gauges' ] == { 'inflight{ost="1"}': 2 }
+
+
+def test_histogram_buckets():
+    h = metrics.Histogram( buckets=( 1, 10, float( 'inf' ) ) )
+    for v in ( 0.5, 1, 2, 20 ):
+        h.observe( v )
+    assert h.as_dict() == { 'count': 4, 'sum': 23.5,
+                            'buckets': [ ( 1, 2 ), ( 10, 3 ), ( float( 'inf' ), 4 ) ] }
+
+
+def test_runcmd_kinds( recording ):
+    runcmd.runcmd( [ 'echo', 'path2fid' ] )
+    runcmd.runcmd( [ 'echo' ], opts={ 'bs': 1 } )
+    with pytest.raises( runcmd.Run_Cmd_Error ):
+        runcmd.runcmd( [ sys.executable, '-c', 'raise SystemExit( 1 )' ] )
+    counters = metrics.snapshot()[ 'counters' ]
+    assert counters[ 'runcmd.echo.path2fid.calls' ] == 1
+    assert counters[ 'runcmd.echo.calls' ] == 1
+    name = 'runcmd.{0}'.format( sys.executable.rsplit( '/', 1 )[-1] )
+    assert counters[ name + '.errors' ] == 1
+
+
+def test_syncfile_error_labels( recording ):
+    import pylut
+    pylut._count_error( pylut.SyncError(
+        reason="errors during sync of '/a/b c' -> '/d/e'", origin=None ) )
+    pylut._count_error( pylut.SyncError( reason=b'rsync: /x/y: Permission denied\nmore', origin=None ) )
+    pylut._count_actions( { 'data_copy': True, 'meta_update': False } )
+    counters = metrics.snapshot()[ 'counters' ]
+    assert counters == {
+        'syncfile.errors{reason="errors during sync of _ -> _"}': 1,
+        'syncfile.errors{reason="rsync: _ Permission denied"}': 1,
+        'syncfile.action{action="data_copy"}': 1 }
@@ -0,0 +1,70 @@
+import pytest
+import os
+import json
+import urllib.request
+import metrics
+import metricsexport
+
+
+@pytest.fixture
+def registry():
+    r = metrics.Registry()
+    r.incr( 'syncfile.calls', 10 )
+    r.incr( 'syncfile.copy.bytes', 4096 )
+    r.incr( 'syncfile.action', 7, labels={ 'action': 'data_copy' } )
+    r.incr( 'syncfile.errors', labels={ 'reason': 'Checksum "bad"' } )
+    r.incr( 'fid2path_cache.hits', 3 )
+    r.incr( 'fid2path_cache.misses', 1 )
+    r.observe( 'syncfile.copy', 0.002 )
+    r.gauge( 'scheduler.inflight_bytes', 1024, labels={ 'ost': 3, 'side': 'src' } )
+    return r
+
+
+def test_prometheus_text( registry ):
+    text = metricsexport.prometheus_text( registry.snapshot(), extra={ 'x.ratio': 0.5 } )
+    lines = text.splitlines()
+    assert '# TYPE pylut_syncfile_calls_total counter' in lines
+    assert 'pylut_syncfile_calls_total 10' in lines
+    assert 'pylut_syncfile_action_total{action="data_copy"} 7' in lines
+    assert 'pylut_syncfile_errors_total{reason="Checksum \\"bad\\""} 1' in lines
+    assert '# TYPE pylut_syncfile_copy_seconds histogram' in lines
+    assert 'pylut_syncfile_copy_seconds_bucket{le="0.0025"} 1' in lines
+    assert 'pylut_syncfile_copy_seconds_bucket{le="+Inf"} 1' in lines
+    assert 'pylut_syncfile_copy_seconds_count 1' in lines
+    assert 'pylut_x_ratio 0.5' in lines
+    assert '# TYPE pylut_scheduler_inflight_bytes gauge' in lines
+    assert 'pylut_scheduler_inflight_bytes{ost="3",side="src"} 1024' in lines
+    # one TYPE line per family
+    assert len( [ l for l in lines if l.startswith( '# TYPE pylut_syncfile_action' ) ] ) == 1
+
+
+def test_export_files( registry, tmpdir ):
+    prom = os.path.join( str( tmpdir ), 'pylut.prom' )
+    jlog = os.path.join( str( tmpdir ), 'pylut.jsonl' )
+    e = metricsexport.Exporter( textfile=prom, jsonlog=jlog, registry=registry )
+    e.export()
+    registry.incr( 'syncfile.calls', 10 )
+    e._prevtime -= 10
+    e.export()
+    # no tmp files left behind
+    assert sorted( os.listdir( str( tmpdir ) ) ) == [ 'pylut.jsonl', 'pylut.prom' ]
+    with open( prom ) as f:
+        assert 'pylut_syncfile_calls_total 20\n' in f.read()
+    with open( jlog ) as f:
+        records = [ json.loads( l ) for l in f ]
+    assert len( records ) == 2
+    assert records[1][ 'counters' ][ 'syncfile.calls' ] == 20
+    assert records[1][ 'derived' ][ 'fid2path_cache.hit_ratio' ] == 0.75
+    assert abs( records[1][ 'derived' ][ 'syncfile.calls.rate' ] - 1.0 ) < 0.1
+    assert records[1][ 'histograms' ][ 'syncfile.copy' ][ 'count' ] == 1
+
+
+def test_exporter_thread_and_http( registry, tmpdir ):
+    prom = os.path.join( str( tmpdir ), 'pylut.prom' )
+    with metricsexport.Exporter( textfile=prom, interval=60, http_port=0,
+                                 registry=registry ) as e:
+        url = 'http://127.0.0.1:{0}/metrics'.format( e.http_port )
+        body = urllib.request.urlopen( url, timeout=10 ).read().decode()
+        assert 'pylut_syncfile_calls_total 10' in body
+    # final export on stop
+    assert os.path.isfile( prom )
@@ -0,0 +1,64 @@
+import pytest
+import os
+import mountinfo
+import fsitem
+
+
+sample_mountinfo = """\
+22 1 0:21 / / rw,relatime shared:1 - ext4 /dev/sda1 rw
+23 22 0:22 / /proc rw,nosuid,nodev,noexec,relatime shared:5 - proc proc rw
+40 22 0:35 / /mnt/lustre rw,flock shared:20 - lustre 10.0.0.1@o2ib:/fs1 rw,flock,lazystatfs
+41 40 0:36 / /mnt/lustre/scratch rw - nfs server:/export rw
+42 22 0:37 / /mnt/with\\040space rw - xfs /dev/sdb1 rw
+43 22 0:38 / /mnt/lustre2 rw - ext4 /dev/sdc1 rw
+44 22 0:39 / /mnt/lustre2 rw - lustre 10.0.0.2@tcp:/fs2 rw
+"""
+
+
+@pytest.fixture
+def table( tmpdir ):
+    p = os.path.join( str( tmpdir ), 'mountinfo' )
+    with open( p, 'w' ) as f:
+        f.write( sample_mountinfo )
+    return mountinfo.MountTable( p )
+
+
+def test_parse( table ):
+    assert len( table.mounts ) == 6
+    m = table.mounts[ '/mnt/lustre' ]
+    assert m.fstype == 'lustre'
+    assert m.source == '10.0.0.1@o2ib:/fs1'
+    assert '/mnt/with space' in table.mounts
+    # stacked mount, last one wins
+    assert table.mounts[ '/mnt/lustre2' ].fstype == 'lustre'
+
+
+@pytest.mark.parametrize( 'path,expected', [
+    ( '/', '/' ),
+    ( '/etc/passwd', '/' ),
+    ( '/mnt/lustre', '/mnt/lustre' ),
+    ( '/mnt/lustre/a/b/c', '/mnt/lustre' ),
+    ( '/mnt/lustreX/a', '/' ),
+    ( '/mnt/lustre/scratch/x', '/mnt/lustre/scratch' ),
+    ( '/mnt/with space/x', '/mnt/with space' ),
+] )
+def test_lookup( table, path, expected ):
+    assert table.lookup( path ).mountpoint == expected
+
+
+def test_find_caches_dirs( table ):
+    assert table.getmountpoint( '/mnt/lustre/a/f1' ) == '/mnt/lustre'
+    assert table.getmountpoint( '/mnt/lustre/a/f2' ) == '/mnt/lustre'
+    assert list( table._dircache ) == [ '/mnt/lustre/a' ]
+    # mountpoint itself resolves to its own mount, not its parent's
+    assert table.getmountpoint( '/mnt/lustre/scratch' ) == '/mnt/lustre/scratch'
+    table.refresh()
+    assert table._dircache == {}
+
+
+def test_getmountpoint_matches_ismount( tmpdir ):
+    for path in [ str( tmpdir ), '/', '/proc/self', os.getcwd() ]:
+        expected = os.path.realpath( path )
+        while not os.path.ismount( expected ):
+            expected = os.path.dirname( expected )
+        assert fsitem.getmountpoint( path ) == expected
@@ -0,0 +1,77 @@
+import os
+import stat
+import pytest
+import pstestdir
+
+
+@pytest.fixture
+def gen( tmp_path, monkeypatch ):
+    monkeypatch.chdir( tmp_path )
+    pstestdir.reset_config()
+    pstestdir.config.NUM_OBJECTS = 300
+    pstestdir.config.SET_STRIPES = False
+    yield pstestdir
+    pstestdir.reset_config()
+
+
+def _planned( gen ):
+    return gen.plan( gen.config.SOURCE_DIR, gen.config.NUM_OBJECTS, gen.config.SEED )
+
+
+def test_plan_is_seeded( gen ):
+    first = _planned( gen )
+    assert _planned( gen ) == first
+    gen.config.SEED = 2
+    assert _planned( gen ) != first
+
+
+def test_plan_order( gen ):
+    seen = { gen.config.SOURCE_DIR }
+    for e in _planned( gen ):
+        assert os.path.dirname( e.path ) in seen
+        if e.typ == 'h':
+            assert e.tgt in seen
+        seen.add( e.path )
+    assert len( seen ) == 300 + 1
+
+
+def test_size_distribution( gen ):
+    gen.config.SIZE_DISTRIBUTION = [ ( 1, 10, 20 ), ( 1, 1000, 2000 ) ]
+    sizes = [ e.size for e in _planned( gen ) if e.typ == 'f' ]
+    assert all( 10 <= s <= 20 or 1000 <= s <= 2000 for s in sizes )
+    assert any( s <= 20 for s in sizes ) and any( s >= 1000 for s in sizes )
+
+
+def test_create_and_manifest( gen ):
+    gen.config.WORKERS = 4
+    gen.config.BATCH_SIZE = 16
+    gen.config.MANIFEST = 'manifest.jsonl'
+    gen.reset()
+    assert len( gen.files ) + len( gen.directories ) == 300 + 1
+    for f in gen.files + gen.directories:
+        st = os.lstat( f.path )
+        assert st.st_ino == f.inode()
+        if f.typ == 'f':
+            assert stat.S_ISREG( st.st_mode )
+        elif f.typ == 'l':
+            assert os.readlink( f.path ) == f.tgt
+    for inode, flist in gen.objects.items():
+        assert os.lstat( flist[0].path ).st_nlink >= len( flist )
+    created = { f.path: ( f.typ, f.inode(), f.mode() ) for f in gen.files }
+    gen.load_manifest( 'manifest.jsonl' )
+    assert { f.path: ( f.typ, f.inode(), f.mode() ) for f in gen.files } == created
+    assert gen.source == os.path.abspath( gen.config.SOURCE_DIR )
+
+
+def test_content_is_reproducible( gen ):
+    gen.reset()
+    first = {}
+    for f in gen.files:
+        if f.typ == 'f':
+            with open( f.path, 'rb' ) as fh:
+                first[ f.path ] = fh.read()
+    gen.config.WORKERS = 1
+    gen.reset()
+    for path, data in first.items():
+        with open( path, 'rb' ) as fh:
+            assert fh.read() == data
@@ -8,10 +8,12 @@ import os
 #import itertools
 import pylut
 import fsitem
+import backend
 import time
 import pprint
 import random
 import stat
+import asyncio
 from runcmd import runcmd, Run_Cmd_Error
 
 # NOTE: pytest fixture "testdir" has scope level of "module", which means it will
@@ -45,7 +47,7 @@ def _path2fid( path ):
     output, errput = runcmd( [ 'lfs', 'path2fid' ], opts=None, args=[ path ] )
     if len( errput ) > 0:
         raise UserWarning()
-    return output.rstrip()
+    return os.fsdecode( output ).rstrip()
 
 
 def _getmountpoint( path ):
@@ -170,7 +172,7 @@ def _files_equal( f1, f2 ):
 
 
 def test_path2fid_valid_path( testdir ):
-    for inode, flist in testdir.objects.iteritems():
+    for inode, flist in testdir.objects.items():
         for f in flist:
             fid = _path2fid( f.path )
             FID = pylut.path2fid( f.path )
@@ -181,7 +183,7 @@ def test_path2fid_invalid_path( testdir ):
     """
     Verify that path2fid throws an error for an invalid path
     """
-    f = testdir.objects.values()[0][0]
+    f = next( iter( testdir.objects.values() ) )[0]
     path = '{0}xyz'.format( f.path )
     with pytest.raises( Run_Cmd_Error ) as einfo:
         FID = pylut.path2fid( path )
@@ -193,7 +195,7 @@ def test_fid2path_valid_fids( testdir ):
     """
     Verify that FID's with multiple links return the correct number of paths
     """
-    for inode, flist in testdir.objects.iteritems():
+    for inode, flist in testdir.objects.items():
         numlinks = len( flist )
         for f in flist:
             mnt = _getmountpoint( f.path )
@@ -209,7 +211,7 @@ def test_fid2path_invalid_fid( testdir ):
     Verify that fid2path throws an error for an invalid path
     """
     invalid_fids = [ '[0xffffffffff:0xfffff:0x0]', '[0xeeeeeeeeee:0xeeeee:0x0]' ]
-    mnt = _getmountpoint( testdir.objects.values()[0][0].path )
+    mnt = _getmountpoint( next( iter( testdir.objects.values() ) )[0].path )
     for fid in invalid_fids:
         with pytest.raises( Run_Cmd_Error ) as einfo:
             pylut.fid2path( mnt, fid )
@@ -222,7 +224,7 @@ def test_getstripe_valid_paths( testdir ):
     Verify stripecount and stripesize match expected values for files and dirs
     """
     testdir.reset()
-    for inode, flist in testdir.objects.iteritems():
+    for inode, flist in testdir.objects.items():
         for f in flist:
             if f.typ in [ 'd', 'f' ]:
                 sinfo = pylut.getstripeinfo( f.path )
@@ -237,7 +239,7 @@ def test_getstripe_invalid_path( testdir ):
     """
     Verify that getstripe throws an error for an invalid path
     """
-    f = testdir.objects.values()[0][0]
+    f = next( iter( testdir.objects.values() ) )[0]
     path = '{0}xyz'.format( f.path )
     with pytest.raises( Run_Cmd_Error ) as einfo:
         sinfo = pylut.getstripeinfo( '{0}xyz'.format( path ) )
@@ -308,7 +310,7 @@ def test_syncfile_01( testdir ):
     testdir.reset()
     syncopts = syncopts_defaults.copy()
     syncopts[ 'tmpbase' ] = os.path.abspath( testdir.psconfig.TMP_DIR )
-    f = testdir.objects.values()[0][0]
+    f = next( iter( testdir.objects.values() ) )[0]
     src = fsitem.FSItem( '{0}xyz'.format( f.path ) )
     tgt = fsitem.FSItem( src.absname.replace( testdir.source, testdir.target ) )
     with pytest.raises( pylut.SyncError ) as einfo:
@@ -509,6 +511,255 @@ def test_syncfile_07( testdir ):
         assert tmp_fid_orig != tmp.inode()
 
 
+def test_syncfile_byfid( testdir, monkeypatch ):
+    """
+    Initial sync, reading src through .lustre/fid
+    tmp NO
+    target NO
+    keeptmp NO
+    A plain directory (with a hardlink per FID) stands in for .lustre/fid,
+    so this runs without Lustre
+    """
+    testdir.reset()
+    testdir.mk_all_tgtdirs()
+    mnt = os.path.dirname( testdir.source )
+    backend.register( mnt, backend.LfsBackend() )
+    try:
+        monkeypatch.setattr( pylut, 'FIDDIR', 'fakefid' )
+        os.mkdir( os.path.join( mnt, 'fakefid' ) )
+        syncopts = syncopts_defaults.copy()
+        syncopts.update( keeptmp=False,
+                         byfid=True,
+                         tmpbase=os.path.abspath( testdir.psconfig.TMP_DIR )
+                       )
+        for f in testdir.files:
+            src = fsitem.FSItem( f.path, mountpoint=mnt )
+            fid = '[0x200000400:0x{0:x}:0x0]'.format( os.lstat( src.absname ).st_ino )
+            if not os.path.lexists( pylut.fidpath( mnt, fid ) ):
+                # hardlinks share a FID
+                os.link( src.absname, pylut.fidpath( mnt, fid ), follow_symlinks=False )
+            src.set_inode( fid )
+            tgt = fsitem.FSItem( src.absname.replace( testdir.source, testdir.target ) )
+            pylut.syncfile( src_path=src, tgt_path=tgt, **syncopts )
+            assert src.datapath() == pylut.fidpath( mnt, fid )
+            assert _files_match( src, tgt, syncopts )
+    finally:
+        backend.unregister( mnt )
+        if os.path.isdir( os.path.join( mnt, 'fakefid' ) ):
+            pylut.rmdir( os.path.join( mnt, 'fakefid' ) )
+
+
+def test_find_args( monkeypatch ):
+    """
+    Verify find passes filters to lfs find and decodes NUL separated output
+    """
+    calls = []
+    def fake( cmd, opts=None, args=None, sep=b'\n', timeout=None ):
+        calls.append( ( cmd, args, sep ) )
+        for p in ( b'/mnt/lustre/a', b'/mnt/lustre/b c' ):
+            yield p
+    monkeypatch.setattr( pylut, 'runcmd_stream', fake )
+    found = list( pylut.find( '/mnt/lustre', mtime='-1', type='f', stripe_count=4 ) )
+    assert found == [ '/mnt/lustre/a', '/mnt/lustre/b c' ]
+    cmd, args, sep = calls[0]
+    assert cmd[1:] == [ 'find' ]
+    assert args == [ '/mnt/lustre', '--type', 'f', '--mtime', '-1',
+                     '--stripe-count', 4, '--print0' ]
+    assert sep == b'\0'
+    items = list( pylut.find( '/mnt/lustre', items=True ) )
+    assert [ i.absname for i in items ] == found
+    with pytest.raises( UserWarning ):
+        list( pylut.find( '/mnt/lustre', newer='x' ) )
+
+
+def test_lfs_async_wrappers( monkeypatch ):
+    """
+    Verify the asyncio wrappers run the same lfs commands as the blocking ones
+    """
+    calls = []
+    async def fake( cmd, opts=None, args=None, limit=None ):
+        calls.append( cmd[1:] + list( args ) )
+        return ( b'[0x200000400:0x1:0x0]\n', b'' )
+    monkeypatch.setattr( pylut, 'runcmd_async', fake )
+    async def main():
+        fid = await pylut.path2fid_async( '/mnt/lustre/f' )
+        await pylut.setstripeinfo_async( '/mnt/lustre/g', count=4, size=1048576 )
+        return fid
+    assert asyncio.run( main() ) == '[0x200000400:0x1:0x0]'
+    assert calls == [ [ 'path2fid', '/mnt/lustre/f' ],
+                      [ 'setstripe', '-S', 1048576, '-c', 4, '/mnt/lustre/g' ] ]
+
+
+def test_rmdir( tmpdir, mktree ):
+    """
+    Verify rmdir removes the whole tree and reports the number removed
+    """
+    top = os.path.join( str( tmpdir ), 'doomed' )
+    count = len( mktree( top ) )
+    removed = pylut.rmdir( top )
+    assert removed == count
+    assert os.path.lexists( top ) == False
+    assert os.listdir( str( tmpdir ) ) == []
+
+
+def test_rmdir_symlinks( tmpdir, mktree ):
+    """
+    Verify rmdir removes symlinks but never follows them
+    """
+    keep = os.path.join( str( tmpdir ), 'keep' )
+    count = len( mktree( keep, depth=1 ) ) - 1
+    top = os.path.join( str( tmpdir ), 'doomed' )
+    mktree( top, depth=1 )
+    os.symlink( keep, os.path.join( top, 'dirlink' ) )
+    os.symlink( os.path.join( keep, 'f0' ), os.path.join( top, 'filelink' ) )
+    pylut.rmdir( top )
+    assert os.path.lexists( top ) == False
+    assert os.path.isfile( os.path.join( keep, 'f0' ) )
+    assert sum( len( d ) + len( f ) for r, d, f in os.walk( keep ) ) == count
+    with pytest.raises( pylut.RmdirError ):
+        os.symlink( keep, top )
+        pylut.rmdir( top )
+
+
+def test_rmdir_task_exception( tmpdir, mktree, monkeypatch ):
+    """
+    Verify rmdir reports, instead of hanging on, unexpected errors in tasks
+    """
+    top = os.path.join( str( tmpdir ), 'doomed' )
+    mktree( top, depth=1 )
+    def bad_unlink( path ):
+        raise ValueError( path )
+    monkeypatch.setattr( os, 'unlink', bad_unlink )
+    with pytest.raises( pylut.RmdirError ):
+        pylut.rmdir( top )
+
+
+def test_cleantmpbase( tmpdir ):
+    """
+    Verify cleantmpbase removes unneeded tmp files and empty tmpdirs only
+    """
+    tmpbase = str( tmpdir )
+    fids = [ '[0x200000400:0x{0:x}:0x0]'.format( i ) for i in range( 20 ) ]
+    for fid in fids:
+        d = os.path.join( tmpbase, hex( hash( fid ) )[-5:] )
+        if not os.path.isdir( d ):
+            os.makedirs( d )
+        with open( os.path.join( d, fid ), 'wb' ):
+            pass
+    keep = set( fids[:5] )
+    removed = pylut.cleantmpbase( tmpbase, needed=lambda fid: fid in keep )
+    assert removed == 15
+    remaining = [ f for r, d, fl in os.walk( tmpbase ) for f in fl ]
+    assert set( remaining ) == keep
+    assert len( os.listdir( tmpbase ) ) <= 5
+    assert pylut.cleantmpbase( tmpbase ) == 5
+    assert os.listdir( tmpbase ) == []
+
+
+def _fake_fid2path( known, calls, abort=False ):
+    """
+    Stand-in for runcmd running "lfs fid2path --print-fid".  Like lfs, fids
+    are printed in their "[0x<seq>:0x<oid>:0x<ver>]" form, paths of the
+    known fids are printed, unknown fids are reported on stderr and make the
+    command fail.  If abort is True, stop silently at the first unknown fid
+    instead.
+    """
+    def fake( cmd, opts=None, args=None ):
+        fids = args[2:]
+        calls.append( fids )
+        lines = []
+        errs = []
+        for f in fids:
+            fid = '[0x{0:x}:0x{1:x}:0x{2:x}]'.format(
+                *[ int( x, 16 ) for x in f.strip( '[]' ).split( ':' ) ] )
+            if fid not in known:
+                if abort:
+                    errs.append( '' )
+                    break
+                errs.append( "lfs fid2path: cannot find '{0}': No such file or directory (2)".format( f ) )
+                continue
+            lines.extend( '{0} {1}'.format( fid, p ) for p in known[ fid ] )
+        output = ''.join( l + '\n' for l in lines ).encode()
+        if errs:
+            raise Run_Cmd_Error( code=2, reason=''.join( e + '\n' for e in errs if e ).encode(),
+                                 cmd=cmd, output=output )
+        return ( output, b'' )
+    return fake
+
+
+def test_fid2path_bulk( monkeypatch ):
+    """
+    Verify fid2path_bulk batches fids, keeps hardlinks and names with spaces,
+    and only drops the fids that can't be resolved, without extra runs
+    """
+    known = { '[0x200000400:0x{0:x}:0x0]'.format( i ): [ '/mnt/lustre/d/f {0}'.format( i ) ]
+              for i in range( 25 ) }
+    known[ '[0x200000400:0x1:0x0]' ].append( '/mnt/lustre/d/link1' )
+    calls = []
+    monkeypatch.setattr( pylut, 'runcmd', _fake_fid2path( known, calls ) )
+    missing = [ '[0x200000400:0xdead:0x0]', '[0x200000400:0xbeef:0x0]' ]
+    rv = pylut.fid2path_bulk( '/mnt/lustre', list( known ) + missing,
+                              batchsize=10, workers=2 )
+    assert rv == known
+    # 3 batches, the stale fids are reported on stderr and not retried
+    assert len( calls ) == 3
+
+
+def test_fid2path_bulk_retry( monkeypatch ):
+    """
+    Verify fids that weren't reached by a failed run are retried, and a
+    batch is only bisected when a failed run resolves nothing
+    """
+    known = { '[0x200000400:0x{0:x}:0x0]'.format( i ): [ '/mnt/lustre/f{0}'.format( i ) ]
+              for i in range( 8 ) }
+    fids = list( known )
+    missing = '[0x200000400:0xdead:0x0]'
+    calls = []
+    monkeypatch.setattr( pylut, 'runcmd', _fake_fid2path( known, calls, abort=True ) )
+    rv = pylut.fid2path_bulk( '/mnt/lustre', fids[:4] + [ missing ] + fids[4:],
+                              batchsize=100 )
+    assert rv == known
+    assert calls[0] == fids[:4] + [ missing ] + fids[4:]
+    assert calls[1] == [ missing ] + fids[4:]
+    assert [ missing ] in calls
+    assert len( calls ) < 8
+
+
+def test_fid2path_bulk_normalize( monkeypatch ):
+    """
+    Verify results are keyed by the fids as passed in, however lfs spells them
+    """
+    known = { '[0x200000400:0x1a:0x0]': [ '/mnt/lustre/a' ] }
+    calls = []
+    monkeypatch.setattr( pylut, 'runcmd', _fake_fid2path( known, calls ) )
+    wanted = [ '0x200000400:0x1A:0x0', '[0x0200000400:0x001a:0x0]' ]
+    rv = pylut.fid2path_bulk( '/mnt/lustre', wanted )
+    assert rv == dict( ( f, [ '/mnt/lustre/a' ] ) for f in wanted )
+
+
+def test_fid2path_cache( monkeypatch ):
+    """
+    Verify Fid2PathCache only resolves misses and honors maxsize, invalidate
+    """
+    known = { '[0x200000400:0x{0:x}:0x0]'.format( i ): [ '/mnt/lustre/f{0}'.format( i ) ]
+              for i in range( 10 ) }
+    fids = sorted( known )
+    calls = []
+    monkeypatch.setattr( pylut, 'runcmd', _fake_fid2path( known, calls ) )
+    cache = pylut.Fid2PathCache( '/mnt/lustre', maxsize=8 )
+    assert cache.resolve( fids[:5] ) == { f: known[ f ] for f in fids[:5] }
+    assert cache.resolve( fids[:5] ) == { f: known[ f ] for f in fids[:5] }
+    assert len( calls ) == 1
+    assert ( cache.hits, cache.misses ) == ( 5, 5 )
+    cache.resolve( fids )
+    assert calls[-1] == fids[5:]
+    assert len( cache ) == 8
+    cache.invalidate( fids[9:] )
+    assert len( cache ) == 7
+    cache.invalidate()
+    assert len( cache ) == 0
+
+
 
 
 
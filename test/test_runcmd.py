@@ -0,0 +1,84 @@
+import pytest
+import os
+import sys
+import time
+import asyncio
+from runcmd import runcmd, runcmd_stream, runcmd_async, Run_Cmd_Error, Run_Cmd_Timeout
+
+
+def _py( code ):
+    return [ sys.executable, '-c', code ]
+
+
+def test_runcmd_stream_records():
+    code = "import sys; sys.stdout.write( 'a b\\0c\\0' + 'x' * 100000 )"
+    recs = list( runcmd_stream( _py( code ), sep=b'\0', bufsize=4096 ) )
+    assert recs == [ b'a b', b'c', b'x' * 100000 ]
+
+
+def test_runcmd_stream_error():
+    code = "import sys; print( 'one' ); sys.stderr.write( 'e' * 200000 ); sys.exit( 3 )"
+    gen = runcmd_stream( _py( code ) )
+    assert next( gen ) == b'one'
+    with pytest.raises( Run_Cmd_Error ) as einfo:
+        next( gen )
+    assert einfo.value.code == 3
+    assert len( einfo.value.reason ) == 200000
+
+
+def test_runcmd_stream_close_kills():
+    code = "import sys, time\nwhile True:\n    print( 'y' ); sys.stdout.flush(); time.sleep( 0.01 )"
+    gen = runcmd_stream( _py( code ) )
+    assert next( gen ) == b'y'
+    gen.close()
+
+
+def test_runcmd_stream_chunks():
+    code = "import sys; sys.stdout.write( 'x' * 100000 )"
+    chunks = list( runcmd_stream( _py( code ), sep=None, bufsize=4096 ) )
+    assert all( len( c ) <= 4096 for c in chunks )
+    assert b''.join( chunks ) == b'x' * 100000
+
+
+def test_runcmd_timeout():
+    with pytest.raises( Run_Cmd_Timeout ):
+        runcmd( _py( "import time; time.sleep( 30 )" ), timeout=0.5 )
+    assert runcmd( _py( "print( 1 )" ), timeout=10 )[0] == b'1\n'
+
+
+def test_runcmd_session():
+    # only commands with a timeout leave the caller's process group
+    code = "import os; print( os.getpgrp() )"
+    assert int( runcmd( _py( code ) )[0] ) == os.getpgrp()
+    assert int( next( runcmd_stream( _py( code ) ) ) ) == os.getpgrp()
+    assert int( runcmd( _py( code ), timeout=10 )[0] ) != os.getpgrp()
+
+
+def test_runcmd_stream_timeout_kills_group():
+    # the child of the command must not keep stdout open after the timeout
+    code = "import subprocess, sys; subprocess.call( [ sys.executable, '-c', " \
+           "'import time; print( 1, flush=True ); time.sleep( 30 )' ] )"
+    gen = runcmd_stream( _py( code ), timeout=0.5 )
+    assert next( gen ) == b'1'
+    with pytest.raises( Run_Cmd_Timeout ):
+        list( gen )
+
+
+def test_runcmd_async():
+    async def main():
+        limit = asyncio.Semaphore( 10 )
+        start = time.time()
+        results = await asyncio.gather( *[
+            runcmd_async( _py( "import time; time.sleep( 0.5 ); print( {0} )".format( i ) ),
+                          limit=limit )
+            for i in range( 20 ) ] )
+        elapsed = time.time() - start
+        assert [ r[0] for r in results ] == [ '{0}\n'.format( i ).encode() for i in range( 20 ) ]
+        # two rounds of 10
+        assert 1.0 <= elapsed < 5
+        with pytest.raises( Run_Cmd_Error ) as einfo:
+            await runcmd_async( _py( "import sys; sys.exit( 4 )" ) )
+        assert einfo.value.code == 4
+        with pytest.raises( Run_Cmd_Timeout ):
+            await runcmd_async( _py( "import time; time.sleep( 30 )" ), timeout=0.5 )
+    asyncio.run( main() )
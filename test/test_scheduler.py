@@ -0,0 +1,112 @@
+import time
+import threading
+import fsitem
+import metrics
+import pylut
+import scheduler
+
+MiB = 1024 * 1024
+
+
+def _mkfile( sim, path, size, offset, count=1 ):
+    sim.setstripeinfo( path, count=count, size=MiB, offset=offset )
+    with open( path, 'r+b' ) as f:
+        f.truncate( size )
+    return fsitem.FSItem( path )
+
+
+def test_stripe_bytes():
+    assert scheduler.stripe_bytes( 0, 2, MiB ) == []
+    assert scheduler.stripe_bytes( 5 * MiB // 2, 2, MiB ) == [ 3 * MiB // 2, MiB ]
+    assert scheduler.stripe_bytes( 100, 4, MiB ) == [ 100, 0, 0, 0 ]
+    assert scheduler.stripe_bytes( 9 * MiB, 4, MiB ) == [ 3 * MiB, 2 * MiB, 2 * MiB, 2 * MiB ]
+    si = pylut.LustreStripeInfo( count=2, size=MiB, index_info=[ ( 3, 1, 0 ), ( 0, 1, 0 ) ] )
+    assert scheduler.ost_bytes( si, 3 * MiB ) == { 3: 2 * MiB, 0: MiB }
+    assert scheduler.ost_bytes( pylut.LustreStripeInfo(), 100 ) == {}
+
+
+class _Recorder( object ):
+    """ Stand-in for pylut.syncfile, records what ran concurrently
+    """
+    def __init__( self, sched ):
+        self.sched = sched
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+        self.peak_src = 0
+        self.offsets = []
+
+    def __call__( self, src, tgt, tmpbase=None, stripe_offset=None, **opts ):
+        with self.lock:
+            self.active += 1
+            self.peak = max( self.peak, self.active )
+            self.peak_src = max( [ self.peak_src ] +
+                                 list( self.sched.inflight()[ 'src' ].values() ) )
+            self.offsets.append( stripe_offset )
+        time.sleep( 0.01 )
+        with self.lock:
+            self.active -= 1
+        return ( None, { 'data_copy': True, 'meta_update': True } )
+
+
+def test_source_ost_cap( sim, tmp_path, recording ):
+    # 8 files on OST 0, 4 spread over the other OSTs
+    pairs = []
+    for i in range( 12 ):
+        src = _mkfile( sim, str( tmp_path / 'f{0}'.format( i ) ), 4 * MiB,
+                       0 if i < 8 else 1 + i % 3 )
+        pairs.append( ( src, fsitem.FSItem( str( tmp_path / 't{0}'.format( i ) ) ) ) )
+    s = scheduler.OstScheduler( workers=8, max_ost_bytes=4 * MiB )
+    rec = s.syncfile = _Recorder( s )
+    rv = s.sync( pairs, str( tmp_path / 'tmp' ) )
+    assert ( rv[ 'synced' ], rv[ 'data_copy' ], rv[ 'bytes' ] ) == ( 12, 12, 48 * MiB )
+    assert rv[ 'errors' ] == []
+    # never two files on OST 0 at once, but the other OSTs kept busy
+    assert rec.peak_src <= 4 * MiB
+    assert rec.peak > 1
+    assert s.inflight() == { 'src': {}, 'tgt': {} }
+    counters = metrics.snapshot()[ 'counters' ]
+    assert counters[ 'scheduler.dispatched' ] == 12
+    assert counters[ 'scheduler.ost_bytes{ost="0",side="src"}' ] == 32 * MiB
+    assert counters[ 'scheduler.deferred{ost="0",side="src"}' ] > 0
+    gauges = metrics.snapshot()[ 'gauges' ]
+    assert gauges[ 'scheduler.inflight_bytes{ost="0",side="src"}' ] == 0
+    assert gauges[ 'scheduler.running' ] == 0
+
+
+def test_target_placement( sim, tmp_path ):
+    pairs = [ ( _mkfile( sim, str( tmp_path / 'f{0}'.format( i ) ), 2 * MiB, 0 ),
+                fsitem.FSItem( str( tmp_path / 't{0}'.format( i ) ) ) ) for i in range( 4 ) ]
+    s = scheduler.OstScheduler( workers=4, max_ost_bytes=64 * MiB, tgt_osts=4 )
+    rec = s.syncfile = _Recorder( s )
+    s.sync( pairs, str( tmp_path / 'tmp' ) )
+    # all sources share OST 0, the targets are spread over all OSTs
+    assert sorted( rec.offsets ) == [ 0, 1, 2, 3 ]
+
+
+def test_no_starvation( sim, tmp_path ):
+    big = _mkfile( sim, str( tmp_path / 'big' ), 8 * MiB, 0 )
+    pairs = [ ( _mkfile( sim, str( tmp_path / 's0' ), MiB, 0 ),
+                fsitem.FSItem( str( tmp_path / 't0' ) ) ),
+              ( big, fsitem.FSItem( str( tmp_path / 'tbig' ) ) ) ]
+    pairs += [ ( _mkfile( sim, str( tmp_path / 's{0}'.format( i ) ), MiB, 0 ),
+                 fsitem.FSItem( str( tmp_path / 't{0}'.format( i ) ) ) ) for i in range( 1, 20 ) ]
+    s = scheduler.OstScheduler( workers=2, max_ost_bytes=2 * MiB, maxskips=2 )
+    order = []
+    def _sync( src, tgt, **opts ):
+        order.append( src.absname )
+        time.sleep( 0.005 )
+        return ( None, { 'data_copy': True, 'meta_update': False } )
+    s.syncfile = _sync
+    s.sync( pairs, str( tmp_path / 'tmp' ) )
+    assert order.index( big.absname ) < 6
+
+
+def test_syncfile_stripe_offset( sim, rsync, tmp_path ):
+    src = _mkfile( sim, str( tmp_path / 'src' ), 3 * MiB, 0, count=2 )
+    tgt = fsitem.FSItem( str( tmp_path / 'tgt' ) )
+    rv = scheduler.OstScheduler( tgt_osts=4 ).sync( [ ( src, tgt ) ], str( tmp_path / 'tmp' ) )
+    assert rv[ 'errors' ] == []
+    si = sim.getstripeinfo( tgt.absname )
+    assert si.count == 2
+    assert si.offset == 0
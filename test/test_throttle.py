@@ -0,0 +1,176 @@
+import io
+import os
+import time
+import pytest
+import backend
+import fsitem
+import pylut
+import throttle
+
+MiB = 1024 * 1024
+
+
+def test_token_bucket():
+    b = throttle.TokenBucket( 100, 50 )
+    now = b.stamp
+    assert b.take( 50, now ) == 0.0
+    # debt: wait until it is paid back
+    assert b.take( 20, now ) == pytest.approx( 0.2 )
+    # refill is capped at the capacity
+    assert b.take( 10, now + 10 ) == 0.0
+    assert b.tokens == 40
+    b.set( 10, 5 )
+    assert b.tokens <= 5
+
+
+def test_configure():
+    t = throttle.Throttle()
+    assert not t.active
+    t.configure( { 'bandwidth': '10M', 'ost.*.iops': 100, 'ost.3.bandwidth': '1M',
+                   'burst': 0.5 } )
+    assert t.active and t.per_ost
+    assert t.limits[ 'bandwidth' ] == 10 * MiB
+    assert t._bucket( 'bandwidth', 'global' ).capacity == 5 * MiB
+    assert t._bucket( 'bandwidth', 3 ).rate == MiB
+    assert t._bucket( 'bandwidth', 4 ) is None
+    assert t._bucket( 'iops', 4 ).rate == 100
+    # a drained bucket stays drained when its rate changes
+    t.reserve( nbytes=5 * MiB )
+    t.configure( { 'bandwidth': '20M', 'ost.*.iops': 200 } )
+    assert t._bucket( 'bandwidth', 'global' ).tokens < MiB
+    assert t._bucket( 'iops', 4 ).rate == 200
+    assert t._bucket( 'bandwidth', 3 ) is None
+    t.configure( {} )
+    assert not t.active
+    assert t.reserve( nbytes=MiB, ops=10, ost=1 ) == 0.0
+    with pytest.raises( throttle.ThrottleError ):
+        t.configure( { 'ost.x.bandwidth': 1 } )
+    with pytest.raises( throttle.ThrottleError ):
+        t.configure( { 'bandwidth': '10Q' } )
+
+
+def test_rate():
+    t = throttle.Throttle( { 'bandwidth': '16M', 'burst': 0.125 } )
+    start = time.monotonic()
+    nbytes = sum( len( c ) for c in throttle.chunks(
+        io.BytesIO( bytes( 4 * MiB ) ), chunksize=256 * 1024, throttle=t ) )
+    elapsed = time.monotonic() - start
+    assert nbytes == 4 * MiB
+    # 2MiB burst, the other 2MiB at 16MiB/s
+    assert elapsed >= 0.12
+
+
+class _Recorder( object ):
+    def __init__( self ):
+        self.calls = []
+
+    def acquire( self, nbytes=0, ops=0, ost=None ):
+        self.calls.append( ( nbytes, ops, ost ) )
+
+
+def test_chunks_by_ost():
+    si = pylut.LustreStripeInfo( count=2, size=MiB, index_info=[ ( 5, 1, 0 ), ( 2, 1, 0 ) ] )
+    rec = _Recorder()
+    data = b''.join( throttle.chunks( io.BytesIO( bytes( 5 * MiB // 2 ) ), si,
+                                      chunksize=768 * 1024, throttle=rec,
+                                      size=5 * MiB // 2 ) )
+    assert len( data ) == 5 * MiB // 2
+    K = 1024
+    assert rec.calls == [ ( 768 * K, 1, 5 ), ( 256 * K, 1, 5 ), ( 768 * K, 1, 2 ),
+                          ( 256 * K, 1, 2 ), ( 512 * K, 1, 5 ) ]
+    rec = _Recorder()
+    list( throttle.chunks( io.BytesIO( bytes( 10 ) ), throttle=rec, size=10 ) )
+    assert rec.calls == [ ( 10, 1, None ) ]
+    # without size, the read that finds EOF is charged too
+    rec = _Recorder()
+    list( throttle.chunks( io.BytesIO( bytes( 10 ) ), chunksize=8, throttle=rec ) )
+    assert rec.calls == [ ( 8, 1, None ), ( 8, 1, None ), ( 8, 1, None ) ]
+
+
+def test_chunks_acquire_first():
+    class _File( io.BytesIO ):
+        def read( self, n ):
+            rec.calls.append( 'read' )
+            return super( _File, self ).read( n )
+    rec = _Recorder()
+    list( throttle.chunks( _File( bytes( 10 ) ), chunksize=8, throttle=rec, size=10 ) )
+    assert rec.calls == [ ( 8, 1, None ), 'read', ( 2, 1, None ), 'read' ]
+
+
+def test_control_file( tmp_path ):
+    path = str( tmp_path / 'limits' )
+    t = throttle.Throttle()
+    ctl = throttle.ControlFile( path, throttle=t, interval=0.01 )
+    assert ctl.check() is False
+    with open( path, 'w' ) as f:
+        f.write( '# psync limits\nbandwidth = 100M\n\nost.*.bandwidth = 10M  # each\n' )
+    assert ctl.check() is True
+    assert t.limits == { 'bandwidth': 100 * MiB, 'ost.*.bandwidth': 10 * MiB, 'burst': 1.0 }
+    assert ctl.check() is False
+    # bad contents keep the previous limits
+    with open( path, 'w' ) as f:
+        f.write( 'bandwidth 100M\n' )
+    assert ctl.check() is False
+    assert t.limits[ 'bandwidth' ] == 100 * MiB
+    os.unlink( path )
+    with ctl:
+        assert not t.active
+        with open( path, 'w' ) as f:
+            f.write( 'iops = 50\n' )
+        deadline = time.monotonic() + 5
+        while not t.active and time.monotonic() < deadline:
+            time.sleep( 0.01 )
+    assert t.limits == { 'iops': 50, 'burst': 1.0 }
+
+
+@pytest.fixture
+def limited( sim, rsync, monkeypatch ):
+    # tokens for a billion seconds: nothing waits, usage can be read off the buckets
+    t = throttle.Throttle( { 'bandwidth': 1, 'iops': 1, 'ost.*.bandwidth': 1,
+                             'burst': 1e9 } )
+    monkeypatch.setattr( throttle, 'limiter', t )
+    return t
+
+
+def test_syncfile_throttled( limited, tmp_path, monkeypatch ):
+    data = os.urandom( 3 * MiB + 17 )
+    src = str( tmp_path / 'src' )
+    backend.for_path( src ).setstripeinfo( src, count=2, offset=1 )
+    with open( src, 'r+b' ) as f:
+        f.write( data )
+    os.utime( src, ( 1000000000, 1000000000 ) )
+    rsyncargs = []
+    def _rsync_cmd( plan, fn=pylut._rsync_cmd ):
+        rv = fn( plan )
+        rsyncargs.append( rv[2] )
+        return rv
+    monkeypatch.setattr( pylut, '_rsync_cmd', _rsync_cmd )
+    tgt = fsitem.FSItem( str( tmp_path / 'tgt' ) )
+    ( tmp, action ) = pylut.syncfile( fsitem.FSItem( src ), tgt,
+                                      tmpbase=str( tmp_path / 'tmp' ) )
+    assert action[ 'data_copy' ]
+    with open( tgt.absname, 'rb' ) as f:
+        assert f.read() == data
+    # times are left alone without synctimes, rsync doesn't copy again
+    assert os.stat( tgt.absname ).st_mtime != 1000000000
+    assert '--size-only' in rsyncargs[0]
+    # copy, src and tgt post checksums
+    def used( kind, scope ):
+        b = limited._bucket( kind, scope )
+        return b.capacity - b.tokens
+    assert used( 'bandwidth', 'global' ) == pytest.approx( 3 * len( data ), abs=1 )
+    # copy and src checksum read OSTs 1 and 2 (1MiB stripes, 1, 2, 1, 2)
+    assert used( 'bandwidth', 1 ) > 4 * MiB - 16
+    assert used( 'bandwidth', 2 ) > 2 * MiB + 16
+    assert used( 'iops', 'global' ) > 0
+
+
+def test_syncfile_throttled_synctimes( limited, tmp_path ):
+    src = str( tmp_path / 'src' )
+    with open( src, 'wb' ) as f:
+        f.write( os.urandom( MiB ) )
+    os.utime( src, ( 1000000000, 1000000000 ) )
+    tgt = fsitem.FSItem( str( tmp_path / 'tgt' ) )
+    pylut.syncfile( fsitem.FSItem( src ), tgt, tmpbase=str( tmp_path / 'tmp' ),
+                    synctimes=True )
+    assert os.stat( tgt.absname ).st_mtime == 1000000000
@@ -0,0 +1,140 @@
+import pytest
+import os
+import json
+import asyncio
+import threading
+import tracing
+import runcmd
+import fsitem
+import pylut
+
+
+@pytest.fixture
+def listsink():
+    sink = tracing.ListSink()
+    old = tracing.set_sink( sink )
+    yield sink
+    tracing.set_sink( old )
+
+
+def test_off():
+    assert tracing.sink is None
+    with tracing.span( 'x' ) as s:
+        pass
+    assert s is tracing._nullspan
+
+
+def test_span( listsink ):
+    with tracing.span( 'outer', step=1 ):
+        with pytest.raises( ValueError ):
+            with tracing.span( 'inner' ):
+                raise ValueError( 'boom' )
+    inner, outer = listsink.events
+    assert ( inner[ 'name' ], outer[ 'name' ] ) == ( 'inner', 'outer' )
+    assert outer[ 'ph' ] == 'X'
+    assert outer[ 'args' ] == { 'step': 1 }
+    assert 'boom' in inner[ 'args' ][ 'error' ]
+    assert outer[ 'pid' ] == os.getpid()
+    assert outer[ 'tid' ] == threading.get_native_id()
+    assert outer[ 'ts' ] <= inner[ 'ts' ]
+    assert outer[ 'ts' ] + outer[ 'dur' ] >= inner[ 'ts' ] + inner[ 'dur' ]
+
+
+def test_runcmd_span( listsink ):
+    runcmd.runcmd( [ 'echo' ], args=[ '-n', 'hi' ] )
+    ( ev, ) = listsink.events
+    assert ev[ 'name' ] == 'runcmd.echo'
+    assert ev[ 'cat' ] == 'runcmd'
+    assert ev[ 'args' ][ 'cmd' ] == [ 'echo', '-n', 'hi' ]
+
+
+def test_async_tasks( listsink, sim, rsync, tmp_path ):
+    """ concurrent syncfile_async: every task gets its own track, spans on
+        a track nest
+    """
+    srcs = []
+    for i in range( 8 ):
+        src = tmp_path / 'f{0}'.format( i )
+        src.write_bytes( b'x' * 1000 )
+        srcs.append( fsitem.FSItem( str( src ) ) )
+    async def run():
+        return await asyncio.gather( *[
+            pylut.syncfile_async( s, fsitem.FSItem( s.absname + '.tgt' ),
+                                  tmpbase=str( tmp_path / 'tmp' ) )
+            for s in srcs ] )
+    asyncio.run( run() )
+    spans = [ e for e in listsink.events if e[ 'ph' ] == 'X' ]
+    names = { e[ 'tid' ]: e[ 'args' ][ 'name' ] for e in listsink.events
+              if e[ 'ph' ] == 'M' and e[ 'name' ] == 'thread_name' }
+    tracks = {}
+    for e in spans:
+        tracks.setdefault( e[ 'tid' ], [] ).append( e )
+    assert len( [ t for t in tracks if t in names ] ) == len( srcs )
+    for events in tracks.values():
+        stack = []
+        for e in sorted( events, key=lambda e: ( e[ 'ts' ], -e[ 'dur' ] ) ):
+            while stack and stack[-1] <= e[ 'ts' ]:
+                stack.pop()
+            end = e[ 'ts' ] + e[ 'dur' ]
+            assert not stack or end <= stack[-1], e
+            stack.append( end )
+
+
+def test_chrome_trace_file( tmpdir ):
+    path = os.path.join( str( tmpdir ), 'trace.json' )
+    sink = tracing.ChromeTraceFile( path, bufsize=7 )
+    old = tracing.set_sink( sink )
+    try:
+        def work( n ):
+            for i in range( 100 ):
+                with tracing.span( 'work', n=n, i=i ):
+                    pass
+        threads = [ threading.Thread( target=work, args=( n, ) ) for n in range( 4 ) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        tracing.set_sink( old )
+        sink.close()
+    with open( path ) as f:
+        events = json.load( f )
+    spans = [ e for e in events if e[ 'ph' ] == 'X' ]
+    assert len( spans ) == 400
+    assert len( set( e[ 'tid' ] for e in spans ) ) == 4
+    assert sorted( ( e[ 'args' ][ 'n' ], e[ 'args' ][ 'i' ] ) for e in spans ) == \
+           [ ( n, i ) for n in range( 4 ) for i in range( 100 ) ]
+
+
+def test_chrome_trace_concurrent_flush( tmpdir ):
+    """ flush() from another thread while workers emit: every span exactly once
+    """
+    path = os.path.join( str( tmpdir ), 'trace.json' )
+    sink = tracing.ChromeTraceFile( path, bufsize=5 )
+    old = tracing.set_sink( sink )
+    done = threading.Event()
+    def flusher():
+        while not done.is_set():
+            sink.flush()
+    try:
+        def work( n ):
+            for i in range( 2000 ):
+                with tracing.span( 'work', n=n, i=i ):
+                    pass
+        threads = [ threading.Thread( target=work, args=( n, ) ) for n in range( 4 ) ]
+        f = threading.Thread( target=flusher )
+        f.start()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        done.set()
+        f.join()
+    finally:
+        tracing.set_sink( old )
+        sink.close()
+    with open( path ) as f:
+        events = json.load( f )
+    spans = [ e for e in events if e[ 'ph' ] == 'X' ]
+    assert sorted( ( e[ 'args' ][ 'n' ], e[ 'args' ][ 'i' ] ) for e in spans ) == \
+           [ ( n, i ) for n in range( 4 ) for i in range( 2000 ) ]
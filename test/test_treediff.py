@@ -0,0 +1,95 @@
+import pytest
+import os
+import shutil
+import time
+import itertools
+import catalog
+import pylut
+import treediff
+
+
+@pytest.fixture
+def trees( tmpdir, mktree ):
+    src = os.path.join( str( tmpdir ), 'src' )
+    tgt = os.path.join( str( tmpdir ), 'tgt' )
+    mktree( src, depth=2, fanout=2, nfiles=3, size=10 )
+    # target starts as an exact copy, then src gets modified
+    shutil.copytree( src, tgt, copy_function=shutil.copy2 )
+    time.sleep( 0.01 )
+    with open( os.path.join( src, 'd0', 'f0' ), 'ab' ) as f:    # size change
+        f.write( b'y' )
+    os.utime( os.path.join( src, 'd0', 'd0', 'f1' ), ns=( 5, 2 * 10**18 ) ) # newer
+    os.unlink( os.path.join( src, 'd1', 'f2' ) )                 # deleted
+    os.makedirs( os.path.join( src, 'new' ) )                    # new dir + file
+    with open( os.path.join( src, 'new', 'g' ), 'wb' ) as f:
+        f.write( b'z' )
+    os.unlink( os.path.join( src, 'f2' ) )                       # retyped
+    os.makedirs( os.path.join( src, 'f2' ) )
+    return ( src, tgt )
+
+
+def test_diff( trees ):
+    src, tgt = trees
+    plan = treediff.diff( catalog.Catalog.from_walk( src ),
+                          catalog.Catalog.from_walk( tgt ) )
+    assert sorted( plan.relpaths( 'data_copy' ) ) == [ 'd0/d0/f1', 'd0/f0', 'new/g' ]
+    assert plan.relpaths( 'meta_update' ) == []
+    assert sorted( plan.relpaths( 'mkdir' ) ) == [ 'f2', 'new' ]
+    assert sorted( plan.relpaths( 'delete' ) ) == [ 'd1/f2', 'f2' ]
+
+
+@pytest.mark.parametrize( 'opts', [
+    dict( zip( ( 'synctimes', 'syncowner', 'syncgroup' ), v ) )
+    for v in itertools.product( ( False, True ), repeat=3 ) ] )
+def test_compare_matches_compare_files( trees, opts ):
+    src, tgt = trees
+    # make some metadata differences too
+    os.chown( os.path.join( tgt, 'd1', 'f0' ), 1234, -1 )
+    os.chown( os.path.join( tgt, 'd1', 'f1' ), -1, 1234 )
+    os.utime( os.path.join( tgt, 'd0', 'f1' ), ns=( 5, os.lstat( os.path.join( src, 'd0', 'f1' ) ).st_mtime_ns ) )
+    scat = catalog.Catalog.from_walk( src )
+    tcat = catalog.Catalog.from_walk( tgt )
+    tids = { p: i for i, p in enumerate( tcat.relpaths() ) }
+    pairs = [ ( i, tids[p] ) for i, p in enumerate( scat.relpaths() )
+              if p in tids and not scat.item( i ).is_dir() ]
+    s = scat.entries[ [ p[0] for p in pairs ] ]
+    t = tcat.entries[ [ p[1] for p in pairs ] ]
+    data_ok, meta_ok = treediff.compare( s, t, **opts )
+    syncopts = dict( opts, pre_checksums=False )
+    for n, ( i, j ) in enumerate( pairs ):
+        expected = pylut._compare_files( scat.item( i ), tcat.item( j ), syncopts )
+        assert ( data_ok[n], meta_ok[n] ) == expected
+
+
+def test_diff_empty_target( trees, tmpdir ):
+    src, tgt = trees
+    empty = os.path.join( str( tmpdir ), 'empty' )
+    os.makedirs( empty )
+    scat = catalog.Catalog.from_walk( src )
+    plan = treediff.diff( scat, catalog.Catalog.from_walk( empty ) )
+    assert len( plan.data_copy ) + len( plan.mkdir ) == len( scat ) - 1
+    assert len( plan.delete ) == 0
+
+
+def _plan_paths( plan ):
+    return dict( ( k, sorted( plan.relpaths( k ) ) ) for k in plan.attrnames )
+
+
+def test_diff_hash_collisions( trees ):
+    """ Colliding path hashes, within and across catalogs, give the same plan
+    """
+    src, tgt = trees
+    scat = catalog.Catalog.from_walk( src )
+    tcat = catalog.Catalog.from_walk( tgt )
+    expected = _plan_paths( treediff.diff( scat, tcat ) )
+    # hash of path a is replaced by the hash of path b, in both catalogs
+    collide = { 'd0/f1': 'd1/f1',       # within a catalog
+                'new/g': 'd1/f0',       # src only path with a hash in tgt
+                'd1/f2': 'd0/d0/f2' }   # tgt only path with a hash in src
+    for cat in ( scat, tcat ):
+        ids = dict( ( p, i ) for i, p in enumerate( cat.relpaths() ) )
+        phash = cat.entries[ 'phash' ]
+        for a, b in collide.items():
+            if a in ids:
+                phash[ ids[ a ] ] = phash[ ids[ b ] ]
+    assert _plan_paths( treediff.diff( scat, tcat ) ) == expected
@@ -0,0 +1,58 @@
+import pytest
+import os
+import treewalk
+import fsitem
+
+
+@pytest.mark.parametrize( 'order', [ treewalk.ORDER_BREADTH, treewalk.ORDER_INODE ] )
+def test_walk_finds_everything( tmpdir, mktree, order ):
+    top = os.path.join( str( tmpdir ), 'tree' )
+    expected = mktree( top, symlink=True )
+    items = list( treewalk.walk( top, workers=4, order=order ) )
+    assert sorted( str( i ) for i in items ) == sorted( expected )
+    mnt = fsitem.getmountpoint( top )
+    for i in items:
+        # stat info was filled in by the scan
+        assert i._statinfo is not None
+        assert i.mountpoint == mnt
+        st = os.lstat( i.absname )
+        assert ( i.ino, i.size, i.mode ) == ( st.st_ino, st.st_size, st.st_mode )
+
+
+def test_walk_order( tmpdir, mktree ):
+    top = os.path.join( str( tmpdir ), 'tree' )
+    mktree( top, depth=2, symlink=True )
+    items = list( treewalk.walk( top, workers=1, order=treewalk.ORDER_INODE ) )
+    depths = [ i.absname.count( os.sep ) for i in items ]
+    assert depths == sorted( depths )
+    by_parent = {}
+    for i in items[1:]:
+        by_parent.setdefault( i.parent, [] ).append( i.ino )
+    for inodes in by_parent.values():
+        assert inodes == sorted( inodes )
+
+
+def test_walk_bounded_early_exit( tmpdir, mktree ):
+    top = os.path.join( str( tmpdir ), 'tree' )
+    mktree( top, symlink=True )
+    walker = treewalk.walk( top, workers=4, maxqueue=2 )
+    first = [ next( walker ) for i in range( 3 ) ]
+    walker.close()
+    assert len( first ) == 3
+
+
+def test_walk_missing_top( tmpdir ):
+    with pytest.raises( OSError ):
+        list( treewalk.walk( os.path.join( str( tmpdir ), 'nope' ) ) )
+
+
+def test_walk_nostat( tmpdir, mktree ):
+    top = os.path.join( str( tmpdir ), 'tree' )
+    expected = mktree( top, depth=2, symlink=True )
+    items = list( treewalk.walk( top, stat=False ) )
+    assert sorted( str( i ) for i in items ) == sorted( expected )
+    for i in items[1:]:
+        assert i._statinfo is None
+        islink = os.path.islink( i.absname )
+        assert i.is_symlink() == islink
+        assert i.is_dir() == ( os.path.isdir( i.absname ) and not islink )
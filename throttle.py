@@ -0,0 +1,396 @@
+import os
+import re
+import time
+import asyncio
+import logging
+import threading
+import metrics
+import pylut
+
+log = logging.getLogger( __name__ )
+
+# Max bytes read per request by chunks(), also never crosses a stripe boundary
+CHUNKSIZE = 4 * 1024 * 1024
+
+# Default bucket capacity, in seconds worth of the rate
+BURST = 1.0
+
+_suffixes = { '': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4 }
+_number = re.compile( r'^\s*([0-9.]+)\s*([kmgt]?)i?b?\s*$', re.IGNORECASE )
+
+
+class TokenBucket( object ):
+    """
+    Rate limiter: tokens are added at rate per second, up to capacity
+    A request takes its tokens at once and may run the bucket into debt; the
+    caller then waits until the debt is paid back.  So over any interval T
+    at most capacity + rate * T tokens (plus one request) are handed out,
+    and requests larger than the capacity still get through.
+    Not thread safe, see Throttle.
+    """
+    __slots__ = ( 'rate', 'capacity', 'tokens', 'stamp' )
+
+    def __init__( self, rate, capacity=None ):
+        self.rate = float( rate )
+        self.capacity = float( capacity if capacity is not None else rate * BURST )
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+
+
+    def set( self, rate, capacity=None ):
+        """ Change rate and capacity, keeping the current fill level
+        """
+        self.refill()
+        self.rate = float( rate )
+        self.capacity = float( capacity if capacity is not None else rate * BURST )
+        self.tokens = min( self.tokens, self.capacity )
+
+
+    def refill( self, now=None ):
+        if now is None:
+            now = time.monotonic()
+        self.tokens = min( self.capacity, self.tokens + ( now - self.stamp ) * self.rate )
+        self.stamp = now
+
+
+    def take( self, n, now=None ):
+        """
+        Take n tokens
+        :return float: seconds to wait before using them
+        """
+        self.refill( now )
+        self.tokens -= n
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+    def __repr__( self ):
+        return '<{0} rate={1} capacity={2} tokens={3:.0f}>'.format(
+            self.__class__.__name__, self.rate, self.capacity, self.tokens )
+
+
+class Throttle( object ):
+    """
+    Global and per-OST token buckets for bytes and I/O operations
+    Limits (see configure):
+      bandwidth          bytes/s of data read by copies and checksums
+      iops               operations/s: data I/O requests plus Lustre
+                         metadata calls (FID, layout, size lookups, setstripe)
+      ost.<N>.bandwidth  bytes/s read from OST index N
+      ost.<N>.iops       I/O requests/s to OST index N
+      ost.*.bandwidth    default for every OST without its own limit
+      ost.*.iops
+      burst              bucket capacity, in seconds worth of each rate
+                         (default BURST)
+    Missing or zero limits are unlimited.  Thread safe; a caller that has to
+    wait sleeps without holding the lock.
+    """
+
+    def __init__( self, limits=None ):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._ostdefaults = {}
+        self.limits = {}
+        self.active = False
+        self.per_ost = False
+        self.configure( limits or {} )
+
+
+    def configure( self, limits ):
+        """
+        Replace all limits, see class docstring for the names
+        Buckets that stay limited keep their fill level.
+        :param limits dict: name -> number (or str with a K/M/G/T suffix)
+        """
+        limits = dict( ( k, parse_number( v ) ) for k, v in limits.items() )
+        for k in limits:
+            if _limitkey( k ) is None:
+                raise ThrottleError( 'Unknown limit {0!r}'.format( k ), limits )
+        burst = limits.pop( 'burst', None ) or BURST
+        with self._lock:
+            buckets = {}
+            ostdefaults = {}
+            for k, rate in limits.items():
+                if not rate:
+                    continue
+                key = _limitkey( k )
+                if key[1] == '*':
+                    ostdefaults[ key[0] ] = ( rate, burst )
+                    continue
+                b = self._buckets.get( key )
+                if b is None:
+                    b = TokenBucket( rate, rate * burst )
+                else:
+                    b.set( rate, rate * burst )
+                buckets[ key ] = b
+            # OST buckets created from a default earlier are kept if it still applies
+            for key, b in self._buckets.items():
+                if key in buckets or not isinstance( key[1], int ):
+                    continue
+                if key[0] in ostdefaults:
+                    rate = ostdefaults[ key[0] ][0]
+                    b.set( rate, rate * burst )
+                    buckets[ key ] = b
+            self._buckets = buckets
+            self._ostdefaults = ostdefaults
+            self.limits = limits
+            self.limits[ 'burst' ] = burst
+            self.per_ost = bool( ostdefaults ) or any(
+                isinstance( k[1], int ) for k in buckets )
+            self.active = bool( buckets ) or self.per_ost
+        log.debug( 'throttle limits {0}'.format( self.limits ) )
+
+
+    def _bucket( self, kind, scope ):
+        """ Return bucket for ( kind, scope ), None if unlimited (lock held)
+        """
+        key = ( kind, scope )
+        b = self._buckets.get( key )
+        if b is None and scope != 'global' and kind in self._ostdefaults:
+            ( rate, burst ) = self._ostdefaults[ kind ]
+            b = self._buckets[ key ] = TokenBucket( rate, rate * burst )
+        return b
+
+
+    def reserve( self, nbytes=0, ops=0, ost=None ):
+        """
+        Take tokens from every bucket that applies
+        :return float: seconds the caller must wait before doing the I/O
+        """
+        wait = 0.0
+        now = time.monotonic()
+        with self._lock:
+            for kind, n in ( ( 'bandwidth', nbytes ), ( 'iops', ops ) ):
+                if not n:
+                    continue
+                for scope in ( 'global', ost ):
+                    if scope is None:
+                        continue
+                    b = self._bucket( kind, scope )
+                    if b is not None:
+                        wait = max( wait, b.take( n, now ) )
+        if wait > 0:
+            metrics.incr( 'throttle.waits' )
+            metrics.observe( 'throttle.wait', wait )
+        return wait
+
+
+    def acquire( self, nbytes=0, ops=0, ost=None ):
+        """ Take tokens, sleeping until they may be used
+        """
+        wait = self.reserve( nbytes, ops, ost )
+        if wait > 0:
+            time.sleep( wait )
+
+
+    async def acquire_async( self, nbytes=0, ops=0, ost=None ):
+        """ asyncio version of acquire
+        """
+        wait = self.reserve( nbytes, ops, ost )
+        if wait > 0:
+            await asyncio.sleep( wait )
+
+
+    def __repr__( self ):
+        return '<{0} {1}>'.format( self.__class__.__name__, self.limits )
+
+
+class ControlFile( object ):
+    """
+    Keep a Throttle's limits in sync with a control file
+    The file has one limit per line, "name = value", values may have a
+    K/M/G/T suffix (powers of 1024), # starts a comment, ie:
+        bandwidth = 500M
+        iops = 2000
+        ost.*.bandwidth = 100M
+        ost.7.bandwidth = 20M
+    The file is checked every interval seconds and reloaded when its mtime
+    or size changes, a missing file means no limits.  If the new contents
+    can't be parsed, the error is logged and the previous limits stay.
+    Start with start() (or use as a context manager), stop with stop().
+    """
+
+    def __init__( self, path, throttle=None, interval=5.0 ):
+        self.path = path
+        self.throttle = throttle if throttle is not None else limiter
+        self.interval = interval
+        self._sig = None
+        self._stop = threading.Event()
+        self._thread = None
+
+
+    def check( self ):
+        """
+        Reload the file if it changed
+        :return bool: True if the limits were replaced
+        """
+        try:
+            st = os.stat( self.path )
+            sig = ( st.st_mtime_ns, st.st_size, st.st_ino )
+        except ( FileNotFoundError ):
+            sig = None
+        if sig == self._sig:
+            return False
+        try:
+            limits = {} if sig is None else load( self.path )
+            self.throttle.configure( limits )
+        except ( OSError, ThrottleError ) as e:
+            log.warning( 'throttle control file {0} not loaded: {1}'.format( self.path, e ) )
+            return False
+        finally:
+            self._sig = sig
+        log.info( 'throttle limits from {0}: {1}'.format( self.path, self.throttle.limits ) )
+        return True
+
+
+    def start( self ):
+        self.check()
+        self._thread = threading.Thread( target=self._run, name='throttlecontrol' )
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+
+    def stop( self ):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+    def _run( self ):
+        while not self._stop.wait( self.interval ):
+            self.check()
+
+
+    def __enter__( self ):
+        return self.start()
+
+
+    def __exit__( self, *exc ):
+        self.stop()
+
+
+def load( path ):
+    """
+    Parse a control file, see ControlFile
+    :return dict: limit name -> number
+    """
+    limits = {}
+    with open( path ) as f:
+        for lineno, line in enumerate( f, 1 ):
+            line = line.split( '#', 1 )[0].strip()
+            if not line:
+                continue
+            ( name, sep, value ) = line.partition( '=' )
+            name = name.strip()
+            if not sep or _limitkey( name ) is None:
+                raise ThrottleError( '{0}:{1}: bad line {2!r}'.format( path, lineno, line ),
+                                     path )
+            limits[ name ] = parse_number( value )
+    return limits
+
+
+def parse_number( value ):
+    """ Return value as a number, str values may have a K/M/G/T suffix
+    """
+    if isinstance( value, ( int, float ) ):
+        return value
+    m = _number.match( str( value ) )
+    if m is None:
+        raise ThrottleError( 'Bad number {0!r}'.format( value ), value )
+    n = float( m.group( 1 ) ) * _suffixes[ m.group( 2 ).lower() ]
+    return int( n ) if n == int( n ) else n
+
+
+def _limitkey( name ):
+    """ Return ( kind, scope ) for limit name, None if unknown
+        scope is 'global', an OST index or '*'
+    """
+    if name == 'burst':
+        return ( 'burst', 'global' )
+    parts = name.split( '.' )
+    if len( parts ) == 1 and parts[0] in ( 'bandwidth', 'iops' ):
+        return ( parts[0], 'global' )
+    if len( parts ) == 3 and parts[0] == 'ost' and parts[2] in ( 'bandwidth', 'iops' ):
+        if parts[1] == '*':
+            return ( parts[2], '*' )
+        if parts[1].isdigit():
+            return ( parts[2], int( parts[1] ) )
+    return None
+
+
+def chunks( f, stripeinfo=None, chunksize=CHUNKSIZE, throttle=None, size=None ):
+    """
+    Yield the contents of binary file object f in chunks, drawing bandwidth
+    and one I/O operation per chunk from the throttle (default: limiter)
+    before each read
+    With a stripeinfo that lists objects (index_info), chunks don't cross
+    stripe boundaries and are charged to the OST they were read from.
+    With size (bytes to read, ie: from os.fstat), reading stops there and
+    the last chunk is charged exactly; without it, the read that finds EOF
+    is charged a full chunk.
+    """
+    if throttle is None:
+        throttle = limiter
+    osts = None
+    if stripeinfo is not None and stripeinfo.index_info and stripeinfo.size:
+        osts = [ i[ pylut.LustreStripeInfo.index_obdidx ] for i in stripeinfo.index_info ]
+        ssize = int( stripeinfo.size )
+    offset = 0
+    while True:
+        ost = None
+        n = chunksize
+        if osts is not None:
+            ( stripe, within ) = divmod( offset, ssize )
+            ost = osts[ stripe % len( osts ) ]
+            n = min( n, ssize - within )
+        if size is not None:
+            n = min( n, size - offset )
+            if n <= 0:
+                return
+        # wait before the read, so the I/O itself is what gets paced
+        throttle.acquire( nbytes=n, ops=1, ost=ost )
+        data = f.read( n )
+        if not data:
+            return
+        yield data
+        offset += len( data )
+
+
+def ops( n=1 ):
+    """ Draw n metadata operations from limiter (no-op if there are no limits)
+    """
+    if limiter.active:
+        limiter.acquire( ops=n )
+
+
+async def ops_async( n=1 ):
+    """ asyncio version of ops
+    """
+    if limiter.active:
+        await limiter.acquire_async( ops=n )
+
+
+class ThrottleError( Exception ):
+    """ Bad limit or control file
+    """
+    def __init__( self, reason, origin, *a, **k ):
+        super( ThrottleError, self ).__init__( *a, **k )
+        self.reason = reason
+        self.origin = origin
+
+    def __repr__( self ):
+        return "<{0} (reason={1} origin={2})>".format(
+            self.__class__.__name__, self.reason, self.origin )
+
+    __str__ = __repr__
+
+
+# The process wide limits, used by pylut and fsitem
+limiter = Throttle()
+
+
+if __name__ == '__main__':
+    raise UserWarning( 'Cmdline not supported' )
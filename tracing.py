@@ -0,0 +1,226 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import itertools
+import threading
+import weakref
+
+log = logging.getLogger( __name__ )
+
+# Where spans go, None means tracing is off, see set_sink()
+sink = None
+
+# Tids given to asyncio tasks, see _tid()
+_task_tids = weakref.WeakKeyDictionary()
+_task_tid_next = itertools.count( 1 << 32 )
+_task_lock = threading.Lock()
+
+
+class ChromeTraceFile( object ):
+    """
+    Trace sink writing Chrome trace-event JSON (array format), which can be
+    loaded in chrome://tracing or Perfetto
+    Events are buffered per thread and written bufsize at a time, so worker
+    threads don't contend on a shared lock for every span.  close() writes
+    out what is left; a file that was not closed is still loadable (the
+    closing bracket of the array is optional in this format).
+    """
+
+    def __init__( self, path, bufsize=1000 ):
+        self.path = path
+        self.bufsize = bufsize
+        self._f = open( path, 'w' )
+        self._f.write( '[\n' )
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._buffers = []
+
+
+    def emit( self, event ):
+        try:
+            buf = self._local.buf
+        except ( AttributeError ):
+            buf = self._local.buf = _ThreadBuffer()
+            with self._lock:
+                self._buffers.append( buf )
+        with buf.lock:
+            buf.events.append( event )
+            if len( buf.events ) < self.bufsize:
+                return
+            events, buf.events = buf.events, []
+        self._write( events )
+
+
+    def _write( self, events ):
+        text = ''.join( json.dumps( e ) + ',\n' for e in events )
+        with self._lock:
+            if self._f is not None:
+                self._f.write( text )
+
+
+    def flush( self ):
+        """ Write out the buffers of all threads
+        """
+        with self._lock:
+            buffers = list( self._buffers )
+        for buf in buffers:
+            # flush() may run in any thread, swap the list out under the
+            # buffer's lock so no event is written twice or dropped
+            with buf.lock:
+                events, buf.events = buf.events, []
+            if events:
+                self._write( events )
+        with self._lock:
+            if self._f is not None:
+                self._f.flush()
+
+
+    def close( self ):
+        self.flush()
+        with self._lock:
+            if self._f is None:
+                return
+            # metadata event, so the array doesn't end with a comma
+            self._f.write( json.dumps( { 'name': 'process_name', 'ph': 'M',
+                                         'pid': os.getpid(),
+                                         'args': { 'name': 'pylut' } } ) )
+            self._f.write( '\n]\n' )
+            self._f.close()
+            self._f = None
+
+
+class _ThreadBuffer( object ):
+    """ Events of one thread, not yet written
+    """
+    __slots__ = ( 'events', 'lock' )
+
+    def __init__( self ):
+        self.events = []
+        self.lock = threading.Lock()
+
+
+class ListSink( object ):
+    """
+    Trace sink keeping events in a list (for tests and in-process analysis)
+    """
+
+    def __init__( self ):
+        self.events = []
+        self._lock = threading.Lock()
+
+    def emit( self, event ):
+        with self._lock:
+            self.events.append( event )
+
+    def flush( self ):
+        pass
+
+    def close( self ):
+        pass
+
+
+class _Span( object ):
+    """
+    Context manager emitting one complete ("X") trace event for its block
+    """
+    __slots__ = ( 'sink', 'name', 'cat', 'args', 'start' )
+
+    def __init__( self, sink, name, cat, args ):
+        self.sink = sink
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__( self ):
+        self.start = time.time()
+        return self
+
+    def __exit__( self, exc_type, exc, tb ):
+        end = time.time()
+        args = self.args
+        if exc_type is not None and exc_type is not GeneratorExit:
+            args = dict( args, error=repr( exc ) )
+        ts = int( self.start * 1000000 )
+        self.sink.emit( {
+            'name': self.name,
+            'cat': self.cat,
+            'ph': 'X',
+            'ts': ts,
+            'dur': int( end * 1000000 ) - ts,
+            'pid': os.getpid(),
+            'tid': _tid( self.sink ),
+            'args': args,
+            } )
+        return False
+
+
+def _tid( sink ):
+    """
+    Trace tid for the caller: the native thread id, or inside an asyncio
+    task a made up id of that task.  Tasks interleave on the loop thread,
+    their spans would overlap without nesting on a single tid.  A task's
+    first span also emits a thread_name event naming its track.
+    """
+    loop = asyncio._get_running_loop()
+    task = asyncio.current_task( loop ) if loop is not None else None
+    if task is None:
+        return threading.get_native_id()
+    tid = _task_tids.get( task )
+    if tid is not None:
+        return tid
+    with _task_lock:
+        tid = _task_tids.get( task )
+        if tid is not None:
+            return tid
+        tid = _task_tids[ task ] = next( _task_tid_next )
+    sink.emit( { 'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(),
+                 'tid': tid, 'args': { 'name': task.get_name() } } )
+    return tid
+
+
+class _NullSpan( object ):
+    """ Does nothing, used while tracing is off
+    """
+    __slots__ = ()
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc, tb ):
+        return False
+
+_nullspan = _NullSpan()
+
+
+def set_sink( new ):
+    """
+    Send spans to new (ie: ChromeTraceFile), None turns tracing off
+    The previous sink is flushed, not closed.
+    :return: the previous sink
+    """
+    global sink
+    old = sink
+    sink = new
+    if old is not None:
+        old.flush()
+    return old
+
+
+def span( name, cat='pylut', **args ):
+    """
+    Return context manager that records its block as a span, ie:
+        with tracing.span( 'rsync', cat='runcmd', cmd=cmdlist ):
+            ...
+    args must be JSON serializable.  Costs one function call while tracing
+    is off.
+    """
+    s = sink
+    if s is None:
+        return _nullspan
+    return _Span( s, name, cat, args )
+
+
+if __name__ == '__main__':
+    raise UserWarning( 'Cmdline not supported' )
@@ -0,0 +1,204 @@
+import stat
+import logging
+import numpy
+
+log = logging.getLogger( __name__ )
+
+# file type bits of st_mode
+_S_IFMT = 0o170000
+
+
+class SyncPlan( object ):
+    """
+    class SyncPlan( object )
+    Result of diff(), arrays of path_ids
+        data_copy:   src entries (non-directories) whose data must be copied
+        meta_update: src entries (non-directories) whose data is ok but whose
+                     metadata must be updated
+        mkdir:       src directories that don't exist in tgt
+        delete:      tgt entries that don't exist in src, or that exist with a
+                     different file type
+    """
+    attrnames = ( 'data_copy', 'meta_update', 'mkdir', 'delete' )
+
+    def __init__( self, src, tgt, **kwargs ):
+        self.src = src
+        self.tgt = tgt
+        for k in self.attrnames:
+            setattr( self, k, kwargs[ k ] )
+
+
+    def relpaths( self, name ):
+        """
+        Return list of relative paths for one of the attrnames
+        (delete is relative to the tgt catalog, all others to src)
+        """
+        cat = self.tgt if name == 'delete' else self.src
+        relpaths = cat.relpaths()
+        return [ relpaths[i] for i in getattr( self, name ) ]
+
+
+    def __repr__( self ):
+        return '<{0} {1}>'.format( self.__class__.__name__,
+            ' '.join( '{0}={1}'.format( k, len( getattr( self, k ) ) )
+                      for k in self.attrnames ) )
+
+
+def diff( src, tgt, synctimes=False, syncowner=False, syncgroup=False ):
+    """
+    Compare two catalogs of the same tree, return a SyncPlan
+    Entries are joined by relative path (sort-merge on the path hash, see
+    _join) and compared with vectorized numpy operations.  For entries that exist on
+    both sides, data_ok and meta_ok are the same as pylut._compare_files
+    would decide with the same sync options (pre_checksums can't be decided
+    from a catalog and is not supported).
+    :param src catalog.Catalog: source tree
+    :param tgt catalog.Catalog: target tree
+    :param synctimes bool: same as for pylut.syncfile
+    :param syncowner bool: same as for pylut.syncfile
+    :param syncgroup bool: same as for pylut.syncfile
+    :return SyncPlan:
+    """
+    se = src.entries
+    te = tgt.entries
+    s_idx, t_idx, s_only, t_only = _join( src, tgt )
+
+    # gather only the columns that are compared, not whole rows
+    s = _columns( se, s_idx )
+    t = _columns( te, t_idx )
+    s_fmt = s[ 'mode' ] & _S_IFMT
+    t_fmt = t[ 'mode' ] & _S_IFMT
+    same_type = s_fmt == t_fmt
+    s_isdir = s_fmt == stat.S_IFDIR
+    data_ok, meta_ok = compare( s, t, synctimes=synctimes,
+                                syncowner=syncowner, syncgroup=syncgroup )
+    files = same_type & ~s_isdir
+    retyped = ~same_type
+
+    src_only_isdir = ( se[ 'mode' ][ s_only ] & _S_IFMT ) == stat.S_IFDIR
+    plan = SyncPlan(
+        src, tgt,
+        data_copy=numpy.concatenate( (
+            s_idx[ files & ~data_ok ],
+            s_idx[ retyped & ~s_isdir ],
+            s_only[ ~src_only_isdir ] ) ),
+        meta_update=s_idx[ files & data_ok & ~meta_ok ],
+        mkdir=numpy.concatenate( (
+            s_idx[ retyped & s_isdir ],
+            s_only[ src_only_isdir ] ) ),
+        delete=numpy.concatenate( ( t_idx[ retyped ], t_only ) ),
+        )
+    log.debug( 'diff {0} -> {1}: {2}'.format( src, tgt, plan ) )
+    return plan
+
+
+def compare( s, t, synctimes=False, syncowner=False, syncgroup=False ):
+    """
+    Vectorized version of pylut._compare_files
+    :param s numpy.ndarray: catalog entries (src), or a dict of their columns
+    :param t numpy.ndarray: catalog entries (tgt), same length as s
+    :return two-tuple: boolean arrays ( data_ok, meta_ok )
+    """
+    # Fast check, if src ctime older, nothing to do
+    unchanged = t[ 'ctime_ns' ] > s[ 'ctime_ns' ]
+    # Check for data changes
+    data_bad = s[ 'size' ] != t[ 'size' ]
+    if synctimes:
+        data_bad |= s[ 'mtime_ns' ] != t[ 'mtime_ns' ]
+    data_bad |= s[ 'mtime_ns' ] > t[ 'mtime_ns' ]
+    # Check for metadata changes
+    if syncowner:
+        meta_bad = s[ 'uid' ] != t[ 'uid' ]
+    elif syncgroup:
+        meta_bad = s[ 'gid' ] != t[ 'gid' ]
+    elif synctimes:
+        meta_bad = s[ 'atime_ns' ] != t[ 'atime_ns' ]
+    else:
+        meta_bad = numpy.zeros( len( s[ 'size' ] ), dtype=bool )
+    data_ok = unchanged | ~data_bad
+    meta_ok = unchanged | ( ~data_bad & ~meta_bad )
+    return ( data_ok, meta_ok )
+
+
+def _columns( entries, idx ):
+    return { k: entries[ k ][ idx ] for k in _compared_columns }
+
+_compared_columns = ( 'mode', 'size', 'uid', 'gid', 'atime_ns', 'mtime_ns', 'ctime_ns' )
+
+
+def _join( src, tgt ):
+    """
+    Pair up the entries of src and tgt that have the same relative path
+    Entries whose path hash is unique are joined with a sort-merge on the
+    hash, then the paths of each pair are compared, so a hash collision
+    between src and tgt can't pair two different files.  Entries whose hash
+    is not unique, and pairs whose paths differ, are joined by path instead.
+    :return four-tuple: arrays of path_ids ( src matched, tgt matched,
+                        src only, tgt only ), matched arrays are pairwise
+    """
+    se = src.entries
+    te = tgt.entries
+    s_keys, s_order, s_dup = _sorted_keys( se )
+    t_keys, t_order, t_dup = _sorted_keys( te )
+    # a hash that is unique on one side but duplicated on the other can't be
+    # merged either
+    s_slow = s_dup | numpy.isin( s_keys, t_keys[ t_dup ] )
+    t_slow = t_dup | numpy.isin( t_keys, s_keys[ s_dup ] )
+    s_keys, s_fast = s_keys[ ~s_slow ], s_order[ ~s_slow ]
+    t_keys, t_fast = t_keys[ ~t_slow ], t_order[ ~t_slow ]
+    # merge join
+    if len( t_keys ) > 0:
+        pos = numpy.searchsorted( t_keys, s_keys )
+        numpy.minimum( pos, len( t_keys ) - 1, out=pos )
+        matched = t_keys[ pos ] == s_keys
+    else:
+        pos = numpy.zeros( len( s_keys ), dtype=numpy.intp )
+        matched = numpy.zeros( len( s_keys ), dtype=bool )
+    s_idx = s_fast[ matched ]
+    t_idx = t_fast[ pos[ matched ] ]
+    s_slow = s_order[ s_slow ]
+    t_slow = t_order[ t_slow ]
+    if len( s_idx ) > 0 or len( s_slow ) > 0:
+        s_paths = numpy.array( src.relpaths(), dtype=object )
+        t_paths = numpy.array( tgt.relpaths(), dtype=object )
+        same = s_paths[ s_idx ] == t_paths[ t_idx ]
+        if not same.all():
+            # hash collision between src and tgt
+            s_slow = numpy.concatenate( ( s_slow, s_idx[ ~same ] ) )
+            t_slow = numpy.concatenate( ( t_slow, t_idx[ ~same ] ) )
+            s_idx = s_idx[ same ]
+            t_idx = t_idx[ same ]
+        if len( s_slow ) > 0 and len( t_slow ) > 0:
+            log.debug( 'path hash collisions, joining {0} src and {1} tgt entries '
+                       'by path'.format( len( s_slow ), len( t_slow ) ) )
+            bypath = dict( zip( t_paths[ t_slow ].tolist(), t_slow.tolist() ) )
+            pairs = [ ( i, bypath[ p ] ) for i, p in
+                      zip( s_slow.tolist(), s_paths[ s_slow ].tolist() ) if p in bypath ]
+            if pairs:
+                s_idx = numpy.concatenate( ( s_idx, [ i for i, j in pairs ] ) ).astype( numpy.intp )
+                t_idx = numpy.concatenate( ( t_idx, [ j for i, j in pairs ] ) ).astype( numpy.intp )
+    s_seen = numpy.zeros( len( se ), dtype=bool )
+    s_seen[ s_idx ] = True
+    t_seen = numpy.zeros( len( te ), dtype=bool )
+    t_seen[ t_idx ] = True
+    return ( s_idx, t_idx, numpy.flatnonzero( ~s_seen ), numpy.flatnonzero( ~t_seen ) )
+
+
+def _sorted_keys( entries ):
+    """
+    :return three-tuple: sorted path hashes, the row of each, and a mask of
+                         the hashes that occur more than once
+    """
+    keys = entries[ 'phash' ]
+    order = numpy.argsort( keys, kind='stable' )
+    keys = keys[ order ]
+    dup = numpy.zeros( len( keys ), dtype=bool )
+    if len( keys ) > 1:
+        eq = keys[1:] == keys[:-1]
+        dup[1:] |= eq
+        dup[:-1] |= eq
+    return ( keys, order, dup )
+
+
+if __name__ == '__main__':
+    raise UserWarning( 'Cmdline not supported' )
@@ -0,0 +1,186 @@
+import os
+import fsitem
+import logging
+import threading
+import collections
+import queue
+
+log = logging.getLogger( __name__ )
+
+
+ORDER_BREADTH = 'breadth'
+ORDER_INODE = 'inode'
+
+
+def walk( top, workers=8, order=ORDER_BREADTH, maxqueue=10000, onerror=None,
+          stat=True, faststat=False ):
+    """
+    Parallel directory tree traversal, built on os.scandir
+    Directories are scanned concurrently by a pool of worker threads.
+    Yields an FSItem for top and for every entry below it; items are built
+    with FSItem.from_direntry, so the mountpoint is inherited from top and
+    stat information comes from the directory scan.  Directories on a
+    different filesystem than top are yielded but not descended into.
+    :param top       str: directory to walk
+    :param workers   int: number of directories scanned in parallel (default=8)
+    :param order     str: ORDER_BREADTH (default) yields directories in
+                          (approximately) breadth-first order
+                          ORDER_INODE additionally sorts the entries of each
+                          directory by inode number, for MDT locality
+    :param maxqueue  int: max number of FSItems waiting to be consumed, bounds
+                          memory use when the caller is slower than the scan
+    :param onerror  func: OPTIONAL called with the OSError instance if a
+                          directory can't be scanned; by default errors are
+                          logged and the directory is skipped
+    :param stat     bool: if True (default), stat each entry during the scan;
+                          if False, items are yielded without stat info (file
+                          type is still known from the directory entry) and
+                          other filesystems are not detected
+    :param faststat bool: if True, items use MDS-only stat (see FSItem.stat)
+    """
+    if order not in ( ORDER_BREADTH, ORDER_INODE ):
+        raise UserWarning( "Unknown walk order '{0}'".format( order ) )
+    root = fsitem.FSItem( top )
+    root.stat()
+    yield root
+    if not root.is_dir():
+        return
+    walker = _Walker( root, workers, order, maxqueue, onerror, stat, faststat )
+    try:
+        for item in walker.run():
+            yield item
+    finally:
+        walker.stop()
+
+
+class _Walker( object ):
+    """
+    Shared state between the walk() generator and its scanning threads
+    """
+
+    # sentinel put on the output queue by each thread when it finishes
+    _done = object()
+
+    def __init__( self, root, workers, order, maxqueue, onerror, dostat, faststat ):
+        self.root = root
+        self.dev = root.dev
+        self.workers = workers
+        self.order = order
+        self.onerror = onerror
+        self.dostat = dostat
+        self.faststat = faststat
+        self.dirs = collections.deque( [ root ] )
+        self.active = 0
+        self.stopped = False
+        self.cond = threading.Condition()
+        self.output = queue.Queue( maxsize=maxqueue )
+
+
+    def run( self ):
+        threads = [ threading.Thread( target=self._worker ) for i in range( self.workers ) ]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        running = len( threads )
+        while running > 0:
+            item = self.output.get()
+            if item is self._done:
+                running -= 1
+                continue
+            yield item
+
+
+    def stop( self ):
+        """ Release all threads, called when the consumer goes away early
+        """
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        try:
+            while True:
+                self.output.get_nowait()
+        except queue.Empty:
+            pass
+
+
+    def _next_dir( self ):
+        with self.cond:
+            while not self.dirs and self.active > 0 and not self.stopped:
+                self.cond.wait()
+            if self.stopped or not self.dirs:
+                # nothing left to scan and nobody is scanning
+                self.cond.notify_all()
+                return None
+            self.active += 1
+            return self.dirs.popleft()
+
+
+    def _worker( self ):
+        try:
+            while True:
+                parent = self._next_dir()
+                if parent is None:
+                    break
+                try:
+                    self._scan( parent )
+                finally:
+                    with self.cond:
+                        self.active -= 1
+                        self.cond.notify_all()
+        finally:
+            self._put( self._done, force=True )
+
+
+    def _scan( self, parent ):
+        try:
+            with os.scandir( parent.absname ) as it:
+                entries = list( it )
+        except ( OSError ) as e:
+            self._error( e )
+            return
+        if self.order == ORDER_INODE:
+            entries.sort( key=lambda e: e.inode() )
+        subdirs = []
+        for entry in entries:
+            item = fsitem.FSItem.from_direntry( entry, parent,
+                                                faststat=self.faststat )
+            if self.dostat:
+                try:
+                    item.stat()
+                except ( OSError ) as e:
+                    self._error( e )
+                    continue
+                if item.is_dir() and item.dev == self.dev:
+                    subdirs.append( item )
+            elif item.is_dir():
+                subdirs.append( item )
+            if not self._put( item ):
+                return
+        if subdirs:
+            with self.cond:
+                self.dirs.extend( subdirs )
+                self.cond.notify_all()
+
+
+    def _put( self, item, force=False ):
+        """ Blocking put on the output queue that gives up when stopped
+        """
+        while force or not self.stopped:
+            try:
+                self.output.put( item, timeout=0.1 )
+                return True
+            except queue.Full:
+                if force and self.stopped:
+                    return False
+        return False
+
+
+    def _error( self, e ):
+        if self.onerror is not None:
+            self.onerror( e )
+        else:
+            log.warning( 'walk error: {0}'.format( e ) )
+
+
+if __name__ == '__main__':
+    raise UserWarning( 'Cmdline not supported' )